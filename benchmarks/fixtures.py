@@ -0,0 +1,148 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Synthetic sentinel 2 fixtures for the benchmarks
+
+    Makes a granule of georeferenced uint16 bands at the 10, 20 and 60 m sentinel 2 sizes, in utm (like the real
+    tiles) or reprojected to wgs84, plus kml cutlines over it. Pixels are smooth paddock like patches with noise,
+    so compression and resampling cost about what they do on real data.
+
+"""
+
+import os
+import numpy as np
+from osgeo import gdal, osr
+
+
+
+# full size of a sentinel 2 tile at each resolution (metres: pixels)
+TILE_SIZES = {10: 10980, 20: 5490, 60: 1830}
+
+# bands used by the library's indices and rgb, and their resolutions
+FIXTURE_BANDS = {"B02": 10, "B03": 10, "B04": 10, "B08": 10, "B05": 20, "B07": 20, "B11": 20, "B01": 60}
+
+# top left corner of tile 56HLH in EPSG:32756
+TILE_ORIGIN = (300000.0, 6300040.0)
+TILE_EPSG = 32756
+
+GRANULE_NAME = "T56HLH_20190204T000241"
+
+
+
+def _srs(epsg):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+
+def synthetic_band(size, band_name, seed=0):
+    """
+        Make a (size, size) uint16 band of reflectance like values: 32 x 32 patches of constant "crop" plus noise
+    """
+    random = np.random.RandomState(seed + sum(ord(char) for char in band_name))
+
+    patches = random.randint(500, 4000, (32, 32)).astype(np.float32)
+    rows = np.arange(size) * 32 // size
+    data = patches[rows][:, rows]
+    data += random.normal(0, 150, (size, size)).astype(np.float32)
+
+    return np.clip(data, 1, 10000).astype(np.uint16)
+
+
+
+def make_granule(directory, scale=1.0, projection="utm", driver="GTiff"):
+    """
+        Write a synthetic granule.
+        Input: output directory, fraction of the full tile size (eg. 0.25 for a quarter of the width and height),
+        "utm" or "wgs84", gdal driver of the band files ("GTiff", or "JP2OpenJPEG" when gdal has it)
+        Return: dictionary of {band name: path}
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    extension = ".jp2" if driver.startswith("JP2") else ".tif"
+    utm = _srs(TILE_EPSG)
+    bands = {}
+
+    for band_name, resolution in sorted(FIXTURE_BANDS.items()):
+        size = max(1, int(TILE_SIZES[resolution] * scale))
+        pixel_size = TILE_SIZES[10] * 10.0 / size
+
+        mem_ds = gdal.GetDriverByName("MEM").Create("", size, size, 1, gdal.GDT_UInt16)
+        mem_ds.SetGeoTransform((TILE_ORIGIN[0], pixel_size, 0, TILE_ORIGIN[1], 0, -pixel_size))
+        mem_ds.SetProjection(utm.ExportToWkt())
+        mem_ds.GetRasterBand(1).WriteArray(synthetic_band(size, band_name))
+
+        if projection == "wgs84":
+            mem_ds = gdal.Warp("", mem_ds, format="MEM", dstSRS="EPSG:4326", resampleAlg="bilinear")
+
+        path = os.path.join(directory, "%s_%s%s" % (GRANULE_NAME, band_name, extension))
+        out_ds = gdal.GetDriverByName(driver).CreateCopy(path, mem_ds)
+        out_ds.FlushCache()
+        del out_ds
+
+        bands[band_name] = path
+
+    return bands
+
+
+
+def tile_lonlat_bounds():
+    """
+        Return the (min_lon, min_lat, max_lon, max_lat) of the synthetic tile
+    """
+    transformation = osr.CoordinateTransformation(_srs(TILE_EPSG), _srs(4326))
+    extent = TILE_SIZES[10] * 10.0
+    left, top = TILE_ORIGIN
+    right, bottom = left + extent, top - extent
+
+    def lonlat(x, y):
+        return transformation.TransformPoint(x, y)[:2]
+
+    # the largest lon/lat box inside the tile
+    min_lon = max(lonlat(left, top)[0], lonlat(left, bottom)[0])
+    max_lon = min(lonlat(right, top)[0], lonlat(right, bottom)[0])
+    min_lat = max(lonlat(left, bottom)[1], lonlat(right, bottom)[1])
+    max_lat = min(lonlat(left, top)[1], lonlat(right, top)[1])
+
+    return min_lon, min_lat, max_lon, max_lat
+
+
+
+def make_kml(path, fraction=0.05, polygons=1, seed=0):
+    """
+        Write a kml of square polygons inside the synthetic tile, each covering fraction of the tile's width
+        Return: path
+    """
+    min_lon, min_lat, max_lon, max_lat = tile_lonlat_bounds()
+    random = np.random.RandomState(seed)
+
+    width = (max_lon - min_lon) * fraction
+    height = (max_lat - min_lat) * fraction
+
+    placemarks = []
+    for idx in range(polygons):
+        if polygons == 1:
+            lon, lat = (min_lon + max_lon - width) / 2, (min_lat + max_lat - height) / 2
+        else:
+            lon = random.uniform(min_lon, max_lon - width)
+            lat = random.uniform(min_lat, max_lat - height)
+
+        ring = [(lon, lat), (lon + width, lat), (lon + width, lat + height), (lon, lat + height), (lon, lat)]
+        coordinates = " ".join("%.8f,%.8f,0" % point for point in ring)
+        placemarks.append("<Placemark><name>%d</name><Polygon><outerBoundaryIs><LinearRing><coordinates>%s</coordinates>"
+                          "</LinearRing></outerBoundaryIs></Polygon></Placemark>" % (idx, coordinates))
+
+    with open(path, "w") as kml_file:
+        kml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>%s</Document></kml>\n'
+                       % "".join(placemarks))
+
+    return path
@@ -0,0 +1,242 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Benchmarks of the library's hot paths on synthetic sentinel 2 granules
+
+    Usage:
+        python -m benchmarks.run_benchmarks --scale 0.25 --output results.json [--compare previous.json]
+
+    Every case runs in a fresh process, so its peak memory is its own. Results are written as json
+    (wall time per repeat, peak RSS and the RSS the case added on top of its setup), and comparing against the json
+    of an earlier version prints the change of each case.
+
+"""
+
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+
+from sentinel2_auto.version import __version__
+from sentinel2_auto.geoTiff import GeoTiff
+from sentinel2_auto.bands import Bands
+from sentinel2_auto.georeferencing import georeference_raster_to_ds
+from benchmarks.fixtures import make_granule, make_kml
+
+
+
+INDEX_BANDS = ("B02", "B03", "B04", "B05", "B07", "B08", "B11")
+
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux and bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _index_bands(fixture, **kwargs):
+    return Bands(dict((band, fixture["bands"][band]) for band in INDEX_BANDS), **kwargs)
+
+
+def _ndvi(fixture):
+    return _index_bands(fixture).compute_ndvi()
+
+
+def _as_mem_ds(fixture, copy):
+    # a float32 index sized raster handed to gdal, wrapped (no copy) or copied, to compare their added RSS
+    src_ds = gdal.Open(fixture["bands"]["B04"])
+    raster = np.ones((src_ds.RasterYSize, src_ds.RasterXSize), dtype=np.float32)
+    return lambda: georeference_raster_to_ds(src_ds, raster, output_type="MEM", copy=copy).ReadAsArray(0, 0, 1, 1)
+
+
+
+# each case does its setup and returns the function to time
+CASES = [
+    ("geotiff_open", lambda fixture: lambda: GeoTiff(fixture["bands"]["B04"])),
+    ("geotiff_open_lazy", lambda fixture: lambda: GeoTiff(fixture["bands"]["B04"], lazy=True)),
+    ("resize_bands", lambda fixture: _index_bands(fixture, resize=False).resize_bands),
+    ("resize_bands_stacked", lambda fixture: (lambda bands: lambda: bands.resize_bands(stacked=True))(_index_bands(fixture, resize=False))),
+    ("resample_bands", lambda fixture: (lambda bands: lambda: bands.resample_bands(20, 20))(_index_bands(fixture, resize=False))),
+    ("cut_to_kml", lambda fixture: (lambda geotiff: lambda: geotiff.cut_to_kml(fixture["kml"]))(GeoTiff(fixture["bands"]["B04"]))),
+    ("mem_ds_copy", lambda fixture: _as_mem_ds(fixture, copy=True)),
+    ("mem_ds_wrap", lambda fixture: _as_mem_ds(fixture, copy=False)),
+    ("compute_ndvi", lambda fixture: _index_bands(fixture).compute_ndvi),
+    ("compute_ndre", lambda fixture: _index_bands(fixture).compute_ndre),
+    ("compute_ndwi", lambda fixture: _index_bands(fixture).compute_ndwi),
+    ("compute_rgb", lambda fixture: _index_bands(fixture).compute_rgb),
+    ("compute_ndvi_streamed", lambda fixture: (lambda bands: lambda: bands.compute_ndvi(streamed=True))(_index_bands(fixture))),
+    ("apply_colour_scale", lambda fixture: (lambda ndvi: lambda: ndvi.apply_colour_scale(os.path.join(fixture["output_dir"], "ndvi_colour.tif")))(_ndvi(fixture))),
+    ("save_raster", lambda fixture: (lambda ndvi: lambda: ndvi.save_raster(os.path.join(fixture["output_dir"], "ndvi.tif")))(_ndvi(fixture))),
+    ("save_raster_cog", lambda fixture: (lambda ndvi: lambda: ndvi.save_raster(os.path.join(fixture["output_dir"], "ndvi_cog.tif"), output_type="COG"))(_ndvi(fixture))),
+    ("zonal_stats", lambda fixture: (lambda ndvi: lambda: ndvi.zonal_stats(fixture["zones"]))(_ndvi(fixture))),
+]
+
+
+
+def run_case(name, fixture):
+    """
+        Run one case in this process (see run_in_subprocess) with its output silenced
+        Return: dictionary of seconds, peak RSS and the RSS the timed call added
+    """
+    make_function = dict(CASES)[name]
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        function = make_function(fixture)
+        setup_rss = _peak_rss_mb()
+
+        start = time.time()
+        function()
+        seconds = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    peak_rss = _peak_rss_mb()
+    return {"seconds": seconds, "peak_rss_mb": peak_rss, "added_rss_mb": peak_rss - setup_rss}
+
+
+
+def run_in_subprocess(name, fixture):
+    """
+        Run one case in a fresh worker process so its memory use isn't hidden by earlier cases
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(run_case, (name, fixture))
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+def make_fixtures(directory, scale, projections, driver):
+    """
+        Write a synthetic granule, a kml and a set of paddock polygons for each projection
+        Return: dictionary of {projection: fixture}
+    """
+    fixtures = {}
+    for projection in projections:
+        projection_dir = os.path.join(directory, projection)
+        output_dir = os.path.join(projection_dir, "output")
+        os.makedirs(output_dir)
+
+        fixtures[projection] = {
+            "bands": make_granule(projection_dir, scale, projection, driver),
+            "kml": make_kml(os.path.join(projection_dir, "cutline.kml")),
+            "zones": make_kml(os.path.join(projection_dir, "paddocks.kml"), fraction=0.01, polygons=500),
+            "output_dir": output_dir,
+        }
+    return fixtures
+
+
+
+def run_benchmarks(scale=0.25, projections=("utm", "wgs84"), repeat=3, cases=None, driver="GTiff", work_dir=None):
+    """
+        Benchmark every case on every projection's synthetic granule
+        Return: dictionary ready to be saved as json
+    """
+    cases = cases or [name for name, _ in CASES]
+    directory = tempfile.mkdtemp(prefix="s2_benchmarks_", dir=work_dir)
+
+    try:
+        fixtures = make_fixtures(directory, scale, projections, driver)
+        results = []
+
+        for projection in projections:
+            for name in cases:
+                runs = [run_in_subprocess(name, fixtures[projection]) for _ in range(repeat)]
+                seconds = [run["seconds"] for run in runs]
+
+                result = {
+                    "case": name,
+                    "projection": projection,
+                    "seconds": seconds,
+                    "min_seconds": min(seconds),
+                    "median_seconds": float(np.median(seconds)),
+                    "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+                    "added_rss_mb": max(run["added_rss_mb"] for run in runs),
+                }
+                results.append(result)
+                print "%-24s %-6s %8.3fs %8.1f MB" % (name, projection, result["min_seconds"], result["added_rss_mb"])
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "version": __version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "gdal": gdal.__version__,
+        "numpy": np.__version__,
+        "cpu_count": multiprocessing.cpu_count(),
+        "scale": scale,
+        "driver": driver,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+
+def compare(results, previous):
+    """
+        Print how each case changed against an earlier results json
+    """
+    earlier = dict(((result["case"], result["projection"]), result) for result in previous["results"])
+
+    print "\nCompared to version %s:" % previous.get("version")
+    for result in results["results"]:
+        before = earlier.get((result["case"], result["projection"]))
+        if before is None or not before["min_seconds"]:
+            continue
+
+        print "%-24s %-6s time x%.2f   memory %+.1f MB" % (result["case"], result["projection"], result["min_seconds"] / before["min_seconds"],
+                                                        result["added_rss_mb"] - before["added_rss_mb"])
+
+
+
+def main(argv=None):
+    """
+        Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Benchmark sentinel2_auto on synthetic granules")
+    parser.add_argument("--scale", type=float, default=0.25, help="fraction of the full tile width and height (1 for real 10980 px tiles)")
+    parser.add_argument("--projections", nargs="+", default=["utm", "wgs84"], choices=["utm", "wgs84"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, each in a fresh process")
+    parser.add_argument("--cases", nargs="+", default=None, choices=[name for name, _ in CASES])
+    parser.add_argument("--driver", default="GTiff", help="gdal driver of the synthetic bands, eg. JP2OpenJPEG")
+    parser.add_argument("--work-dir", default=None, help="where to write the fixtures (default: the temp directory)")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file to write the results to")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, args.projections, args.repeat, args.cases, args.driver, args.work_dir)
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print "Saved %s" % args.output
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
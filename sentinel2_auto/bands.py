@@ -2,15 +2,27 @@
 from geoTiff import GeoTiff
 import sys, os
 import numpy as np
-from georeferencing import georeference_raster_to_ds
+from georeferencing import georeference_raster_to_ds, create_output_ds
+from streaming import stream_blocks, map_blocks
+from expressions import compile_expressions, INDEX_EXPRESSIONS
+from cutline import Cutline
+from zonal import Zones, DEFAULT_STATISTICS
+from instrumentation import instrumented, count
 from osgeo import gdal_array, gdal, ogr, osr
 
 
 class Bands(object):
 
-    def __init__(self, bands, resize = True, resize_shape=None):
+    def __init__(self, bands, resize = True, resize_shape=None, lazy=False, stacked=False, aoi=None, cache=None, threads=1, overview=None):
         """
             Enter data source upon class initialisation
+            Set lazy to True to only read band pixels when they are needed (see GeoTiff)
+            Set stacked to True to resize all the bands together in one warp (see resize_bands)
+            Set aoi to a kml path (or Cutline) to only ever read the bands' pixels under the area of interest
+            Give a RasterCache to reuse resized/cut bands and indices from earlier runs over the same files
+            threads is the number of threads indices are computed with, block by block (see compute_indices)
+            Set overview to work on a reduced resolution preview of the bands, eg. 3 for an eighth of the resolution,
+            read straight from the JP2 resolution levels (see GeoTiff)
         """
         
 
@@ -18,34 +30,148 @@ class Bands(object):
         # it stores all the GeoTiff objects for each inputted band. 
         # note that GeoTiff objects get overwritten when using the resize_bands method
         self.geotiff_objs = {}
+        self.lazy = lazy
+        self.cache = cache
+        self.threads = threads
+        self.overview = overview
 
-        self.add_bands(bands, resize, resize_shape)
+        # filled by a stacked resize: 3-D (band, row, col) array of the resized bands in their native dtype
+        self.stack_data = None
+        self.stack_bands = []
 
+        self.aoi = aoi
+        if aoi is not None and not isinstance(aoi, Cutline):
+            self.aoi = Cutline(aoi)
 
+        self.add_bands(bands, resize, resize_shape, stacked)
 
 
-    def resize_bands(self, users_shape=None):
+
+
+    def resize_bands(self, users_shape=None, stacked=False, bounds=None):
         """
             Resize all the bands. 
             If the user enters a shape size (height, width), then the bands will resize to that.
             If not, the bands will resize to the largest shape out of all of them.
             This resize method only resizes the image resolution, not the pixel resolution (TODO. easy add)
+            If stacked is True, the single band rasters are warped together in one multithreaded warp
+            (see _resize_bands_stacked)
+            bounds (min_lon, min_lat, max_lon, max_lat) pins the extent so all bands land on exactly the same grid
         """
 
-        if not users_shape:
+        if stacked:
+            resize_shape = users_shape or max([i.raster_data_shape for _, i in self.geotiff_objs.iteritems()])
+            self._resize_bands_stacked(resize_shape, bounds)
+
+        elif not users_shape:
 
             # get largest shape
             resize_shape = max([i.raster_data_shape for _, i in self.geotiff_objs.iteritems()])
 
             # iterate and resize
             for band_name, geo_ds in self.geotiff_objs.iteritems():
-                geo_ds.resize_band(resize_shape)
+                geo_ds.resize_band(resize_shape, bounds=bounds)
 
         else:
 
             # iterate and resize
             for band_name, geo_ds in self.geotiff_objs.iteritems():
-                geo_ds.resize_band(users_shape)
+                geo_ds.resize_band(users_shape, bounds=bounds)
+
+
+
+    @instrumented("warp")
+    def _resize_bands_stacked(self, shape, bounds=None):
+        """
+            Resize the single band rasters with shared warp plans.
+            The bands on each native grid (eg. the 10, 20 and 60 m bands) are stacked into one VRT and warped together
+            to the target grid with a single multithreaded gdal.Warp, so the coordinate transform is only computed once
+            per grid, and every band is resampled once from its native resolution, as resize_band does.
+            The result is kept in self.stack_data, a 3-D (band, row, col) array in the bands' native dtype,
+            in the order of self.stack_bands. Each band's GeoTiff is then updated from its slice of the stack.
+            Multi band rasters (eg. TCI) cannot be stacked and are resized on their own.
+            With a cache, the warp is skipped when every band's resized raster is already cached.
+        """
+        self.stack_bands = sorted(name for name, geotiff in self.geotiff_objs.iteritems() if geotiff.raster_count == 1)
+        stack_geotiffs = [self.geotiff_objs[name] for name in self.stack_bands]
+
+        operation = self._stacked_resize_operation(stack_geotiffs, shape, bounds)
+        cache_keys = [geotiff.cache_key(operation) for geotiff in stack_geotiffs]
+        cached = [self.cache.get(key) for key in cache_keys] if stack_geotiffs and None not in cache_keys else []
+
+        if cached and None not in cached:
+
+            self.stack_data = np.array([band_ds.ReadAsArray() for band_ds in cached])
+            for idx, geotiff in enumerate(stack_geotiffs):
+                # each band's dataset wraps its slice of the stack rather than holding a copy
+                band_ds = georeference_raster_to_ds(cached[idx], self.stack_data[idx], output_type="MEM", copy=False)
+                geotiff._update_vars(band_ds, raster_data=self.stack_data[idx])
+                geotiff.operations.append(operation)
+
+        elif stack_geotiffs:
+
+            # only bands on the same native grid are stacked: a vrt of mixed resolutions would resample the coarser
+            # bands onto the finest grid before the warp, so they'd be resampled twice instead of once
+            grids = {}
+            for idx, geotiff in enumerate(stack_geotiffs):
+                in_ds = geotiff.in_ds
+                grids.setdefault((in_ds.RasterXSize, in_ds.RasterYSize, in_ds.GetGeoTransform(), in_ds.GetProjection()), []).append(idx)
+
+            dtype = np.result_type(*[geotiff.raster_dtype for geotiff in stack_geotiffs])
+            self.stack_data = np.empty((len(stack_geotiffs), shape[0], shape[1]), dtype=dtype)
+
+            for grid in sorted(grids):
+                group = grids[grid]
+                warped_ds = self._warp_stack([stack_geotiffs[idx] for idx in group], shape, bounds)
+                self.stack_data[group] = warped_ds.ReadAsArray().reshape((len(group), shape[0], shape[1]))
+
+                # the other grids land on exactly the first one's extent
+                if bounds is None:
+                    gt = warped_ds.GetGeoTransform()
+                    bounds = (gt[0], gt[3] + gt[5] * shape[0], gt[0] + gt[1] * shape[1], gt[3])
+
+            count(pixels=self.stack_data.size, bytes_read=self.stack_data.nbytes)
+
+            for idx, geotiff in enumerate(stack_geotiffs):
+                band_ds = georeference_raster_to_ds(warped_ds, self.stack_data[idx], output_type="MEM", copy=False)
+                if cache_keys[idx]:
+                    self.cache.put(cache_keys[idx], band_ds)
+
+                geotiff._update_vars(band_ds, raster_data=self.stack_data[idx])
+                geotiff.operations.append(operation)
+
+        # iterate and resize whatever could not be stacked
+        for band_name, geo_ds in self.geotiff_objs.iteritems():
+            if band_name not in self.stack_bands:
+                geo_ds.resize_band(shape, bounds=bounds)
+
+
+
+    @staticmethod
+    def _stacked_resize_operation(geotiffs, shape, bounds=None):
+        """
+            Describe a stacked resize for the cache keys of its bands. A stacked band also depends on the rest of the
+            stack (the first grid's extent is pinned for the others), so the operation names every band in it by
+            its own cache key - a B11 resized with B08 is not the B11 resized with B12
+        """
+        stack = sorted(geotiff.cache_key() for geotiff in geotiffs)
+        return ["resize", list(shape[:2]), list(bounds) if bounds else None, "stacked", stack]
+
+
+
+    def _warp_stack(self, geotiffs, shape, bounds=None):
+        """
+            Warp single band rasters on one native grid together, as the bands of one VRT, with one multithreaded gdal.Warp
+            Return: MEM dataset with a band per raster
+        """
+        # build the vrt from file names when every band is still backed by its full resolution file
+        sources = [geotiff.in_ds.GetDescription() for geotiff in geotiffs]
+        if self.overview or not all(os.path.isfile(source) for source in sources):
+            sources = [geotiff.in_ds for geotiff in geotiffs]
+
+        vrt_ds = gdal.BuildVRT('', sources, separate=True)
+        return gdal.Warp('', vrt_ds, format='MEM', width=shape[1], height=shape[0], dstSRS='EPSG:4326', resampleAlg="cubic",
+                         outputBounds=bounds, multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS'])
 
 
 
@@ -59,18 +185,42 @@ class Bands(object):
 
 
 
+    def reproject_bands(self, projection="EPSG:4326", shape=None, pixel_size=None, bounds=None, resampling="bilinear", plan_cache=None):
+        """
+            Reproject all the bands onto one grid with reusable warp plans (see GeoTiff.reproject).
+            The target grid is worked out from the largest band (unless a shape, pixel size or bounds pin it)
+            and every other band is remapped onto exactly that grid.
+            Return: the target Grid
+        """
+        if not self.geotiff_objs:
+            return None
+
+        largest = max(self.geotiff_objs.values(), key=lambda geotiff: geotiff.raster_data_shape[:2])
+        dst_grid = largest.reproject(projection, shape, pixel_size, bounds, resampling, plan_cache)
+
+        for band_name, geo_ds in self.geotiff_objs.iteritems():
+            if geo_ds is not largest:
+                geo_ds.reproject_to(dst_grid, resampling, plan_cache)
+
+        return dst_grid
+
+
+
     def cut_bands_to_kml(self, kml_path):
         """
             Cut all the bands to a kml
+            The kml is parsed once and each band is cropped in memory (see GeoTiff.cut_to_kml)
         """
 
         if not os.path.isfile(kml_path):
             print "Kml with directory path %s does not exist!" % (kml_path)
             return
 
+        cutline = Cutline(kml_path)
+
         # iterate and cut
         for band_name, geotiff in self.geotiff_objs.iteritems():
-            self.geotiff_objs[band_name] = geotiff.cut_to_kml(kml_path)
+            self.geotiff_objs[band_name] = geotiff.cut_to_kml(cutline)
 
 
 
@@ -127,7 +277,7 @@ class Bands(object):
 
 
 
-    def add_bands(self, bands, resize, resize_shape):
+    def add_bands(self, bands, resize, resize_shape, stacked=False):
         """
             Method coordinates adding the bands for the dataset. 
             It recieves a dictionary where keys are band names and values are the band file path.
@@ -139,7 +289,10 @@ class Bands(object):
 
             Check what indexs can be computed. 
 
-            Finally resize all bands to a specified shape or to the largest band size
+            Finally resize all bands to a specified shape or to the largest band size (together in one warp if stacked)
+
+            With an area of interest (self.aoi), each band is opened lazily and only the pixel window under the aoi is read.
+            The windows are resized onto one grid covering the aoi and then masked to the aoi's polygon.
 
         """
 
@@ -147,80 +300,209 @@ class Bands(object):
 
 
             # make geotiff object and see if its been instantiated correctly or not
-            geotiff = GeoTiff(geotiff_path=band_path)
+            geotiff = GeoTiff(geotiff_path=band_path, lazy=self.lazy or self.aoi is not None, cache=self.cache, overview=self.overview)
             if not geotiff:
                 print "Band %s has failed" % band_path
                 continue
-            else:
-                print "Adding band %s" % band_path
-                self.geotiff_objs[band_name] = geotiff
+
+            if self.aoi is not None:
+                geotiff.lazy = self.lazy
+                if not geotiff.crop_to_cutline(self.aoi, apply_mask=False):
+                    print "Band %s does not overlap the area of interest" % band_path
+                    continue
+
+            print "Adding band %s" % band_path
+            self.geotiff_objs[band_name] = geotiff
 
         self._check_available_indexs()
 
+        bounds = None
+        if self.aoi is not None:
+            bounds = self.aoi.lonlat_bounds()
+
         if resize:
-            self.resize_bands(resize_shape)
+            self.resize_bands(resize_shape, stacked, bounds)
         else:
             print "Warning: bands of different shapes will result in an error"
 
+        if self.aoi is not None:
+            for band_name, geotiff in self.geotiff_objs.iteritems():
+                geotiff.mask_to_cutline(self.aoi)
+
 
 
-    def compute_ndvi(self):
+    @instrumented("compute")
+    def compute_indices(self, expressions, streamed=False, save_paths=None, dtype=None, threads=None):
         """
-            Method computes the NDVI vegetation index
-            ndvi = (nir - red)/(nir + red)
-            This method also checks that the user has inputted the correct bands for ndvi and will notify if otherwise
+            Method computes several band math indices in one pass.
+            Input: dictionary where keys are index names and values are expressions of the band names,
+            eg. {"ndvi": "(B08 - B04) / (B08 + B04)", "savi": "1.5 * (B08 - B04) / (B08 + B04 + 5000)"}
+
+            The expressions are compiled into one plan, so terms shared between indices are only
+            computed once and every band is only read and cast once.
+            If streamed is True, the indices are computed block by block in float32, following the gdal
+            block size of the first band, and written into lazy GeoTiffs (saved to save_paths[name] if given).
+            Otherwise they are computed in memory, in float32 unless a dtype is given (eg. np.float64 for full precision).
+            Pixels where an index is undefined (eg. division by zero) are NaN and masked out.
+            Either way the work is split into blocks spread over threads (defaults to self.threads), which
+            overlap gdal reads, numpy evaluation and writes.
+
+            Return: dictionary where keys are the index names and values are GeoTiff objects
         """
+        plan = compile_expressions(expressions)
 
-        if not self.ndvi_flag:
-            print "Computer says no ndvi because you have not entered the correct bands :("
+        missing_bands = [band for band in plan.bands if band not in self.geotiff_objs]
+        if missing_bands:
+            print "Computer says no %s because bands %s have not been entered :(" % (", ".join(sorted(expressions)), ", ".join(missing_bands))
             return
 
-        num = self.geotiff_objs["B07"].raster_data.astype(float) - self.geotiff_objs["B04"].raster_data.astype(float)
-        dom = self.geotiff_objs["B07"].raster_data.astype(float) + self.geotiff_objs["B04"].raster_data.astype(float)
+        shapes = [tuple(self.geotiff_objs[band].raster_data_shape[:2]) for band in plan.bands]
+        if len(set(shapes)) > 1:
+            raise ValueError("Bands %s are not the same size (%s), resize them first (see resize_bands)"
+                             % (", ".join(plan.bands), ", ".join("%dx%d" % shape for shape in shapes)))
 
-        np.seterr(divide='ignore', invalid='ignore')
-        ndvi_raster = np.true_divide(num, dom) 
+        src_ds = self.geotiff_objs[plan.bands[0]].in_ds
+        names = sorted(plan.outputs)
+        threads = threads or self.threads
+        dtype = dtype or np.float32
 
-        # create gdal ds for ndvi and then extract into GeoTiff class
-        ndvi_gdal_obj = georeference_raster_to_ds(self.geotiff_objs["B07"].in_ds, ndvi_raster, output_type="MEM")
-        self.geotiff_objs["ndvi"] = GeoTiff.geoTiff_factory(in_ds=ndvi_gdal_obj)
+        def compute_block(*blocks):
+            results = plan.evaluate(dict(zip(plan.bands, blocks)), dtype)
+            return [results[name] for name in names]
 
-        # set mask 
-        self.geotiff_objs["ndvi"].no_data_mask = dom == 0
+        if streamed:
+            save_paths = save_paths or {}
+            type_code = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype).type)
+
+            out_dss = []
+            for name in names:
+                output_type = "GTiff" if save_paths.get(name) else "MEM"
+                out_dss.append(create_output_ds(src_ds, 1, type_code, save_path=save_paths.get(name), output_type=output_type, no_data_value=np.nan))
+
+            in_bands = [self.geotiff_objs[band].in_ds.GetRasterBand(1) for band in plan.bands]
+            open_options = [self.geotiff_objs[band].open_options for band in plan.bands]
+            stream_blocks(in_bands, [out_ds.GetRasterBand(1) for out_ds in out_dss], compute_block, threads=threads, open_options=open_options)
+            count(pixels=src_ds.RasterXSize * src_ds.RasterYSize * len(names))
+
+            for name, out_ds in zip(names, out_dss):
+                out_ds.FlushCache()
+                self.geotiff_objs[name] = GeoTiff.geoTiff_factory(in_ds=out_ds, lazy=True)
+
+        else:
+
+            # reuse cached indices when every one of them is cached
+            cache_keys = dict((name, self._index_cache_key(plan, name, dtype)) for name in names)
+            cached = {}
+            if None not in cache_keys.values():
+                cached = dict((name, self.cache.get(cache_keys[name])) for name in names)
 
+            if cached and None not in cached.values():
+                for name in names:
+                    self.geotiff_objs[name] = GeoTiff.geoTiff_factory(in_ds=cached[name])
+                    self.geotiff_objs[name].no_data_mask = np.isnan(self.geotiff_objs[name].raster_data)
 
-        return self.geotiff_objs["ndvi"]
+                return dict((name, self.geotiff_objs[name]) for name in names)
 
+            # lazy rasters are read up front, gdal handles can't be shared between the threads
+            arrays = [np.asarray(self.geotiff_objs[band].raster_data) for band in plan.bands]
+            rasters = dict((name, np.empty(arrays[0].shape[:2], dtype=dtype)) for name in names)
+            map_blocks(arrays, compute_block, [rasters[name] for name in names], threads=threads)
+            count(pixels=arrays[0].shape[0] * arrays[0].shape[1] * len(names))
 
+            for name in names:
+                # create gdal ds for the index and then extract into GeoTiff class
+                index_gdal_obj = georeference_raster_to_ds(src_ds, rasters[name], output_type="MEM", copy=False)
+                self.geotiff_objs[name] = GeoTiff.geoTiff_factory(in_ds=index_gdal_obj, raster_data=rasters[name])
 
-    def compute_ndre(self):
+                if cache_keys[name]:
+                    self.cache.put(cache_keys[name], index_gdal_obj)
+
+                # set mask
+                self.geotiff_objs[name].no_data_mask = np.isnan(rasters[name])
+
+        return dict((name, self.geotiff_objs[name]) for name in names)
+
+
+
+    def zonal_stats(self, zones, names=None, statistics=DEFAULT_STATISTICS, percentiles=(), id_field=None):
+        """
+            Compute per zone statistics of several bands or indices (eg. per paddock ndvi) over the polygons of a vector file.
+            The file is parsed once, and rasterized once for all the rasters that share a grid (see GeoTiff.zonal_stats)
+            Input: path to the vector file (or Zones), names of the bands/indices (defaults to all of them),
+            names of statistics, percentiles, attribute holding the zone ids (defaults to the feature ids)
+            Return: dictionary of {name: table}
+        """
+        if not isinstance(zones, Zones):
+            zones = Zones(zones, id_field)
+
+        names = names or sorted(self.geotiff_objs)
+        return dict((name, self.geotiff_objs[name].zonal_stats(zones, statistics, percentiles)) for name in names)
+
+
+
+    def _index_cache_key(self, plan, index_name, dtype):
+        """
+            Make the cache key of an index: the identity and operations of every input band, the expression and dtype.
+            Return: the key, or None without a cache or if an input band is not backed by a file
+        """
+        geotiffs = [self.geotiff_objs[band] for band in plan.bands]
+        if self.cache is None or any(geotiff.source_identity is None for geotiff in geotiffs):
+            return None
+
+        operations = [[band, geotiff.operations] for band, geotiff in zip(plan.bands, geotiffs)]
+        operations.append(["index", plan.expressions[index_name], np.dtype(dtype).name])
+
+        return self.cache.key([geotiff.source_identity for geotiff in geotiffs], operations)
+
+
+
+    def compute_index(self, expression, index_name=None, streamed=False, save_path=None, dtype=None, threads=None):
+        """
+            Method computes a band math index, eg. compute_index("(B08 - B04) / (B08 + B04)", "ndvi").
+            See compute_indices - use it instead when computing several indices from the same bands.
+            The index is stored under index_name, which defaults to the expression itself.
+        """
+        index_name = index_name or expression
+        save_paths = {index_name: save_path} if save_path else None
+
+        indices = self.compute_indices({index_name: expression}, streamed, save_paths, dtype, threads)
+        if indices:
+            return indices[index_name]
+
+
+
+    def compute_ndvi(self, streamed=False, save_path=None):
+        """
+            Method computes the NDVI vegetation index
+            ndvi = (nir - red)/(nir + red)
+            This method also checks that the user has inputted the correct bands for ndvi and will notify if otherwise
+            Set streamed to True to compute it block by block into a lazy GeoTiff (saved to save_path if given)
+        """
+
+        if not self.ndvi_flag:
+            print "Computer says no ndvi because you have not entered the correct bands :("
+            return
+
+        return self.compute_index(INDEX_EXPRESSIONS["ndvi"], "ndvi", streamed, save_path)
+
+
+
+    def compute_ndre(self, streamed=False, save_path=None):
         """
             Method computes the NDRE vegetation index
             ndre = (nir - rededge)/(nir + rededge)
             This method also checks that the user has inputted the correct bands for ndre and will notify if otherwise
+            Set streamed to True to compute it block by block into a lazy GeoTiff (saved to save_path if given)
         """
         if not self.ndre_flag:
             print "Computer says no ndre because you have not entered the correct bands :("
             return
 
-        num = self.geotiff_objs["B07"].raster_data.astype(float) - self.geotiff_objs["B05"].raster_data.astype(float)
-        dom = self.geotiff_objs["B07"].raster_data.astype(float) + self.geotiff_objs["B05"].raster_data.astype(float)
+        return self.compute_index(INDEX_EXPRESSIONS["ndre"], "ndre", streamed, save_path)
 
-        np.seterr(divide='ignore', invalid='ignore')
-        ndre_raster = np.true_divide(num, dom)
 
-        # create gdal ds for ndre and then extract into GeoTiff class
-        ndre_gdal_obj = georeference_raster_to_ds(self.geotiff_objs["B07"].in_ds, ndre_raster, output_type="MEM")
-        self.geotiff_objs["ndre"] = GeoTiff.geoTiff_factory(in_ds=ndre_gdal_obj)
 
-        # set mask 
-        self.geotiff_objs["ndre"].no_data_mask = dom == 0
-
-        return self.geotiff_objs["ndre"]
-
-
-
-    def compute_ndwi(self):
+    def compute_ndwi(self, streamed=False, save_path=None):
         """
             Method computes the NDWI vegetation index
             ndwi = (nir - swir)/(nir + swir)
@@ -229,57 +511,42 @@ class Bands(object):
             http://ceeserver.cee.cornell.edu/wdp2/cee6150/Readings/Gao_1996_RSE_58_257-266_NDWI.pdf
 
             Use bands 8 and 11 to find changes of water in leaves
+            Set streamed to True to compute it block by block into a lazy GeoTiff (saved to save_path if given)
         """
         if not self.ndwi_flag:
             print "Computer says no ndwi because you have not entered the correct bands :("
             return
 
-
-        num = self.geotiff_objs["B08"].raster_data.astype(float) - self.geotiff_objs["B11"].raster_data.astype(float)
-        dom = self.geotiff_objs["B08"].raster_data.astype(float) + self.geotiff_objs["B11"].raster_data.astype(float)
-
-        np.seterr(divide='ignore', invalid='ignore')
-        self.ndwi_raster = np.true_divide(num, dom)
-
-        # create gdal ds for ndre and then extract into GeoTiff class
-        ndwi_gdal_obj = georeference_raster_to_ds(self.geotiff_objs["B08"].in_ds, self.ndwi_raster, output_type="MEM")
-        self.geotiff_objs["ndwi"] = GeoTiff.geoTiff_factory(in_ds=ndwi_gdal_obj)
-
-        # set mask 
-        self.geotiff_objs["ndwi"].no_data_mask = dom == 0
-
-        return self.geotiff_objs["ndwi"]
+        return self.compute_index(INDEX_EXPRESSIONS["ndwi"], "ndwi", streamed, save_path)
 
 
 
     def compute_rgb(self, save=False, save_path=None):
         """
-            Method makes an rgb image.
+            Method makes an rgb image from the blue, green and red bands (B02, B03, B04 or blue, green, red).
+            The image keeps the native dtype of the bands.
+            Pixels that are zero in all three bands are masked out.
             TODO: exposure adjustment, calculate average of 3 bands with wieghts
         """
         if not self.rgb_flag:
             print "Computer says no rgb because you have not entered the correct bands :("
             return
 
-        self.rgb_raster = np.zeros((self.geotiff_objs["B2"].raster_data_shape[0], self.geotiff_objs["B2"].raster_data_shape[1], 3))
+        if "B04" in self.geotiff_objs and "B03" in self.geotiff_objs and "B02" in self.geotiff_objs:
+            red, green, blue = "B04", "B03", "B02"
+        else:
+            red, green, blue = "red", "green", "blue"
 
-        self.rgb_raster[:,:,0] = self.geotiff_objs["B2"].raster_data 
-        self.rgb_raster[:,:, 1] = self.geotiff_objs["B3"].raster_data 
-        self.rgb_raster[:,:, 2] = self.geotiff_objs["B4"].raster_data 
+        self.rgb_raster = np.dstack([np.asarray(self.geotiff_objs[band].raster_data) for band in (red, green, blue)])
 
-        # create gdal ds for ndre and then extract into GeoTiff class
-        rgb_gdal_obj = georeference_raster_to_ds(self.geotiff_objs["B2"].in_ds, self.rgb_raster, output_type="MEM")
-        self.geotiff_objs["rgb"] = GeoTiff.geoTiff_factory(in_ds=rgb_gdal_obj)
+        # create gdal ds for rgb and then extract into GeoTiff class
+        rgb_gdal_obj = georeference_raster_to_ds(self.geotiff_objs[red].in_ds, self.rgb_raster, output_type="MEM", copy=False)
+        self.geotiff_objs["rgb"] = GeoTiff.geoTiff_factory(in_ds=rgb_gdal_obj, raster_data=self.rgb_raster)
 
         # set mask 
-        self.geotiff_objs["rgb"].no_data_mask = dom == 0
-
-        return self.geotiff_objs["rgb"]
-
-
-
-
-
-
+        self.geotiff_objs["rgb"].no_data_mask = (self.rgb_raster == 0).all(axis=2)
 
+        if save:
+            self.geotiff_objs["rgb"].save_raster(save_path)
 
+        return self.geotiff_objs["rgb"]
@@ -0,0 +1,264 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Batch generation of indices over many granules, run in parallel over a process pool
+
+    Usage:
+        python -m sentinel2_auto.batch PATH --workers 32 --gdal-cache-mb 256 [--incremental] [--metrics-jsonl spans.jsonl] [--metrics-prom s2auto.prom]
+        where PATH is a base directory with subdirectories filled with sentinel2 data
+        --incremental skips the indices whose outputs are up to date with their bands (see manifest.py)
+
+"""
+
+import os, sys
+import argparse
+import multiprocessing
+import traceback
+from collections import namedtuple
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bands import Bands
+from expressions import compile_expressions, INDEX_EXPRESSIONS
+from discovery import discover_granules, parse_band_filename
+from cache import RasterCache
+from datasets import set_block_cache_mb
+from manifest import Manifest, atomic_path
+import instrumentation
+
+
+
+DEFAULT_INDICES = ("ndwi", "ndvi")
+
+# gdal block cache given to each worker process. Keep workers * cache well under the host's memory
+DEFAULT_GDAL_CACHE_MB = 256
+
+# how the gray index geotiffs are stored: "float32", or "int16" scaled by georeferencing.INDEX_SCALE
+DEFAULT_STORAGE = "float32"
+
+# format of the saved geotiffs: "GTiff", or "COG" for tiled cloud optimised geotiffs with overviews
+DEFAULT_OUTPUT_TYPE = "GTiff"
+
+
+# outcome of processing one granule. error is None on success, otherwise the formatted traceback.
+# spans are the instrumentation spans (see instrumentation.py) the worker recorded for it, if instrumented.
+# up_to_date are the outputs an incremental run left alone
+GranuleResult = namedtuple("GranuleResult", ["granule", "outputs", "error", "elapsed", "spans", "up_to_date"])
+
+
+
+def collate_bands(path, index_path=None):
+    """
+        Collate all the bands of the granules under PATH.
+        Input: root dir, optional path of a persistent granule index (see discovery.py) to speed up rescans
+        Return: list of dictionaries where each dict has {"B01":<path>, "B02":<path>, etc}
+    """
+    return discover_granules(path, index_path)
+
+
+
+def granule_name(band_path):
+    """
+        Name a granule after its tile and sensing time, eg. "T56HLH_20190204T000241"
+        Input: path of one of its bands
+        Return: string, or None if the file is not named like a sentinel 2 band
+    """
+    granule_file = parse_band_filename(band_path)
+    if granule_file is None:
+        return None
+    return "T%s_%s" % (granule_file.tile, granule_file.sensing_time)
+
+
+
+def generate_indicies(bands, indices=DEFAULT_INDICES, cache=None, storage=DEFAULT_STORAGE, output_type=DEFAULT_OUTPUT_TYPE, incremental=False):
+    """
+        Compute the indices of one granule and save a gray and a colour geotiff of each next to the granule's bands,
+        named after the granule (eg. T56HLH_20190204T000241_ndvi_gray.tif) so granules sharing a directory don't
+        overwrite each other. Every output is written atomically and recorded in the granule's manifest with the
+        bands and parameters it was made from (see manifest.py).
+        Input: dictionary of {band name: path}, names of indices in INDEX_EXPRESSIONS, optional RasterCache,
+        storage of the gray geotiffs ("float32" or "int16"), output_type ("GTiff" or "COG"),
+        incremental (skip the indices whose outputs the manifest shows are up to date)
+        Output: list of saved file paths, list of the up to date file paths that were skipped
+    """
+    expressions = dict((index, INDEX_EXPRESSIONS[index]) for index in indices)
+    index_bands = dict((index, compile_expressions({index: expressions[index]}).bands) for index in indices)
+
+    missing_bands = sorted(set(band for index in indices for band in index_bands[index] if band not in bands))
+    if missing_bands:
+        raise ValueError("Granule is missing bands %s for %s" % (", ".join(missing_bands), ", ".join(indices)))
+
+    first_band = bands[index_bands[indices[0]][0]]
+    path = os.path.dirname(first_band)
+    granule = granule_name(first_band)
+    manifest = Manifest(path, granule)
+
+    prefix = granule + "_" if granule else ""
+    index_outputs, index_inputs, index_params = {}, {}, {}
+    for index in indices:
+        index_outputs[index] = [os.path.join(path, '%s%s_gray.tif' % (prefix, index)), os.path.join(path, '%s%s_colour.tif' % (prefix, index))]
+        index_inputs[index] = dict((band, bands[band]) for band in index_bands[index])
+        index_params[index] = {"expression": expressions[index], "storage": storage, "output_type": output_type}
+
+    # only the indices with an output missing or out of date with its bands are computed
+    todo = [index for index in indices if not incremental or manifest.outdated(index_outputs[index], index_inputs[index], index_params[index])]
+    up_to_date = [output for index in indices if index not in todo for output in index_outputs[index]]
+    if not todo:
+        return [], up_to_date
+
+    # only open the bands the indices need
+    needed_bands = compile_expressions(dict((index, expressions[index]) for index in todo)).bands
+    sentinel_bands = Bands(dict((band, bands[band]) for band in needed_bands), stacked=True, cache=cache)
+
+    computed = sentinel_bands.compute_indices(dict((index, expressions[index]) for index in todo))
+
+    outputs = []
+
+    for index in todo:
+        gray_path, colour_path = index_outputs[index]
+
+        with atomic_path(gray_path) as tmp_path:
+            computed[index].save_raster(tmp_path, storage, output_type)
+
+        with atomic_path(colour_path) as tmp_path:
+            computed[index].apply_colour_scale(tmp_path, output_type=output_type)
+
+        for output in index_outputs[index]:
+            manifest.record(output, index_inputs[index], index_params[index])
+        manifest.save()
+
+        outputs.extend(index_outputs[index])
+
+    return outputs, up_to_date
+
+
+
+def process_granule(bands, indices=DEFAULT_INDICES, gdal_cache_mb=DEFAULT_GDAL_CACHE_MB, cache=None, storage=DEFAULT_STORAGE,
+                    output_type=DEFAULT_OUTPUT_TYPE, instrument=False, incremental=False):
+    """
+        Worker entry point. Generate the indices of one granule and never raise,
+        so one bad granule cannot kill the run.
+        If instrument is True the granule's stages are recorded as spans and handed back in the result
+        If incremental is True the outputs that are up to date with their bands are skipped
+        Return: GranuleResult
+    """
+    set_block_cache_mb(gdal_cache_mb)
+    if instrument:
+        instrumentation.enable()
+
+    start = time()
+    outputs, up_to_date, error = [], [], None
+
+    try:
+        with instrumentation.span("granule", "process_granule"):
+            outputs, up_to_date = generate_indicies(bands, indices, cache, storage, output_type, incremental)
+
+    except Exception:
+        error = traceback.format_exc()
+
+    spans = instrumentation.registry().drain() if instrument else []
+    return GranuleResult(bands, outputs, error, time() - start, spans, up_to_date)
+
+
+
+def run_batch(granules, workers=None, gdal_cache_mb=DEFAULT_GDAL_CACHE_MB, indices=DEFAULT_INDICES, cache=None, storage=DEFAULT_STORAGE,
+              output_type=DEFAULT_OUTPUT_TYPE, instrument=False, incremental=False):
+    """
+        Generate indices for many granules in parallel.
+        Input: list of band dictionaries (see collate_bands), number of worker processes (defaults to the cpu count),
+        gdal block cache per worker in MB, names of indices to compute, optional RasterCache shared by the workers,
+        storage of the gray index geotiffs, format of the saved geotiffs, whether to record instrumentation spans
+        (the workers' spans are gathered into this process' registry, see instrumentation.py),
+        whether to skip the outputs that are up to date with their bands (see manifest.py)
+        Return: list of GranuleResult, in the order the granules finished
+    """
+    workers = workers or multiprocessing.cpu_count()
+    results = []
+
+    # run in process when there is a single worker - much easier to debug
+    if workers == 1:
+        for granule in granules:
+            results.append(process_granule(granule, indices, gdal_cache_mb, cache, storage, output_type, instrument, incremental))
+            instrumentation.registry().extend(results[-1].spans)
+            _report(results[-1], len(results), len(granules))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        futures = dict((executor.submit(process_granule, granule, indices, gdal_cache_mb, cache, storage, output_type, instrument, incremental), granule)
+                       for granule in granules)
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                # the worker itself died (eg. a crash inside gdal)
+                result = GranuleResult(futures[future], [], traceback.format_exc(), None, [], [])
+
+            instrumentation.registry().extend(result.spans)
+            results.append(result)
+            _report(result, len(results), len(granules))
+
+    return results
+
+
+
+def _report(result, done, total):
+    """
+        Print the progress of a batch run
+    """
+    granule_dir = os.path.dirname(sorted(result.granule.values())[0]) if result.granule else result.granule
+
+    if result.error:
+        print "[%d/%d] FAILED %s\n%s" % (done, total, granule_dir, result.error)
+    elif not result.outputs:
+        print "[%d/%d] Up to date %s" % (done, total, granule_dir)
+    else:
+        print "[%d/%d] Done %s in %.1fs" % (done, total, granule_dir, result.elapsed)
+
+
+
+def main(argv=None):
+    """
+        Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Generate indices for every granule under a directory")
+    parser.add_argument("path", nargs="?", default=os.getcwd(), help="base directory of the granule subdirectories")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: cpu count)")
+    parser.add_argument("--gdal-cache-mb", type=int, default=DEFAULT_GDAL_CACHE_MB, help="gdal block cache per worker in MB")
+    parser.add_argument("--index", default=None, help="sqlite file to keep the granule index in between runs")
+    parser.add_argument("--cache-dir", default=None, help="directory to cache derived rasters in between runs")
+    parser.add_argument("--cache-mb", type=int, default=1024, help="size cap of the raster cache in MB")
+    parser.add_argument("--indices", nargs="+", default=list(DEFAULT_INDICES), choices=sorted(INDEX_EXPRESSIONS))
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, choices=["float32", "int16"], help="how the gray index geotiffs are stored")
+    parser.add_argument("--cog", action="store_const", const="COG", default=DEFAULT_OUTPUT_TYPE, dest="output_type",
+                        help="save cloud optimised geotiffs (tiled, with overviews)")
+    parser.add_argument("--incremental", action="store_true", help="only compute the outputs that are missing or older than their bands")
+    parser.add_argument("--metrics-jsonl", default=None, help="append the instrumentation spans of every stage to this json lines file")
+    parser.add_argument("--metrics-prom", default=None, help="write per stage totals to this prometheus textfile")
+    args = parser.parse_args(argv)
+
+    collated_bands = collate_bands(args.path, args.index)
+    print "FOUND %d PATHS" % len(collated_bands)
+
+    cache = RasterCache(args.cache_dir, args.cache_mb) if args.cache_dir else None
+    instrument = bool(args.metrics_jsonl or args.metrics_prom)
+    results = run_batch(collated_bands, args.workers, args.gdal_cache_mb, args.indices, cache, args.storage, args.output_type, instrument,
+                        args.incremental)
+
+    if args.metrics_jsonl:
+        instrumentation.write_jsonl(args.metrics_jsonl)
+    if args.metrics_prom:
+        instrumentation.write_prometheus(args.metrics_prom)
+
+    failed = [result for result in results if result.error]
+    skipped = [result for result in results if not result.error and not result.outputs]
+    print "Processed %d granules, %d up to date, %d failed" % (len(results), len(skipped), len(failed))
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Content addressed on disk cache of derived rasters
+
+    A derived raster (a resized band, a cut band, an index...) is identified by the identity of its source files
+    (path, size, mtime), the chain of operations that produced it and the library version.
+    Results are stored as tiled, compressed geotiffs named by the hash of that key, and the least recently
+    used files are evicted once the cache grows past its size cap.
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from time import time
+from osgeo import gdal
+from version import __version__
+
+
+
+# temporary files older than this are left over from a failed or killed put() and are deleted by evict() and clear().
+# Younger ones may still be being written by another process sharing the cache
+STALE_TMP_SECONDS = 3600
+
+
+
+def source_identity(path):
+    """
+        Identify a source file by its absolute path, size and modification time
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+
+
+class RasterCache(object):
+    """
+        Cache of gdal datasets on disk, with LRU eviction
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        """
+            Input: directory to keep the cache in, size cap in MB
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def __repr__(self):
+        return "RasterCache_" + self.cache_dir
+
+
+    @staticmethod
+    def key(sources, operations):
+        """
+            Make the cache key of a derived raster.
+            Input: list of source identities (see source_identity), list of operations that made the raster
+            where each operation is a json serialisable list, eg. ["resize", [10980, 10980], null]
+        """
+        description = json.dumps([__version__, sources, operations], sort_keys=True)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".tif")
+
+
+    def get(self, key):
+        """
+            Look up a cached raster
+            Return: MEM gdal dataset (a copy, so it can be modified freely), or None on a miss
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+
+        cached_ds = gdal.Open(path)
+        if cached_ds is None:
+            return None
+
+        # mark as recently used
+        os.utime(path, None)
+
+        return gdal.GetDriverByName('MEM').CreateCopy('', cached_ds)
+
+
+    def put(self, key, in_ds):
+        """
+            Store a raster in the cache, then evict old entries if the cache is over its size cap.
+            The geotiff is written to a temporary file and renamed, so readers never see half written entries.
+            The temporary file is removed if the write fails
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        os.close(fd)
+
+        try:
+            out_ds = gdal.GetDriverByName('GTiff').CreateCopy(tmp_path, in_ds, options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+            out_ds.FlushCache()
+            del out_ds
+
+            os.rename(tmp_path, self._path(key))
+
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict()
+
+
+    def evict(self):
+        """
+            Delete the least recently used entries until the cache is under its size cap,
+            and the temporary files left behind by failed writes
+        """
+        self._remove_stale_tmp()
+
+        entries = []
+        total_size = 0
+
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith(".tif") or not os.path.isfile(path):
+                continue
+
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+
+    def clear(self):
+        """
+            Empty the cache
+        """
+        self._remove_stale_tmp()
+
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tif"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+    def _remove_stale_tmp(self):
+        """
+            Delete the temporary files of puts that died before cleaning up (see STALE_TMP_SECONDS)
+        """
+        stale_before = time() - STALE_TMP_SECONDS
+
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith(".tmp"):
+                continue
+
+            try:
+                if os.stat(path).st_mtime < stale_before:
+                    os.remove(path)
+            except OSError:
+                # already renamed or removed by its writer
+                pass
@@ -0,0 +1,205 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Colour mapping of single band rasters (eg. indices) through a 256 entry lookup table
+
+    A raster is stretched between two percentiles, found from a histogram rather than by sorting, and quantized
+    to uint8 palette indices in one pass. Indices 0 - 254 hold the colour scale and NO_DATA_INDEX is white
+    for no data pixels, so the same indices can be written as a paletted geotiff or expanded to RGB with one
+    lookup table indexing pass.
+
+"""
+
+import warnings
+import numpy as np
+from osgeo import gdal
+from georeferencing import georeference_raster_to_ds, create_output_ds, write_cog
+from instrumentation import instrumented, count_written
+
+
+
+# palette index of no data pixels. The colour scale uses the indices below it
+NO_DATA_INDEX = 255
+COLOUR_LEVELS = NO_DATA_INDEX
+
+# anchor colours of the colorbrewer scales, evenly spaced from low to high
+COLOUR_SCALES = {
+    "RdYlGn": ["a50026", "d73027", "f46d43", "fdae61", "fee08b", "ffffbf", "d9ef8b", "a6d96a", "66bd63", "1a9850", "006837"],
+    "Greys": ["ffffff", "f0f0f0", "d9d9d9", "bdbdbd", "969696", "737373", "525252", "252525", "000000"],
+}
+
+# number of histogram bins used to estimate percentiles
+HISTOGRAM_BINS = 4096
+
+
+
+def colour_lut(name="RdYlGn"):
+    """
+        Make the lookup table of a colour scale in COLOUR_SCALES
+        Return: (256, 3) uint8 array of RGB colours, the last entry (NO_DATA_INDEX) is white
+    """
+    anchors = np.array([[int(colour[i:i + 2], 16) for i in (0, 2, 4)] for colour in COLOUR_SCALES[name]], dtype=np.float64)
+
+    positions = np.linspace(0, 1, len(anchors))
+    levels = np.linspace(0, 1, COLOUR_LEVELS)
+
+    lut = np.empty((NO_DATA_INDEX + 1, 3), dtype=np.uint8)
+    for channel in range(3):
+        lut[:COLOUR_LEVELS, channel] = np.rint(np.interp(levels, positions, anchors[:, channel]))
+    lut[NO_DATA_INDEX] = 255
+
+    return lut
+
+
+
+def histogram_percentiles(data, percentiles, valid=None, bins=HISTOGRAM_BINS):
+    """
+        Estimate percentiles of a raster from a histogram - two passes over the data (range and histogram)
+        instead of a full sort. The estimate is within (max - min) / bins of the exact percentile.
+        Input: np array, sequence of percentiles (0 - 100), optional boolean mask of the pixels to use
+        Return: list of values, or None if there are no finite pixels
+    """
+    values = data[valid] if valid is not None else data
+
+    # integer rasters can't hold NaN, so plain min/max avoid nanmin's copy
+    if values.dtype.kind == "f":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)     # all NaN rasters are handled below
+            low, high = np.nanmin(values), np.nanmax(values)
+    else:
+        low, high = values.min(), values.max()
+
+    if not (np.isfinite(low) and np.isfinite(high)):
+        return None
+    if low == high:
+        return [float(low)] * len(percentiles)
+
+    # values outside the range (NaN, inf) fall out of the histogram
+    with np.errstate(invalid="ignore"):
+        counts, edges = np.histogram(values, bins, range=(float(low), float(high)))
+
+    return percentiles_from_histogram(counts, edges, percentiles)
+
+
+
+def percentiles_from_histogram(counts, edges, percentiles):
+    """
+        Estimate percentiles from a histogram (eg. one accumulated block by block), interpolating inside the bins
+        Return: list of values
+    """
+    bins = len(counts)
+    cumulative = np.cumsum(counts)
+
+    results = []
+    for percentile in percentiles:
+        rank = cumulative[-1] * percentile / 100.0
+        idx = min(np.searchsorted(cumulative, rank), bins - 1)
+
+        # interpolate inside the bin that holds the rank
+        below = cumulative[idx - 1] if idx else 0
+        fraction = (rank - below) / float(counts[idx]) if counts[idx] else 0.0
+        results.append(float(edges[idx] + fraction * (edges[idx + 1] - edges[idx])))
+
+    return results
+
+
+
+def quantize(data, low, high, no_data_mask=None):
+    """
+        Quantize a raster linearly from [low, high] to palette indices 0 - COLOUR_LEVELS-1, clipping outside values.
+        Pixels in no_data_mask and non finite pixels get NO_DATA_INDEX.
+        Return: uint8 np array
+    """
+    scale = (COLOUR_LEVELS - 1) / float(high - low) if high > low else 0.0
+
+    # one float32 working buffer, reused for every step
+    scaled = np.subtract(data, low, dtype=np.float32)
+    np.multiply(scaled, scale, out=scaled)
+    np.add(scaled, 0.5, out=scaled)
+    np.clip(scaled, 0, COLOUR_LEVELS - 1, out=scaled)
+
+    invalid = ~np.isfinite(scaled)
+    if no_data_mask is not None:
+        invalid |= no_data_mask
+    scaled[invalid] = NO_DATA_INDEX
+
+    return scaled.astype(np.uint8)
+
+
+
+def colour_indices(data, no_data_mask=None, low_percentile=0.4, high_percentile=99.6):
+    """
+        Stretch a raster between two percentiles and quantize it to palette indices
+        Return: uint8 np array (see quantize)
+    """
+    valid = ~no_data_mask if no_data_mask is not None else None
+    stretch = histogram_percentiles(data, (low_percentile, high_percentile), valid)
+
+    if stretch is None:
+        return np.full(data.shape, NO_DATA_INDEX, dtype=np.uint8)
+
+    return quantize(data, stretch[0], stretch[1], no_data_mask)
+
+
+
+def create_colour_ds(src_ds, lut, paletted=False, save_path=None, output_type="GTiff"):
+    """
+        Create an empty colour dataset on the grid of src_ds: one byte band with lut as its colour table
+        if paletted, otherwise 3 byte RGB bands. Ready to be written block by block (see colour_blocks)
+    """
+    if not paletted:
+        return create_output_ds(src_ds, 3, gdal.GDT_Byte, save_path, output_type)
+
+    colour_table = gdal.ColorTable()
+    for idx, colour in enumerate(lut):
+        colour_table.SetColorEntry(idx, tuple(int(channel) for channel in colour) + (255,))
+
+    out_ds = create_output_ds(src_ds, 1, gdal.GDT_Byte, save_path, output_type, no_data_value=NO_DATA_INDEX)
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetRasterColorTable(colour_table)
+    out_band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    return out_ds
+
+
+
+def colour_blocks(indices, lut, paletted=False):
+    """
+        Return: the blocks to write to the bands of a colour dataset (see create_colour_ds) for a block of palette indices
+    """
+    if paletted:
+        return [indices]
+    return [lut[indices, channel] for channel in range(3)]
+
+
+
+@instrumented("write")
+def save_colour_geotiff(src_ds, indices, save_path, lut, paletted=False, output_type="GTiff"):
+    """
+        Save palette indices on the grid of src_ds as a colour geotiff (output_type "GTiff", or "COG").
+        A paletted geotiff is one byte band with lut as its colour table (a third the size of RGB),
+        otherwise the indices are expanded to a 3 band RGB geotiff with one lookup table pass.
+        Return: the raster that was written
+    """
+    if not paletted:
+        rgb = lut[indices]
+        georeference_raster_to_ds(src_ds, rgb, save_path=save_path, output_type=output_type)
+        count_written(save_path)
+        return rgb
+
+    if output_type == "COG":
+        out_ds = create_colour_ds(src_ds, lut, paletted, output_type="MEM")
+    else:
+        out_ds = create_colour_ds(src_ds, lut, paletted, save_path, output_type)
+
+    out_ds.GetRasterBand(1).WriteArray(indices)
+
+    if output_type == "COG":
+        write_cog(out_ds, save_path)
+    else:
+        out_ds.FlushCache()
+    del out_ds
+
+    count_written(save_path)
+    return indices
@@ -0,0 +1,126 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Vectorised conversions between pixel, projected and lon/lat coordinates
+
+    Every function takes numpy arrays (or anything np.asarray accepts) of points and converts them in one call,
+    so sampling thousands of field plots costs a few array operations rather than a python loop.
+
+"""
+
+import numpy as np
+from osgeo import osr
+from cutline import _srs_from_wkt
+
+
+
+def apply_geo_transform(geo_transform, rows, cols):
+    """
+        Find the projected coordinates of pixel positions with a gdal geotransform.
+        Whole pixel positions are the pixels' top left corners, add 0.5 for their centres.
+        Return: (ys, xs) float arrays - lats and lons for a wgs84 raster, northings and eastings for utm
+    """
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+
+    xs = geo_transform[0] + cols * geo_transform[1] + rows * geo_transform[2]
+    ys = geo_transform[3] + cols * geo_transform[4] + rows * geo_transform[5]
+    return ys, xs
+
+
+
+def invert_geo_transform(geo_transform):
+    """
+        Invert a gdal geotransform, so apply_geo_transform with the result maps projected (ys, xs) back to (rows, cols)
+    """
+    x0, a, b, y0, d, e = geo_transform
+    determinant = a * e - b * d
+    if determinant == 0:
+        raise ValueError("The geotransform %s can't be inverted" % (geo_transform,))
+
+    inv_a, inv_b = e / determinant, -b / determinant
+    inv_d, inv_e = -d / determinant, a / determinant
+    return (-x0 * inv_a - y0 * inv_b, inv_a, inv_b, -x0 * inv_d - y0 * inv_e, inv_d, inv_e)
+
+
+
+def geo_to_pixel(inv_geo_transform, ys, xs):
+    """
+        Find the pixels that hold projected coordinates, given an inverted geotransform (see invert_geo_transform)
+        Return: (rows, cols) int arrays. Points off the raster get rows/cols outside it
+    """
+    rows, cols = apply_geo_transform(inv_geo_transform, ys, xs)
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+
+
+def haversine_distances(lats1, lons1, lats2, lons2):
+    """
+        Great circle distances between points on the earth (in decimal degrees), broadcasting like numpy
+        Return: distances in km
+    """
+    lats1, lons1, lats2, lons2 = [np.radians(np.asarray(values, dtype=np.float64)) for values in (lats1, lons1, lats2, lons2)]
+
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+
+    # Radius of earth in kilometers is 6371
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+
+
+class LonLatTransformer(object):
+    """
+        Converts points between wgs84 lon/lat and a projection (eg. a raster's utm zone).
+        The osr transformations are built once, then each call converts a whole array of points
+    """
+
+    def __init__(self, projection):
+        """
+            Input: projection wkt
+        """
+        self.srs = _srs_from_wkt(projection)
+        self.is_geographic = bool(self.srs.IsGeographic())
+
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        if hasattr(wgs84, "SetAxisMappingStrategy"):
+            wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        self._identity = self.is_geographic and bool(self.srs.IsSame(wgs84))
+        if not self._identity:
+            self._to_projection = osr.CoordinateTransformation(wgs84, self.srs)
+            self._to_lonlat = osr.CoordinateTransformation(self.srs, wgs84)
+
+
+    def _transform(self, transformation, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+        points = np.array(transformation.TransformPoints(np.column_stack([xs.ravel(), ys.ravel()]).tolist()), dtype=np.float64)
+        if not len(points):
+            return np.empty(xs.shape), np.empty(ys.shape)
+        return points[:, 0].reshape(xs.shape), points[:, 1].reshape(ys.shape)
+
+
+    def to_projection(self, lats, lons):
+        """
+            Return: (ys, xs) arrays of the points in the projection
+        """
+        if self._identity:
+            return np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+
+        xs, ys = self._transform(self._to_projection, lons, lats)
+        return ys, xs
+
+
+    def to_lonlat(self, ys, xs):
+        """
+            Return: (lats, lons) arrays of points in the projection
+        """
+        if self._identity:
+            return np.asarray(ys, dtype=np.float64), np.asarray(xs, dtype=np.float64)
+
+        lons, lats = self._transform(self._to_lonlat, xs, ys)
+        return lats, lons
@@ -0,0 +1,210 @@
+from osgeo import gdal, ogr, osr
+import numpy as np
+import hashlib
+import math
+
+
+
+def _srs_from_wkt(wkt):
+    """
+        Make an osr spatial reference that keeps the traditional (x = lon, y = lat) axis order on gdal 3
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+
+def geo_window(bounds, geo_transform, xsize, ysize):
+    """
+        Find the pixel window of a raster that covers a (min_x, max_x, min_y, max_y) bounding box
+        in the raster's projection. The window is snapped outwards to whole pixels and clipped to the raster.
+        Only north up rasters (no rotation) are supported.
+        Return: (xoff, yoff, xsize, ysize) or None if the bounds do not overlap the raster
+    """
+    min_x, max_x, min_y, max_y = bounds
+
+    cols = [(x - geo_transform[0]) / geo_transform[1] for x in (min_x, max_x)]
+    rows = [(y - geo_transform[3]) / geo_transform[5] for y in (min_y, max_y)]
+
+    xoff = max(0, int(math.floor(min(cols))))
+    yoff = max(0, int(math.floor(min(rows))))
+    xend = min(xsize, int(math.ceil(max(cols))))
+    yend = min(ysize, int(math.ceil(max(rows))))
+
+    if xend <= xoff or yend <= yoff:
+        return None
+
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+
+class Cutline(object):
+    """
+        The cutline geometry of a kml (or any vector file ogr can read), parsed once.
+        All the polygons of the file are unioned into one geometry, which is reprojected (and cached)
+        for each raster projection it is used with.
+        Cropping reads only the pixel window under the cutline's bounding box and masks it in memory,
+        so cutting a small paddock out of a full tile costs kilobytes of I/O.
+    """
+
+    def __init__(self, vector_path):
+        """
+            Input: path to the kml/geojson/shapefile
+        """
+        vector_ds = ogr.Open(vector_path)
+        if vector_ds is None:
+            raise ValueError("Could not read the cutline %s" % vector_path)
+
+        self.vector_path = vector_path
+        self.geometry = None
+        self.srs = None
+
+        for layer_idx in range(vector_ds.GetLayerCount()):
+            layer = vector_ds.GetLayerByIndex(layer_idx)
+
+            if self.srs is None and layer.GetSpatialRef() is not None:
+                self.srs = _srs_from_wkt(layer.GetSpatialRef().ExportToWkt())
+
+            for feature in layer:
+                geometry = feature.GetGeometryRef()
+                if geometry is None:
+                    continue
+
+                geometry = geometry.Clone()
+                geometry.FlattenTo2D()
+                self.geometry = geometry if self.geometry is None else self.geometry.Union(geometry)
+
+        if self.geometry is None:
+            raise ValueError("The cutline %s has no geometries" % vector_path)
+
+        # kmls are always in wgs84
+        if self.srs is None:
+            self.srs = osr.SpatialReference()
+            self.srs.ImportFromEPSG(4326)
+            if hasattr(self.srs, "SetAxisMappingStrategy"):
+                self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        # identifies the cutline's geometry regardless of the file it came from
+        self.hash = hashlib.sha1(self.geometry.ExportToWkb()).hexdigest()
+
+        self._projected = {}
+
+
+    def __repr__(self):
+        return "Cutline_" + str(self.vector_path)
+
+
+    def geometry_for(self, projection):
+        """
+            Return the cutline geometry in a projection (wkt), reprojecting it only the first time
+        """
+        if projection not in self._projected:
+            geometry = self.geometry.Clone()
+            dst_srs = _srs_from_wkt(projection)
+
+            if not dst_srs.IsSame(self.srs):
+                geometry.Transform(osr.CoordinateTransformation(self.srs, dst_srs))
+
+            self._projected[projection] = geometry
+
+        return self._projected[projection]
+
+
+    def bounds_for(self, projection):
+        """
+            Return the (min_x, max_x, min_y, max_y) bounding box of the cutline in a projection (wkt)
+        """
+        return self.geometry_for(projection).GetEnvelope()
+
+
+    def lonlat_bounds(self):
+        """
+            Return the bounding box of the cutline in wgs84, ordered (min_lon, min_lat, max_lon, max_lat)
+            like gdal.Warp's outputBounds
+        """
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+
+        min_x, max_x, min_y, max_y = self.bounds_for(wgs84.ExportToWkt())
+        return min_x, min_y, max_x, max_y
+
+
+    def window(self, in_ds):
+        """
+            Find the pixel window of a dataset under the cutline's bounding box
+            Return: (xoff, yoff, xsize, ysize) or None if the cutline does not overlap the dataset
+        """
+        return geo_window(self.bounds_for(in_ds.GetProjection()), in_ds.GetGeoTransform(), in_ds.RasterXSize, in_ds.RasterYSize)
+
+
+    def mask(self, xsize, ysize, geo_transform, projection):
+        """
+            Rasterize the cutline onto a grid
+            Return: boolean np array, True for pixels inside the cutline
+        """
+        mask_ds = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Byte)
+        mask_ds.SetGeoTransform(geo_transform)
+        mask_ds.SetProjection(projection)
+
+        vector_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vector_ds.CreateLayer("cutline", _srs_from_wkt(projection), ogr.wkbUnknown)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(self.geometry_for(projection))
+        layer.CreateFeature(feature)
+
+        gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+
+        return mask_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+    def apply_mask(self, in_ds, fill_value=None):
+        """
+            Set the pixels of a dataset outside the cutline to fill_value, in place.
+            fill_value defaults to the dataset's no data value, or NaN for float rasters and 0 otherwise.
+            The fill value becomes the dataset's no data value.
+            This reads the whole dataset, so only use it on small (eg. already cropped) datasets.
+            Only MEM datasets are masked: datasets of files may be shared through the dataset pool, copy them first
+        """
+        if in_ds.GetDriver().ShortName != "MEM":
+            raise ValueError("Only in memory datasets can be masked in place, %s is a %s dataset"
+                             % (in_ds.GetDescription(), in_ds.GetDriver().ShortName))
+
+        inside = self.mask(in_ds.RasterXSize, in_ds.RasterYSize, in_ds.GetGeoTransform(), in_ds.GetProjection())
+
+        for band_idx in range(1, in_ds.RasterCount + 1):
+            band = in_ds.GetRasterBand(band_idx)
+            band_fill = fill_value
+
+            if band_fill is None:
+                band_fill = band.GetNoDataValue()
+            if band_fill is None:
+                band_fill = np.nan if band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64) else 0
+
+            data = band.ReadAsArray()
+            data[~inside] = band_fill
+            band.WriteArray(data)
+            band.SetNoDataValue(band_fill)
+
+        return in_ds
+
+
+    def crop(self, in_ds, apply_mask=True):
+        """
+            Crop a dataset to the cutline in memory.
+            Only the window under the cutline's bounding box is read from the source, then
+            pixels outside the polygon are masked out (see apply_mask).
+            Return: MEM gdal dataset, or None if the cutline does not overlap the dataset
+        """
+        window = self.window(in_ds)
+        if window is None:
+            return None
+
+        cropped_ds = gdal.Translate('', in_ds, format='MEM', srcWin=list(window))
+
+        if apply_mask:
+            self.apply_mask(cropped_ds)
+
+        return cropped_ds
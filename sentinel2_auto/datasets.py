@@ -0,0 +1,181 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Process wide pool of open gdal datasets
+
+    Opening a JP2 parses its header and codestream index every time, so the same band opened by GeoTiff.__new__,
+    GeoTiff.__init__, Bands and friends should only pay for it once. The pool keeps the most recently used
+    datasets open, keyed by path and open options, and reopens a file when it has changed on disk.
+    Dataset handles must not be shared between threads - threads open their own (see streaming.py).
+
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from osgeo import gdal
+from instrumentation import span
+
+
+
+# number of datasets the pool keeps open
+DEFAULT_MAX_OPEN = 64
+
+
+
+class DatasetPool(object):
+    """
+        Bounded pool of open gdal datasets with least recently used eviction.
+        Evicting a dataset only drops the pool's reference - anything still using it keeps it open.
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __repr__(self):
+        return "DatasetPool_%d_of_%d" % (len(self._datasets), self.max_open)
+
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+    def open(self, path, open_options=None):
+        """
+            Open a raster read only, reusing the pooled dataset when the file hasn't changed since it was opened
+            Input: path, optional list of gdal open options (eg. ["OVERVIEW_LEVEL=2"])
+            Return: gdal dataset, or None if gdal can't open it
+        """
+        open_options = tuple(open_options or ())
+        key = (os.path.abspath(path), open_options)
+
+        try:
+            stat = os.stat(path)
+            identity = (stat.st_size, stat.st_mtime)
+        except OSError:
+            identity = None
+
+        with self._lock:
+            entry = self._datasets.pop(key, None)
+            if entry is not None and entry[1] == identity:
+                self._datasets[key] = entry
+                self.hits += 1
+                return entry[0]
+
+        with span("open", "open_dataset", path=path):
+            if open_options:
+                in_ds = gdal.OpenEx(path, gdal.OF_RASTER, open_options=list(open_options))
+            else:
+                in_ds = gdal.Open(path)
+
+        if in_ds is None:
+            return None
+
+        with self._lock:
+            self.misses += 1
+            self._datasets[key] = (in_ds, identity)
+            while len(self._datasets) > self.max_open:
+                self._datasets.popitem(last=False)
+
+        return in_ds
+
+
+    def resize(self, max_open):
+        """
+            Change how many datasets are kept open, evicting the oldest ones if needed
+        """
+        with self._lock:
+            self.max_open = max_open
+            while len(self._datasets) > self.max_open:
+                self._datasets.popitem(last=False)
+
+
+    def clear(self):
+        """
+            Drop every pooled dataset
+        """
+        with self._lock:
+            self._datasets.clear()
+
+
+
+# the pool shared by everything in this process
+_pool = DatasetPool()
+
+# files already reported as having no overviews
+_no_overview_paths = set()
+_no_overview_lock = threading.Lock()
+
+
+
+def open_dataset(path, open_options=None):
+    """
+        Open a raster through the process wide pool (see DatasetPool.open)
+    """
+    return _pool.open(path, open_options)
+
+
+
+def open_overview(path, overview=None):
+    """
+        Open a raster at a reduced resolution through the pool.
+        overview 1 is the first overview (half resolution), 2 the second (quarter) and so on - for a JP2 these are
+        its wavelet resolution levels, so only that much of the codestream is decoded. The level is capped at the
+        coarsest overview the file has, and files without overviews open at full resolution (reported once per file).
+        Return: gdal dataset, or None if gdal can't open it
+    """
+    full_ds = open_dataset(path)
+    if not overview or full_ds is None:
+        return full_ds
+
+    open_options = overview_open_options(full_ds, overview)
+    if open_options is None:
+        path = os.path.abspath(path)
+        with _no_overview_lock:
+            first_time = path not in _no_overview_paths
+            _no_overview_paths.add(path)
+        if first_time:
+            print "%s has no overviews, reading it at full resolution" % path
+        return full_ds
+
+    return open_dataset(path, open_options)
+
+
+
+def overview_open_options(full_ds, overview=None):
+    """
+        Return the gdal open options that read a dataset at an overview level (see open_overview),
+        or None when it is read at full resolution
+    """
+    if not overview or full_ds is None:
+        return None
+
+    overview_count = full_ds.GetRasterBand(1).GetOverviewCount()
+    if overview_count == 0:
+        return None
+
+    return ["OVERVIEW_LEVEL=%d" % (min(overview, overview_count) - 1)]
+
+
+
+def dataset_pool():
+    """
+        Return the process wide pool, eg. to resize() or clear() it
+    """
+    return _pool
+
+
+
+def set_block_cache_mb(cache_mb):
+    """
+        Size gdal's block cache, which holds the decoded blocks of every open dataset in the process.
+        Keep (number of worker processes * cache_mb) well under the host's memory
+    """
+    gdal.SetCacheMax(int(cache_mb) * 1024 * 1024)
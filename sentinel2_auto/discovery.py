@@ -0,0 +1,240 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Discovery of sentinel 2 granules in an archive of SAFE/L1C (or L2A) band files
+
+    Band files are recognised by their name alone, eg.
+        T56HLH_20190204T000241_B05.jp2          (L1C)
+        T56HLH_20190204T000241_B04_10m.jp2      (L2A)
+    and are kept in a sqlite index so that a rescan only lists the directories whose mtime has changed.
+
+"""
+
+import os
+import re
+import sqlite3
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+
+# tile ID, sensing time, band and (for L2A) resolution of a band file
+SAFE_FILENAME = re.compile(
+    r"T(?P<tile>\d{2}[A-Z]{3})_(?P<sensing_time>\d{8}T\d{6})_"
+    r"(?P<band>B0[1-9]|B1[0-2]|B8A|TCI|AOT|WVP|SCL)"
+    r"(?:_(?P<resolution>\d{2})m)?\.(?:jp2|tif|tiff)$"
+)
+
+
+GranuleFile = namedtuple("GranuleFile", ["path", "tile", "sensing_time", "band", "resolution"])
+
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS directories (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        mtime REAL
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        directory TEXT,
+        tile TEXT,
+        sensing_time TEXT,
+        band TEXT,
+        resolution INTEGER,
+        size INTEGER,
+        mtime REAL
+    );
+    CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+    CREATE INDEX IF NOT EXISTS files_granule ON files (tile, sensing_time);
+"""
+
+
+
+def parse_band_filename(path):
+    """
+        Parse a sentinel 2 band file name
+        Return: GranuleFile, or None if the file is not a sentinel 2 band
+    """
+    match = SAFE_FILENAME.search(os.path.basename(path))
+    if not match:
+        return None
+
+    resolution = match.group("resolution")
+    return GranuleFile(path, match.group("tile"), match.group("sensing_time"), match.group("band"),
+                       int(resolution) if resolution else None)
+
+
+
+class GranuleIndex(object):
+    """
+        Persistent index of the sentinel 2 band files under one or more directories.
+        refresh() only lists the directories whose mtime changed since the last refresh,
+        so rescanning a large, mostly unchanged archive costs one stat per directory.
+    """
+
+    def __init__(self, index_path=None):
+        """
+            Input: path of the sqlite index file. Without one the index only lives in memory
+        """
+        self.index_path = index_path or ":memory:"
+        self._conn = sqlite3.connect(self.index_path)
+        self._conn.executescript(_SCHEMA)
+
+
+    def close(self):
+        self._conn.close()
+
+
+    def refresh(self, root):
+        """
+            Bring the index up to date with the directory tree under root.
+            Return: number of directories that were (re)scanned
+        """
+        root = os.path.abspath(root)
+        prefix = root.rstrip(os.sep) + os.sep
+
+        known_dirs = {}
+        children = {}
+        for path, parent, mtime in self._conn.execute("SELECT path, parent, mtime FROM directories WHERE path = ? OR substr(path, 1, ?) = ?", (root, len(prefix), prefix)):
+            known_dirs[path] = mtime
+            children.setdefault(parent, []).append(path)
+
+        visited = set()
+        scanned = 0
+        stack = [root]
+
+        with self._conn:
+
+            while stack:
+                directory = stack.pop()
+
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    continue
+
+                visited.add(directory)
+
+                # an unchanged directory mtime means no entries were added, removed or renamed
+                if known_dirs.get(directory) == mtime:
+                    stack.extend(children.get(directory, []))
+                    continue
+
+                subdirs, rows = self._scan_directory(directory)
+                scanned += 1
+
+                self._conn.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, os.path.dirname(directory), mtime))
+
+                stack.extend(subdirs)
+
+            # directories that have disappeared
+            for directory in set(known_dirs) - visited:
+                self._conn.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                self._conn.execute("DELETE FROM directories WHERE path = ?", (directory,))
+
+        return scanned
+
+
+    def _scan_directory(self, directory):
+        """
+            List one directory
+            Return: list of subdirectory paths, list of file rows for the sentinel 2 band files
+        """
+        subdirs = []
+        rows = []
+
+        for entry in scandir(directory):
+
+            if entry.is_dir():
+                subdirs.append(entry.path)
+
+            elif entry.is_file():
+                band_file = parse_band_filename(entry.name)
+                if band_file:
+                    stat = entry.stat()
+                    rows.append((entry.path, directory, band_file.tile, band_file.sensing_time, band_file.band,
+                                 band_file.resolution, stat.st_size, stat.st_mtime))
+
+        return subdirs, rows
+
+
+    def files(self, root=None, tile=None, start=None, end=None):
+        """
+            Query the indexed band files, optionally under a root directory, for one tile (eg. "56HLH")
+            and in a sensing time range.
+            start and end are sensing time strings such as "20190204" or "20190204T000241" (end is inclusive)
+            Return: list of GranuleFile
+        """
+        query = "SELECT path, tile, sensing_time, band, resolution FROM files WHERE 1"
+        params = []
+
+        if root:
+            prefix = os.path.abspath(root).rstrip(os.sep) + os.sep
+            query += " AND substr(path, 1, ?) = ?"
+            params.extend([len(prefix), prefix])
+        if tile:
+            query += " AND tile = ?"
+            params.append(tile.lstrip("T"))
+        if start:
+            query += " AND sensing_time >= ?"
+            params.append(start)
+        if end:
+            query += " AND sensing_time <= ?"
+            params.append(end if "T" in end else end + "T999999")
+
+        query += " ORDER BY tile, sensing_time, band, path"
+        return [GranuleFile(*row) for row in self._conn.execute(query, params)]
+
+
+    def granules(self, root=None, tile=None, start=None, end=None):
+        """
+            Group the indexed band files into granules (see group_granules)
+            Return: list of dictionaries {"B01": <path>, "B02": <path>, etc}, one per granule, ordered by tile and time
+        """
+        return group_granules(self.files(root, tile, start, end))
+
+
+
+def group_granules(band_files):
+    """
+        Group band files into granules, keyed by tile and sensing time.
+        When a band exists at several resolutions (L2A), the finest one is kept.
+        Input: iterable of GranuleFile (their paths can be local paths or object store keys)
+        Return: list of dictionaries {"B01": <path>, "B02": <path>, etc}, one per granule, ordered by tile and time
+    """
+    granules = {}
+    resolutions = {}
+
+    for band_file in band_files:
+        key = (band_file.tile, band_file.sensing_time)
+        granule = granules.setdefault(key, {})
+        resolution = band_file.resolution or 0
+
+        if band_file.band not in granule or resolution < resolutions[key + (band_file.band,)]:
+            granule[band_file.band] = band_file.path
+            resolutions[key + (band_file.band,)] = resolution
+
+    return [granules[key] for key in sorted(granules)]
+
+
+
+def discover_granules(path, index_path=None, tile=None, start=None, end=None):
+    """
+        Find all the granules under path, refreshing the index at index_path (if given) first
+        Return: list of dictionaries {"B01": <path>, "B02": <path>, etc}, one per granule
+    """
+    index = GranuleIndex(index_path)
+    try:
+        index.refresh(path)
+        return index.granules(path, tile, start, end)
+    finally:
+        index.close()
@@ -0,0 +1,240 @@
+"""
+    Band math expressions.
+
+    Expressions such as "(B08 - B04) / (B08 + B04)" are parsed once into an ExpressionPlan - a flat list of
+    numpy operations over the bands. When several expressions are compiled together, shared terms
+    (eg. B08 + B04 in NDVI and SAVI) are only computed once and every band is only cast once, so many
+    indices can be evaluated in one pass over the input blocks.
+"""
+
+import ast
+import numpy as np
+
+
+
+# expressions for the indices this repo knows about.
+# Sentinel 2 L1C digital numbers are reflectance * 10000, so the constants of evi and savi are scaled to match
+INDEX_EXPRESSIONS = {
+    "ndvi": "(B07 - B04) / (B07 + B04)",
+    "ndre": "(B07 - B05) / (B07 + B05)",
+    "ndwi": "(B08 - B11) / (B08 + B11)",
+    "evi": "2.5 * (B08 - B04) / (B08 + 6 * B04 - 7.5 * B02 + 10000)",
+    "savi": "1.5 * (B08 - B04) / (B08 + B04 + 5000)",
+}
+
+
+_BINARY_OPS = {
+    ast.Add: "add",
+    ast.Sub: "subtract",
+    ast.Mult: "multiply",
+    ast.Div: "true_divide",
+    ast.Pow: "power",
+}
+
+_UNARY_OPS = {
+    ast.USub: "negative",
+    ast.UAdd: None,
+}
+
+_FUNCTIONS = {
+    "sqrt": "sqrt",
+    "abs": "absolute",
+    "log": "log",
+    "exp": "exp",
+    "min": "minimum",
+    "max": "maximum",
+}
+
+# operations where the operand order does not matter, so a + b and b + a share a node
+_COMMUTATIVE = set(["add", "multiply", "minimum", "maximum"])
+
+
+# compiled plans, keyed by the expressions they were compiled from
+_plan_cache = {}
+
+
+
+class ExpressionPlan(object):
+    """
+        A set of band math expressions compiled into one list of numpy operations.
+        Each node of the plan is ("band", name), ("const", value) or (numpy ufunc name, operand node ids).
+        Identical nodes are only stored once, which eliminates common subexpressions across all the expressions.
+    """
+
+    def __init__(self, expressions):
+        """
+            Input: dictionary where keys are output names and values are expression strings
+        """
+        self.expressions = dict(expressions)
+        self.nodes = []
+        self._node_ids = {}
+        self.outputs = {}
+
+        for name in sorted(self.expressions):
+            tree = ast.parse(self.expressions[name].strip(), mode="eval")
+            self.outputs[name] = self._add_ast(tree.body, self.expressions[name])
+
+        self.bands = sorted(node[1] for node in self.nodes if node[0] == "band")
+        self._last_use = self._find_last_use()
+
+
+    def __repr__(self):
+        return "ExpressionPlan(%s)" % ", ".join(sorted(self.outputs))
+
+
+    def _add_node(self, node):
+        """
+            Add a node to the plan, or return the id of an identical existing node
+        """
+        if node[0] in _COMMUTATIVE:
+            node = (node[0], tuple(sorted(node[1])))
+
+        if node not in self._node_ids:
+            self._node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+
+        return self._node_ids[node]
+
+
+    def _add_op(self, op, operands):
+        """
+            Add an operation node, folding it into a constant when all operands are constants
+        """
+        if all(self.nodes[operand][0] == "const" for operand in operands):
+            value = getattr(np, op)(*[self.nodes[operand][1] for operand in operands])
+            return self._add_node(("const", float(value)))
+
+        return self._add_node((op, tuple(operands)))
+
+
+    def _add_ast(self, node, expression):
+        """
+            Recursively add a parsed python expression to the plan
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            operands = [self._add_ast(node.left, expression), self._add_ast(node.right, expression)]
+            return self._add_op(_BINARY_OPS[type(node.op)], operands)
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            operand = self._add_ast(node.operand, expression)
+            if _UNARY_OPS[type(node.op)] is None:
+                return operand
+            return self._add_op(_UNARY_OPS[type(node.op)], [operand])
+
+        if isinstance(node, ast.Num):
+            return self._add_node(("const", float(node.n)))
+
+        if isinstance(node, ast.Name):
+            return self._add_node(("band", node.id))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS and not node.keywords:
+            operands = [self._add_ast(arg, expression) for arg in node.args]
+            return self._add_op(_FUNCTIONS[node.func.id], operands)
+
+        raise ValueError("Unsupported syntax in band math expression: %s" % expression)
+
+
+    def _find_last_use(self):
+        """
+            Find the id of the last node that uses each node, so buffers can be reused once they are dead
+        """
+        last_use = {}
+        for node_id, node in enumerate(self.nodes):
+            if node[0] not in ("band", "const"):
+                for operand in node[1]:
+                    last_use[operand] = node_id
+
+        return last_use
+
+
+    def describe(self):
+        """
+            Return the plan as a list of readable steps
+        """
+        steps = []
+        for node_id, node in enumerate(self.nodes):
+            if node[0] in ("band", "const"):
+                steps.append("%d: %s %s" % (node_id, node[0], node[1]))
+            else:
+                steps.append("%d: %s(%s)" % (node_id, node[0], ", ".join(str(operand) for operand in node[1])))
+
+        for name in sorted(self.outputs):
+            steps.append("%s = %d" % (name, self.outputs[name]))
+
+        return steps
+
+
+    def evaluate(self, blocks, dtype=np.float32):
+        """
+            Evaluate every expression of the plan over a set of band blocks (or full rasters).
+            Each band is cast to dtype once. Temporaries are written into the buffers of
+            temporaries that are no longer needed, so peak memory stays at a few blocks.
+            Pixels where an expression is not finite (eg. division by zero) are set to NaN.
+            Input: dictionary where keys are band names and values are numpy arrays of the same shape
+            Return: dictionary where keys are the output names and values are the computed arrays
+        """
+        dtype = np.dtype(dtype)
+        output_ids = set(self.outputs.values())
+        values = [None] * len(self.nodes)
+
+        # a buffer is owned if the plan allocated it, so it is safe to overwrite
+        owned = [False] * len(self.nodes)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+            for node_id, node in enumerate(self.nodes):
+
+                if node[0] == "band":
+                    block = blocks[node[1]]
+                    values[node_id] = block.astype(dtype, copy=False)
+                    owned[node_id] = values[node_id] is not block
+
+                elif node[0] == "const":
+                    values[node_id] = dtype.type(node[1])
+
+                else:
+                    operands = [values[operand] for operand in node[1]]
+
+                    # reuse the buffer of an operand that dies here
+                    out = None
+                    for operand in node[1]:
+                        if owned[operand] and self._last_use.get(operand) == node_id and operand not in output_ids:
+                            out = values[operand]
+                            owned[operand] = False
+                            break
+
+                    if out is not None:
+                        values[node_id] = getattr(np, node[0])(*operands, out=out)
+                        owned[node_id] = True
+                    else:
+                        values[node_id] = getattr(np, node[0])(*operands)
+                        owned[node_id] = isinstance(values[node_id], np.ndarray)
+
+                    # drop references to operands that are no longer needed
+                    for operand in node[1]:
+                        if self._last_use.get(operand) == node_id and operand not in output_ids:
+                            values[operand] = None
+
+        results = {}
+        for name, node_id in self.outputs.items():
+            result = values[node_id]
+            if not owned[node_id] or list(self.outputs.values()).count(node_id) > 1:
+                result = np.array(result, dtype=dtype)
+            result[~np.isfinite(result)] = np.nan
+            results[name] = result
+
+        return results
+
+
+
+def compile_expressions(expressions):
+    """
+        Compile a dictionary of {output name: expression} into an ExpressionPlan.
+        Plans are cached so each set of expressions is only parsed once per process
+    """
+    key = tuple(sorted(expressions.items()))
+
+    if key not in _plan_cache:
+        _plan_cache[key] = ExpressionPlan(expressions)
+
+    return _plan_cache[key]
@@ -0,0 +1,544 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Fetching granules from an object store while earlier granules are processed
+
+    Usage:
+        python -m sentinel2_auto.fetch 56HLH DOWNLOAD_DIR --start 20190101 --end 20190131 --fetch-workers 16 --workers 8
+        python -m sentinel2_auto.fetch 56HLH DOWNLOAD_DIR --store /mnt/bucket    (a mounted bucket or local mirror)
+
+    Rather than downloading tiles by hand before a run, the band objects of each granule are fetched from the
+    GCP public sentinel 2 bucket (or any GCS compatible store) by a bounded pool of fetch threads sharing a pool
+    of keep-alive connections, and only the bands the indices use are fetched. As soon as a granule's last band
+    lands it is handed to the process pool (see batch.process_granule) while later downloads carry on, so a run
+    takes about as long as the slower of downloading and computing rather than both.
+    LocalObjectServer serves a directory over the same http api, as a stand-in for the bucket in tests.
+
+"""
+
+import os, sys
+import json
+import socket
+import argparse
+import httplib
+import multiprocessing
+import threading
+import traceback
+import Queue
+from time import time
+from urllib import quote, unquote
+from urlparse import urlsplit, urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from discovery import parse_band_filename, group_granules
+from expressions import compile_expressions, INDEX_EXPRESSIONS
+from manifest import atomic_path
+from batch import process_granule, GranuleResult, _report, DEFAULT_INDICES, DEFAULT_GDAL_CACHE_MB, DEFAULT_STORAGE, DEFAULT_OUTPUT_TYPE
+import instrumentation
+
+
+
+GCS_URL = "https://storage.googleapis.com"
+
+SENTINEL2_BUCKET = "gcp-public-data-sentinel-2"
+
+# concurrent object downloads (and pooled connections)
+DEFAULT_FETCH_WORKERS = 8
+
+# objects are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 1 << 20
+
+# attempts at an object before giving up. A dropped download resumes with a range request
+FETCH_RETRIES = 3
+
+# objects per page of a listing
+LIST_PAGE_SIZE = 1000
+
+
+
+def tile_prefix(tile):
+    """
+        Return the bucket prefix of a tile's granules, eg. "56HLH" -> "tiles/56/H/LH/"
+    """
+    tile = tile.lstrip("T")
+    return "tiles/%s/%s/%s/" % (tile[:2], tile[2], tile[3:])
+
+
+
+class FileObjectStore(object):
+    """
+        Objects are the files under a directory: a mounted bucket, a local mirror or a test fixture
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+
+    def __repr__(self):
+        return "FileObjectStore_%s" % self.root
+
+
+    def list(self, prefix=""):
+        """
+            Return: list of (key, size) of the objects whose key starts with prefix
+        """
+        objects = []
+        for directory, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    objects.append((key, os.path.getsize(path)))
+
+        return sorted(objects)
+
+
+    def fetch(self, key, save_path):
+        """
+            Copy an object to save_path (written to a temporary file and renamed)
+            Return: number of bytes copied
+        """
+        copied = 0
+        with open(os.path.join(self.root, *key.split("/")), "rb") as object_file:
+            with atomic_path(save_path) as tmp_path:
+                with open(tmp_path, "wb") as out_file:
+                    for chunk in iter(lambda: object_file.read(CHUNK_SIZE), ""):
+                        out_file.write(chunk)
+                        copied += len(chunk)
+
+        return copied
+
+
+
+class HttpObjectStore(object):
+    """
+        Objects in a bucket of a GCS compatible http store: listed through the json api
+        (/storage/v1/b/<bucket>/o) and downloaded from /<bucket>/<key>.
+        Connections are kept alive and shared between threads through a pool, so fetching many objects
+        doesn't pay a TCP and TLS handshake for each.
+    """
+
+    def __init__(self, url=GCS_URL, bucket=SENTINEL2_BUCKET, pool_size=DEFAULT_FETCH_WORKERS, timeout=60):
+        parts = urlsplit(url)
+        self.url = url
+        self.bucket = bucket
+        self.timeout = timeout
+        self._secure = parts.scheme == "https"
+        self._host = parts.netloc
+        self._base_path = parts.path.rstrip("/")
+        self._connections = Queue.LifoQueue(maxsize=pool_size)
+
+
+    def __repr__(self):
+        return "HttpObjectStore_%s/%s" % (self.url, self.bucket)
+
+
+    def _connection(self):
+        try:
+            return self._connections.get_nowait()
+        except Queue.Empty:
+            connection_class = httplib.HTTPSConnection if self._secure else httplib.HTTPConnection
+            return connection_class(self._host, timeout=self.timeout)
+
+
+    def _release(self, connection):
+        try:
+            self._connections.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+
+    def close(self):
+        """
+            Close the pooled connections
+        """
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+    def _get(self, path, headers=None):
+        """
+            Send a GET on a pooled connection.
+            Return: the connection and its response (release the connection once the body is read)
+        """
+        connection = self._connection()
+        try:
+            connection.request("GET", self._base_path + path, headers=headers or {})
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+
+
+    def list(self, prefix=""):
+        """
+            Return: list of (key, size) of the objects whose key starts with prefix
+        """
+        objects = []
+        page_token = None
+
+        while True:
+            path = "/storage/v1/b/%s/o?prefix=%s&maxResults=%d" % (quote(self.bucket), quote(prefix, safe=""), LIST_PAGE_SIZE)
+            if page_token:
+                path += "&pageToken=%s" % quote(page_token, safe="")
+
+            connection, response = self._get(path)
+            body = response.read()
+            self._release(connection)
+
+            if response.status != 200:
+                raise IOError("Listing %s in %s failed with HTTP %d" % (prefix, self, response.status))
+
+            page = json.loads(body)
+            objects.extend((item["name"], int(item["size"])) for item in page.get("items", []))
+
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return sorted(objects)
+
+
+    def fetch(self, key, save_path):
+        """
+            Stream an object to save_path (written to a temporary file and renamed).
+            A download that drops part way is resumed with a range request for the rest.
+            Return: number of bytes downloaded
+        """
+        path = "/%s/%s" % (quote(self.bucket), quote(key))
+        fetched = 0
+        attempts = 0
+
+        with atomic_path(save_path) as tmp_path:
+            with open(tmp_path, "wb") as out_file:
+                while True:
+                    headers = {"Range": "bytes=%d-" % fetched} if fetched else {}
+                    try:
+                        connection, response = self._get(path, headers)
+                    except (httplib.HTTPException, socket.error):
+                        # eg. a pooled connection the server has since closed
+                        attempts += 1
+                        if attempts >= FETCH_RETRIES:
+                            raise
+                        continue
+
+                    if response.status not in (200, 206) or (fetched and response.status != 206):
+                        response.read()
+                        self._release(connection)
+                        raise IOError("Fetching %s from %s failed with HTTP %d" % (key, self, response.status))
+
+                    try:
+                        for chunk in iter(lambda: response.read(CHUNK_SIZE), ""):
+                            out_file.write(chunk)
+                            fetched += len(chunk)
+
+                        # httplib ends a body cut short quietly, with bytes still to come
+                        if response.length:
+                            raise httplib.IncompleteRead("", response.length)
+
+                    except (httplib.HTTPException, socket.error):
+                        connection.close()
+                        attempts += 1
+                        if attempts >= FETCH_RETRIES:
+                            raise
+                        continue
+
+                    self._release(connection)
+                    return fetched
+
+
+
+def object_store(location, bucket=SENTINEL2_BUCKET, pool_size=DEFAULT_FETCH_WORKERS):
+    """
+        Return an HttpObjectStore for an http(s) url, otherwise a FileObjectStore of a directory
+    """
+    if location.startswith(("http://", "https://")):
+        return HttpObjectStore(location, bucket, pool_size)
+    return FileObjectStore(location)
+
+
+
+def remote_granules(store, tile, start=None, end=None, prefix=None):
+    """
+        List the granules of a tile in an object store.
+        start and end are sensing time strings such as "20190204" (end is inclusive)
+        Return: list of dictionaries {"B01": <key>, "B02": <key>, etc}, one per granule, ordered by time
+    """
+    band_files = []
+    for key, _ in store.list(prefix if prefix is not None else tile_prefix(tile)):
+        band_file = parse_band_filename(key)
+        if band_file is None or band_file.tile != tile.lstrip("T"):
+            continue
+        if start and band_file.sensing_time < start:
+            continue
+        if end and band_file.sensing_time > (end if "T" in end else end + "T999999"):
+            continue
+
+        band_files.append(band_file._replace(path=key))
+
+    return group_granules(band_files)
+
+
+
+def _fetch_band(store, key, save_path):
+    """
+        Fetch one band object, unless a previous run already did
+    """
+    if os.path.isfile(save_path):
+        return save_path
+
+    save_dir = os.path.dirname(save_path)
+    try:
+        os.makedirs(save_dir)
+    except OSError:
+        if not os.path.isdir(save_dir):
+            raise
+
+    with instrumentation.span("fetch", "fetch_object", key=key) as fetch_span:
+        fetch_span.add(bytes_read=store.fetch(key, save_path))
+
+    return save_path
+
+
+
+def fetch_and_process(granules, store, download_dir, indices=DEFAULT_INDICES, fetch_workers=DEFAULT_FETCH_WORKERS, workers=None,
+                      gdal_cache_mb=DEFAULT_GDAL_CACHE_MB, cache=None, storage=DEFAULT_STORAGE, output_type=DEFAULT_OUTPUT_TYPE,
+                      instrument=False, incremental=False):
+    """
+        Fetch granules from an object store and generate their indices, overlapping the two:
+        the bands are downloaded by fetch_workers threads, in granule order, and each granule is submitted to
+        the process pool as soon as its bands are on disk.
+        Input: list of {band name: key} dictionaries (see remote_granules), object store, directory to download to
+        (keys keep their layout under it), names of indices, number of concurrent downloads, number of worker
+        processes (1 computes in this process, while the downloads carry on), then as batch.run_batch
+        Return: list of GranuleResult, in the order the granules finished
+    """
+    workers = workers or 1
+    needed_bands = compile_expressions(dict((index, INDEX_EXPRESSIONS[index]) for index in indices)).bands
+    results = []
+
+    def finish(result):
+        instrumentation.registry().extend(result.spans)
+        results.append(result)
+        _report(result, len(results), len(granules))
+
+    def process(local_bands):
+        if process_executor is None:
+            finish(process_granule(local_bands, indices, gdal_cache_mb, cache, storage, output_type, instrument, incremental))
+        else:
+            processes[process_executor.submit(process_granule, local_bands, indices, gdal_cache_mb, cache, storage, output_type,
+                                              instrument, incremental)] = local_bands
+
+    process_executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    processes = {}
+    try:
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor:
+
+            # only the bands the indices need are fetched, granule by granule
+            fetches, granule_bands, remaining, errors = {}, [], [], []
+            for granule_idx, granule in enumerate(granules):
+                local_bands = dict((band, os.path.join(download_dir, *granule[band].split("/"))) for band in needed_bands if band in granule)
+                granule_bands.append(local_bands)
+                remaining.append(len(local_bands))
+                errors.append(None)
+
+                for band, save_path in local_bands.items():
+                    fetches[fetch_executor.submit(_fetch_band, store, granule[band], save_path)] = granule_idx
+
+                if not local_bands:
+                    # nothing to fetch: processing reports the missing bands
+                    process(local_bands)
+
+            while fetches or processes:
+                done, _ = wait(list(fetches) + list(processes), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future in processes:
+                        local_bands = processes.pop(future)
+                        try:
+                            finish(future.result())
+                        except Exception:
+                            # the worker itself died (eg. a crash inside gdal)
+                            finish(GranuleResult(local_bands, [], traceback.format_exc(), None, [], []))
+                        continue
+
+                    granule_idx = fetches.pop(future)
+                    remaining[granule_idx] -= 1
+                    if future.exception() is not None and errors[granule_idx] is None:
+                        errors[granule_idx] = "Fetching %s failed: %r" % (granules[granule_idx], future.exception())
+
+                    # the granule's last band is in: hand it to the workers while the other downloads carry on
+                    if remaining[granule_idx] == 0:
+                        if errors[granule_idx]:
+                            finish(GranuleResult(granule_bands[granule_idx], [], errors[granule_idx], None, [], []))
+                        else:
+                            process(granule_bands[granule_idx])
+
+    finally:
+        if process_executor:
+            process_executor.shutdown()
+
+    return results
+
+
+
+class _ObjectRequestHandler(BaseHTTPRequestHandler):
+    """
+        Serve a directory like a GCS bucket: json listings and objects, with range requests
+    """
+
+    protocol_version = "HTTP/1.1"
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        list_path = "/storage/v1/b/%s/o" % self.server.bucket
+        object_prefix = "/%s/" % self.server.bucket
+
+        if url.path == list_path:
+            self._list(parse_qs(url.query))
+        elif url.path.startswith(object_prefix):
+            self._object(url.path[len(object_prefix):])
+        else:
+            self._send(404, "application/json", json.dumps({"error": "not found"}))
+
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _list(self, query):
+        prefix = query.get("prefix", [""])[0]
+        page_size = int(query.get("maxResults", [LIST_PAGE_SIZE])[0])
+        offset = int(query.get("pageToken", ["0"])[0])
+
+        objects = self.server.store.list(prefix)
+        page = {"items": [{"name": key, "size": str(size)} for key, size in objects[offset:offset + page_size]]}
+        if offset + page_size < len(objects):
+            page["nextPageToken"] = str(offset + page_size)
+
+        self._send(200, "application/json", json.dumps(page))
+
+
+    def _object(self, key):
+        path = os.path.join(self.server.store.root, *unquote(key).split("/"))
+        if not os.path.isfile(path):
+            self._send(404, "application/json", json.dumps({"error": "no such object"}))
+            return
+
+        with open(path, "rb") as object_file:
+            body = object_file.read()
+
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start, _, end = range_header[len("bytes="):].partition("-")
+            start, end = int(start), int(end) if end else len(body) - 1
+            self._send(206, "application/octet-stream", body[start:end + 1],
+                       {"Content-Range": "bytes %d-%d/%d" % (start, end, len(body))})
+        else:
+            self._send(200, "application/octet-stream", body)
+
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class LocalObjectServer(object):
+    """
+        Serve a directory over http as a bucket of a GCS compatible store, as a stand-in for the
+        sentinel 2 bucket when testing. Use as a context manager, with an HttpObjectStore on its url:
+
+            with LocalObjectServer("fixtures") as server:
+                store = HttpObjectStore(server.url, server.bucket)
+    """
+
+    def __init__(self, root, bucket=SENTINEL2_BUCKET, port=0):
+        self.bucket = bucket
+        self._server = _ThreadingHTTPServer(("127.0.0.1", port), _ObjectRequestHandler)
+        self._server.store = FileObjectStore(root)
+        self._server.bucket = bucket
+        self._thread = None
+
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+
+def main(argv=None):
+    """
+        Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Fetch the granules of a tile and generate their indices as they arrive")
+    parser.add_argument("tile", help="tile ID, eg. 56HLH")
+    parser.add_argument("download_dir", help="directory the band objects are downloaded to")
+    parser.add_argument("--store", default=GCS_URL, help="url of a GCS compatible store, or a directory (default: %(default)s)")
+    parser.add_argument("--bucket", default=SENTINEL2_BUCKET)
+    parser.add_argument("--start", default=None, help="first sensing date, eg. 20190101")
+    parser.add_argument("--end", default=None, help="last sensing date (inclusive)")
+    parser.add_argument("--fetch-workers", type=int, default=DEFAULT_FETCH_WORKERS, help="concurrent downloads")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: cpu count)")
+    parser.add_argument("--gdal-cache-mb", type=int, default=DEFAULT_GDAL_CACHE_MB, help="gdal block cache per worker in MB")
+    parser.add_argument("--indices", nargs="+", default=list(DEFAULT_INDICES), choices=sorted(INDEX_EXPRESSIONS))
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, choices=["float32", "int16"], help="how the gray index geotiffs are stored")
+    parser.add_argument("--cog", action="store_const", const="COG", default=DEFAULT_OUTPUT_TYPE, dest="output_type",
+                        help="save cloud optimised geotiffs (tiled, with overviews)")
+    parser.add_argument("--incremental", action="store_true", help="only compute the outputs that are missing or older than their bands")
+    args = parser.parse_args(argv)
+
+    store = object_store(args.store, args.bucket, args.fetch_workers)
+    granules = remote_granules(store, args.tile, args.start, args.end)
+    print "FOUND %d GRANULES" % len(granules)
+
+    start = time()
+    workers = args.workers or multiprocessing.cpu_count()
+    results = fetch_and_process(granules, store, args.download_dir, args.indices, args.fetch_workers, workers, args.gdal_cache_mb,
+                                storage=args.storage, output_type=args.output_type, incremental=args.incremental)
+
+    failed = [result for result in results if result.error]
+    print "Processed %d granules in %.1fs, %d failed" % (len(results), time() - start, len(failed))
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,11 +3,19 @@ from osgeo import gdal, ogr, osr
 import utm
 import numpy as np
 import math
+from collections import OrderedDict
 import helpers
-from georeferencing import georeference_raster_to_ds
-import matplotlib as mpl
-mpl.use('TkAgg') 
-import matplotlib.cm as cm
+from instrumentation import instrumented, span, count, count_written
+from georeferencing import georeference_raster_to_ds, save_index, write_cog, wrap_array_as_ds
+from raster import LazyRaster, gdal_to_numpy_dtype, memmap_raster
+from cutline import Cutline
+from cache import source_identity
+from datasets import open_dataset, open_overview, overview_open_options
+from colour import colour_indices, colour_lut, save_colour_geotiff
+from zonal import Zones, zonal_statistics, DEFAULT_STATISTICS
+from coordinates import apply_geo_transform, invert_geo_transform, geo_to_pixel, haversine_distances, LonLatTransformer
+from discovery import parse_band_filename
+from reprojection import Grid, target_grid, default_plan_cache
 
 
 
@@ -16,15 +24,32 @@ class GeoTiff(object):
     """
         Class for managing all geotiffs and gdal.Open data sets
     """
-    def __init__(self, geotiff_path=None, in_ds=None):
+    def __init__(self, geotiff_path=None, in_ds=None, lazy=False, cache=None, raster_data=None, overview=None):
         """
             Class recieves a path to a geotiff or a Gdal Open object in memory.
             Gdal variables will be extracted accordingly
+            If lazy is True, raster_data is a LazyRaster proxy and pixels are only read when they are asked for
+            If a RasterCache is given, resizing, resampling, reprojecting and cutting go through it (see cache.py)
+            If raster_data is given it is used as is instead of being read from in_ds - pass the array
+            an in memory dataset wraps (see georeferencing.wrap_array_as_ds) to avoid holding two copies
+            If overview is given (1 for half resolution, 2 for a quarter, 3 for an eighth...) the file is read from its
+            JP2 resolution levels or geotiff overviews, so only that much of it is decoded (see datasets.open_overview)
         """
         self.img_name = None
+        self.lazy = lazy
+        self.overview = overview
 
+        # where the raster came from and what has been done to it since - used as the cache key
+        self.cache = cache
+        self.source_identity = source_identity(geotiff_path) if geotiff_path else None
+        self.operations = [["overview", overview]] if overview else []
+
+        # opened through the shared pool, so this reuses the dataset __new__ opened.
+        # open_options are what in_ds was opened with, for reopening it (eg. once per thread, see streaming.py)
+        self.open_options = None
         if geotiff_path:
-            in_ds = gdal.Open(geotiff_path)
+            in_ds = open_overview(geotiff_path, overview)
+            self.open_options = overview_open_options(open_dataset(geotiff_path), overview)
 
         # figure out if its wgs84 or utm projected and assign variables accordingly
         proj = in_ds.GetProjection()
@@ -36,16 +61,18 @@ class GeoTiff(object):
         # extract information 
         self.in_ds = in_ds
         self.projection = self.in_ds.GetProjection()
-        self.raster_dtype = self.in_ds.GetRasterBand(1).ReadAsArray().dtype
+        self.raster_dtype = gdal_to_numpy_dtype(self.in_ds.GetRasterBand(1).DataType)
         self.raster_count = self.in_ds.RasterCount
-        self.raster_data = self._extract_raster_data(self.in_ds)
+        self.raster_data = raster_data if raster_data is not None else self._extract_raster_data(self.in_ds)
+        self._ds_buffer = raster_data   # keeps the memory of a wrapping dataset alive while raster_data is reassigned
         self.raster_data_shape = self.raster_data.shape
         self.geo_transform = self.in_ds.GetGeoTransform()
         self.pixel_width = self.geo_transform[1]    # the units for this will depend on the projection
         self.pixel_height = abs(self.geo_transform[5])
 
+        # the no data mask of a lazy raster is made when it is materialised
         self.no_data_value = self._get_no_data_val()
-        if self.no_data_value:
+        if self.no_data_value and not self.lazy:
             self.no_data_mask = self._set_no_data_mask()
         else:
             self.no_data_mask = None
@@ -80,13 +107,18 @@ class GeoTiff(object):
 
 
 
-    def _update_vars(self, in_ds):
+    def _update_vars(self, in_ds, raster_data=None):
         """
             Method to refresh class variables after resampling/reprojecting.
+            raster_data, if given, is the array backing in_ds and is used instead of reading in_ds again
         """
         self.in_ds = in_ds
+        self.open_options = None
         self.projection = self.in_ds.GetProjection()
-        self.raster_data = self._extract_raster_data(self.in_ds)
+        self.raster_dtype = gdal_to_numpy_dtype(self.in_ds.GetRasterBand(1).DataType)
+        self.raster_count = self.in_ds.RasterCount
+        self.raster_data = raster_data if raster_data is not None else self._extract_raster_data(self.in_ds)
+        self._ds_buffer = raster_data
         self.raster_data_shape = self.raster_data.shape
         self.geo_transform = self.in_ds.GetGeoTransform()
         self.pixel_width = self.geo_transform[1]    # the units for this will depend on the projection
@@ -105,7 +137,7 @@ class GeoTiff(object):
             self.pixel_width_m = self.pixel_width
             self.pixel_height_m = self.pixel_height
         
-    def __new__(cls, geotiff_path=None, in_ds=None):
+    def __new__(cls, geotiff_path=None, in_ds=None, lazy=False, cache=None, raster_data=None, overview=None):
         """
             Do checks on the input file - ensure it exists and that its georeferenced.
             If not, return None
@@ -117,7 +149,7 @@ class GeoTiff(object):
                 print "The file %s does not exist!" % (geotiff_path)
                 return None
 
-            in_ds = gdal.Open(geotiff_path)
+            in_ds = open_overview(geotiff_path, overview)
 
         if in_ds:
 
@@ -158,11 +190,28 @@ class GeoTiff(object):
 
 
 
+    def materialise(self):
+        """
+            Read a lazy raster fully into memory and build its no data mask.
+            Does nothing for rasters that are already in memory
+            Return: the raster data as a numpy array
+        """
+        if isinstance(self.raster_data, LazyRaster):
+            self.raster_data = self.raster_data.materialise()
+            if self.no_data_value:
+                self.no_data_mask = self._set_no_data_mask()
+
+        return self.raster_data
+
+
+
     def _set_no_data_mask(self):
         """
             Method sets a no data mask.
             The mask will be a boolean np array, where True indicates the pixel to mask out
         """
+        if np.isnan(self.no_data_value):
+            return np.isnan(self.raster_data)
         return self.raster_data == self.no_data_value
 
 
@@ -192,56 +241,51 @@ class GeoTiff(object):
 
 
 
-    def apply_colour_scale(self, save_path):
+    @instrumented("colour")
+    def apply_colour_scale(self, save_path, paletted=False, colour_scale="RdYlGn", output_type="GTiff"):
         """
             Apply a colour scale to a black and white image
-            Input: directory to save the coloured image
+            The raster is stretched between its 0.4% and 99.6% percentiles for maximum variation in the image,
+            quantized to a 256 entry lookup table and saved as an RGB (or paletted) geotiff (see colour.py)
+            Input: directory to save the coloured image, paletted, name of a scale in colour.COLOUR_SCALES,
+            output_type ("GTiff" or "COG" for a cloud optimised geotiff)
             Return: None (saves file locally)
 
         """
+        self.materialise()
 
-        # shift from -1 - 1 to 0 - 1
-        normalised_index = self.raster_data + 1.0
-        normalised_index = normalised_index / 2.0
-
-        # stretch data to 0.4% and 99.6% quartiles for maximum variation in the image
-        minindex = np.nanpercentile(self.raster_data, 0.4)
-        maxindex = np.nanpercentile(self.raster_data, 99.6)
-        self.raster_data = (normalised_index - minindex) / (maxindex - minindex) 
-
-        cmap = cm.get_cmap('RdYlGn')
-        index_rgb = cmap(normalised_index)
-        index_red = (index_rgb[:,:,0]*255).astype(np.uint8)     
-        index_green = (index_rgb[:,:,1]*255).astype(np.uint8)
-        index_blue = (index_rgb[:,:,2]*255).astype(np.uint8)
-
-        # apply a no data mask if one exists
-        if isinstance(self.no_data_mask, np.ndarray):
-            index_blue[self.no_data_mask] = 255
-            index_green[self.no_data_mask] = 255
-            index_red[self.no_data_mask] = 255
-
-        coloured = np.zeros((self.raster_data.shape[0], self.raster_data.shape[1], 3)).astype("uint8")
-        coloured[:, :, 0] = index_blue
-        coloured[:, :, 1] = index_green
-        coloured[:, :, 2] = index_red
+        indices = colour_indices(self.raster_data, self.no_data_mask if isinstance(self.no_data_mask, np.ndarray) else None)
+        count(pixels=indices.size)
+        coloured = save_colour_geotiff(self.in_ds, indices, save_path, colour_lut(colour_scale), paletted, output_type)
 
         # store back in raster data
         self.raster_data = coloured
-        self.raster_count = 3
-        georeference_raster_to_ds(self.in_ds, coloured, output_type="GTiff", save_path=save_path)
+        self.raster_count = 1 if paletted else 3
 
 
 
-    @helpers.timing
-    def save_raster(self, save_path=None):
+    @instrumented("write")
+    def save_raster(self, save_path=None, storage=None, output_type="GTiff", cog_options=None):
         """
             Save the raster locally.
+            Indices can be saved compactly by giving a storage (see georeferencing.save_index):
+            "float32", or "int16" for the index scaled by INDEX_SCALE with INT16_NO_DATA where it is undefined
+            output_type "COG" saves a tiled cloud optimised geotiff with overviews (see georeferencing.write_cog,
+            cog_options is a dictionary of its keyword arguments, eg. {"compress": "ZSTD", "block_size": 256})
         """
         if not save_path:
             save_path = os.path.splitext(self.geotiff_path)[0] + "_raster.tif"
 
-        gdal.Warp(save_path, self.in_ds, format='GTiff')
+        if storage:
+            save_index(self.in_ds, np.asarray(self.raster_data), save_path, storage, output_type, cog_options)
+        elif output_type == "COG":
+            write_cog(self.in_ds, save_path, **(cog_options or {}))
+        else:
+            # a straight copy, nothing needs warping
+            gdal.Translate(save_path, self.in_ds, format='GTiff')
+
+        count(pixels=self.in_ds.RasterXSize * self.in_ds.RasterYSize)
+        count_written(save_path)
 
 
 
@@ -255,21 +299,38 @@ class GeoTiff(object):
     def _extract_raster_data(self, ds):
         """
             Extract all raster data for inputted geotiff.
-            Return a list of numpy arrays
+            Return a list of numpy arrays, or a LazyRaster proxy when the GeoTiff is lazy
+            Uncompressed, striped geotiffs are memory mapped rather than read (see raster.memmap_raster)
         """
+        if self.lazy:
+            return LazyRaster(ds)
+
+        # an overview's pixels are not where the full resolution file keeps them
+        mapped = memmap_raster(ds) if not self.overview else None
+        if mapped is not None:
+            return mapped
+
+        with span("read", "read_raster") as read_span:
+            raster_data = self._read_bands(ds)
+            read_span.add(pixels=ds.RasterXSize * ds.RasterYSize * self.raster_count, bytes_read=raster_data.nbytes)
+
+        return raster_data
 
-        # sample the first band to get the shape and then preallocate knowing raster_count
-        raster_shape = ds.GetRasterBand(1).ReadAsArray().astype(self.raster_dtype).shape
-        raster_data = np.zeros((raster_shape[0], raster_shape[1], self.raster_count))
 
+    def _read_bands(self, ds):
+        """
+            Read every band of a dataset into a numpy array in its native dtype
+        """
         if self.raster_count > 1:
 
+            # preallocate knowing the dataset size and raster_count, in the dataset's native dtype
+            raster_data = np.empty((ds.RasterYSize, ds.RasterXSize, self.raster_count), dtype=self.raster_dtype)
             for band_idx in range(1, self.raster_count + 1):
-                raster_data[:, :, band_idx - 1] = ds.GetRasterBand(band_idx).ReadAsArray().astype(self.raster_dtype)
+                raster_data[:, :, band_idx - 1] = ds.GetRasterBand(band_idx).ReadAsArray()
 
         else:
 
-            raster_data = ds.GetRasterBand(1).ReadAsArray().astype(self.raster_dtype)
+            raster_data = ds.GetRasterBand(1).ReadAsArray()
 
         return raster_data
 
@@ -278,12 +339,148 @@ class GeoTiff(object):
         """
             Find the gps coordinate at a pixel by computing an affine transform
         """
- 
-        Xpixel = pixel_coord[1]
-        Yline = pixel_coord[0]
-        Xgeo = self.geo_transform[0] + Xpixel*self.geo_transform[1] + Yline*self.geo_transform[2]
-        Ygeo = self.geo_transform[3] + Xpixel*self.geo_transform[4] + Yline*self.geo_transform[5]
-        return (Ygeo, Xgeo)
+        Ygeo, Xgeo = apply_geo_transform(self.geo_transform, pixel_coord[0], pixel_coord[1])
+        return (float(Ygeo), float(Xgeo))
+
+
+
+    def _coordinate_transforms(self):
+        """
+            The inverse geotransform and lon/lat transformer of the current dataset, built once per dataset
+        """
+        key = (self.geo_transform, self.projection)
+        if getattr(self, "_coordinates_key", None) != key:
+            self._coordinates = (invert_geo_transform(self.geo_transform), LonLatTransformer(self.projection))
+            self._coordinates_key = key
+
+        return self._coordinates
+
+
+
+    def pixel_to_geo(self, rows, cols):
+        """
+            Vectorised gps_coord_transform: find the projected coordinates of arrays of pixel positions
+            (top left corners - add 0.5 for pixel centres)
+            Return: (ys, xs) arrays in the raster's projection
+        """
+        return apply_geo_transform(self.geo_transform, rows, cols)
+
+
+
+    def geo_to_pixel(self, ys, xs):
+        """
+            Find the pixels holding arrays of coordinates in the raster's projection
+            Return: (rows, cols) int arrays
+        """
+        return geo_to_pixel(self._coordinate_transforms()[0], ys, xs)
+
+
+
+    def pixel_to_lonlat(self, rows, cols):
+        """
+            Find the wgs84 coordinates of arrays of pixel positions
+            Return: (lats, lons) arrays
+        """
+        ys, xs = self.pixel_to_geo(rows, cols)
+        return self._coordinate_transforms()[1].to_lonlat(ys, xs)
+
+
+
+    def lonlat_to_pixel(self, lats, lons):
+        """
+            Find the pixels holding arrays of wgs84 points
+            Return: (rows, cols) int arrays
+        """
+        ys, xs = self._coordinate_transforms()[1].to_projection(lats, lons)
+        return self.geo_to_pixel(ys, xs)
+
+
+
+    def sample_pixels(self, rows, cols):
+        """
+            Read the raster values at arrays of pixel positions. Only the window covering the points is read,
+            so this also works on lazy rasters.
+            Return: float64 array of the values, shaped like rows (with a trailing band axis for multi band rasters).
+            Points off the raster are NaN
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        height, width = self.raster_data_shape[:2]
+
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        values = np.full(rows.shape + tuple(self.raster_data_shape[2:]), np.nan)
+
+        if inside.any():
+            row_min, row_max = rows[inside].min(), rows[inside].max()
+            col_min, col_max = cols[inside].min(), cols[inside].max()
+
+            window = np.asarray(self.raster_data[row_min:row_max + 1, col_min:col_max + 1])
+            values[inside] = window[rows[inside] - row_min, cols[inside] - col_min]
+
+        return values
+
+
+
+    def sample(self, lats, lons):
+        """
+            Read the raster values at arrays of wgs84 points, eg. field plots (see sample_pixels)
+        """
+        return self.sample_pixels(*self.lonlat_to_pixel(lats, lons))
+
+
+
+    def zonal_stats(self, zones, statistics=DEFAULT_STATISTICS, percentiles=(), band=1):
+        """
+            Compute statistics of the raster under every polygon of a vector file in one pass (see zonal.py).
+            Only the window covering the zones is read. No data and NaN pixels are left out.
+            Input: path to the vector file (or Zones, to share the parsing and rasterizing between rasters),
+            names of statistics (count, sum, mean, std, min, max), percentiles (0 - 100), band of a multi band raster
+            Return: table as an OrderedDict of columns, "zone" (the zone ids) followed by one column per statistic
+        """
+        if not isinstance(zones, Zones):
+            zones = Zones(zones)
+
+        height, width = self.raster_data_shape[:2]
+        window = zones.window(width, height, self.geo_transform, self.projection)
+
+        if window is None:
+            values = np.empty((0, 0), dtype=self.raster_dtype)
+            labels = np.zeros((0, 0), dtype=np.int32)
+            no_data_mask = None
+
+        else:
+            xoff, yoff, xsize, ysize = window
+            rows, cols = slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+
+            gt = self.geo_transform
+            window_geo_transform = (gt[0] + xoff * gt[1] + yoff * gt[2], gt[1], gt[2], gt[3] + xoff * gt[4] + yoff * gt[5], gt[4], gt[5])
+            labels = zones.labels(xsize, ysize, window_geo_transform, self.projection)
+
+            if len(self.raster_data_shape) > 2:
+                values = np.asarray(self.raster_data[rows, cols, band - 1])
+            else:
+                values = np.asarray(self.raster_data[rows, cols])
+
+            if isinstance(self.no_data_mask, np.ndarray):
+                no_data_mask = self.no_data_mask[rows, cols]
+                if no_data_mask.ndim > 2:
+                    no_data_mask = no_data_mask[:, :, band - 1]
+            elif self.no_data_value is not None and not np.isnan(self.no_data_value):
+                no_data_mask = values == self.no_data_value
+            else:
+                no_data_mask = None
+
+        table = OrderedDict([("zone", np.array(zones.ids))])
+        table.update(zonal_statistics(values, labels, len(zones), statistics, percentiles, no_data_mask))
+        return table
+
+
+
+    def distances(self, lats, lons, lat=None, lon=None):
+        """
+            Haversine distances in km from arrays of wgs84 points to one point (defaults to the raster's origin)
+        """
+        return haversine_distances(self.lat if lat is None else lat, self.lon if lon is None else lon, lats, lons)
 
 
 
@@ -306,16 +503,24 @@ class GeoTiff(object):
 
 
 
-    def resize_band(self, shape, projection="wgs84"):
+    @instrumented("warp")
+    def resize_band(self, shape, projection="wgs84", bounds=None):
         """
             Resize the band to a image size.
             Then overwrite current gdal variables
+            bounds (min_lon, min_lat, max_lon, max_lat) pins the output extent, so bands resized with the
+            same shape and bounds land on exactly the same grid
         """
-        resized_ds = gdal.Warp('', self.in_ds, format='MEM', width=shape[1], height=shape[0], dstSRS='EPSG:4326', resampleAlg="cubic")#, dstSRS='EPSG:4326')
+        operation = ["resize", list(shape[:2]), list(bounds) if bounds else None]
+        resized_ds = self._run_cached(operation, lambda: gdal.Warp('', self.in_ds, format='MEM', width=shape[1], height=shape[0], dstSRS='EPSG:4326', resampleAlg="cubic", outputBounds=bounds))#, dstSRS='EPSG:4326')
+
+        count(pixels=resized_ds.RasterXSize * resized_ds.RasterYSize)
 
         self._update_vars(resized_ds)
+        self.operations.append(operation)
 
 
+    @instrumented("warp")
     def resample_band(self, fx, fy):
         """
             Resample the band to a pixel size in meters
@@ -330,12 +535,66 @@ class GeoTiff(object):
             fx = float(fx / self.pixel_width_m) * self.pixel_width
             fy = float(fy / self.pixel_height_m) * self.pixel_height
 
-        resampled_ds = gdal.Warp('', self.in_ds, format='MEM', xRes=fx, yRes=fy, resampleAlg=None)
+        operation = ["resample", fx, fy]
+        resampled_ds = self._run_cached(operation, lambda: gdal.Warp('', self.in_ds, format='MEM', xRes=fx, yRes=fy, resampleAlg=None))
+
+        count(pixels=resampled_ds.RasterXSize * resampled_ds.RasterYSize)
 
         self._update_vars(resampled_ds)
+        self.operations.append(operation)
+
+
+    @instrumented("warp")
+    def reproject(self, projection="EPSG:4326", shape=None, pixel_size=None, bounds=None, resampling="bilinear", plan_cache=None):
+        """
+            Reproject the band with a reusable warp plan (see reprojection.py) rather than gdal.Warp.
+            The mapping between this band's grid and the target grid is worked out once per grid pair and kept in
+            plan_cache (a WarpPlanCache, saved by tile ID when it has a plan_dir), so every later scene of the
+            same tile is just a numpy remap.
+            Then overwrite current gdal variables
+            Inputs: target projection, optional (rows, cols) shape or (x, y) pixel size, optional
+            (min_x, min_y, max_x, max_y) bounds in the target projection, "nearest" or "bilinear", WarpPlanCache
+            Return: the target Grid, to reproject other bands onto exactly the same grid
+        """
+        dst_grid = target_grid(Grid.of(self.in_ds), projection, shape, pixel_size, bounds)
+        return self.reproject_to(dst_grid, resampling, plan_cache)
+
 
+    def reproject_to(self, dst_grid, resampling="bilinear", plan_cache=None):
+        """
+            Reproject the band onto a target Grid with a reusable warp plan (see reproject)
+            Then overwrite current gdal variables
+            Return: the target Grid
+        """
+        plan_cache = plan_cache or default_plan_cache()
+        granule_file = parse_band_filename(self.geotiff_path) if self.geotiff_path else None
+        remapped = {}
+
+        def compute():
+            plan = plan_cache.get(Grid.of(self.in_ds), dst_grid, tile=granule_file.tile if granule_file else None)
+            raster_data = plan.apply(self.materialise(), resampling, self.no_data_value)
+
+            out_ds = wrap_array_as_ds(raster_data)
+            dst_grid.apply_to(out_ds)
+            if self.no_data_value is not None:
+                for band_idx in range(1, out_ds.RasterCount + 1):
+                    out_ds.GetRasterBand(band_idx).SetNoDataValue(self.no_data_value)
+
+            remapped["raster_data"] = raster_data
+            return out_ds
+
+        operation = ["remap", dst_grid.describe(), resampling]
+        reprojected_ds = self._run_cached(operation, compute)
+
+        count(pixels=reprojected_ds.RasterXSize * reprojected_ds.RasterYSize)
+
+        self._update_vars(reprojected_ds, raster_data=remapped.get("raster_data"))
+        self.operations.append(operation)
+        self._refresh_no_data()
+        return dst_grid
 
-    @helpers.timing
+
+    @instrumented("warp")
     def cut_to_kml(self, kml_path, output_type = 'MEM', save_path=None):
         """
             Cut a raster to a kml.
@@ -343,24 +602,124 @@ class GeoTiff(object):
             Warning: kmls are super annoying and this function has proved quite problematic if the kml is not in the right
             format and if there are too many nests in the kml's structure.
             If you ever do have a problem ensure that the kml has the same structure as the one included in the examples directory
-            Inputs: path to the kml
+            The crop happens in memory: only the pixel window under the kml's bounding box is read, and pixels outside
+            the polygon are masked out. If save_path is given, the cut raster is also saved there.
+            Inputs: path to the kml (or an already parsed Cutline, to avoid parsing the kml for every band)
+            Return: GeoTiff object of the cut raster
         """
 
-        if not os.path.isfile(kml_path):
+        if isinstance(kml_path, Cutline):
+            cutline = kml_path
+
+        elif not os.path.isfile(kml_path):
             print "Kml with directory path %s does not exist!" % (kml_path)
             return
 
+        else:
+            cutline = Cutline(kml_path)
+
+        operation = ["crop", cutline.hash, True]
+        cut_ds = self._run_cached(operation, lambda: cutline.crop(self.in_ds))
+        if cut_ds is None:
+            print "Kml %s does not overlap %s" % (cutline.vector_path, self)
+            return
+
         if save_path:
-            gdal.Warp(save_path, self.in_ds, format='GTiff', cutlineDSName=kml_path, cropToCutline=True)
+            gdal.GetDriverByName('GTiff').CreateCopy(save_path, cut_ds, options=['COMPRESS=LZW'])
 
+        cut_geotiff = self.geoTiff_factory(in_ds=cut_ds, lazy=self.lazy, cache=self.cache)
+        cut_geotiff.source_identity = self.source_identity
+        cut_geotiff.operations = self.operations + [operation]
+
+        return cut_geotiff
 
-        if not save_path:
-            # hack - unfortunetly cannot get the cropToCutLine to work when saving to memory...
-            gdal.Warp(os.path.join(os.getcwd(), 'cut.tif'), self.in_ds, format='GTiff', cutlineDSName=kml_path, cropToCutline=True)
-            return self.geoTiff_factory(os.path.join(os.getcwd(), 'cut.tif'))
 
 
 
+    def crop_to_cutline(self, cutline, apply_mask=True):
+        """
+            Crop the raster in place to a Cutline (see cutline.py).
+            Only the pixel window under the cutline is read from the source. With apply_mask False the
+            window is kept whole, which is what you want before resampling (mask afterwards with mask_to_cutline).
+            Then overwrite current gdal variables
+            Return: self, or None if the cutline does not overlap the raster
+        """
+        operation = ["crop", cutline.hash, apply_mask]
+        cut_ds = self._run_cached(operation, lambda: cutline.crop(self.in_ds, apply_mask))
+        if cut_ds is None:
+            return None
+
+        self._update_vars(cut_ds)
+        self.operations.append(operation)
+        self._refresh_no_data()
+        return self
+
+
+    def mask_to_cutline(self, cutline):
+        """
+            Mask out the pixels outside a Cutline. They are set to the no data value.
+            A dataset read from a file is copied into memory first and the mask is applied to the copy, so the file
+            and the pooled dataset shared with other GeoTiffs (see datasets.py) are left untouched.
+            Then overwrite current gdal variables
+        """
+        def mask():
+            in_ds = self.in_ds
+            if in_ds.GetDriver().ShortName != "MEM":
+                in_ds = gdal.GetDriverByName("MEM").CreateCopy("", in_ds)
+            return cutline.apply_mask(in_ds)
+
+        operation = ["mask", cutline.hash]
+        masked_ds = self._run_cached(operation, mask)
+
+        self._update_vars(masked_ds)
+        self.operations.append(operation)
+        self._refresh_no_data()
+
+
+    def _run_cached(self, operation, compute):
+        """
+            Run an operation that makes a new gdal dataset out of this raster.
+            When the GeoTiff has a cache and comes from a file, the result is looked up by the source file, the
+            operations done so far and this operation, and only computed (then stored) on a miss.
+            Inputs: json serialisable description of the operation, function that computes the new dataset
+            Return: the new gdal dataset (None if compute returned None)
+        """
+        key = self.cache_key(operation)
+        if key is None:
+            return compute()
+
+        out_ds = self.cache.get(key)
+        if out_ds is None:
+            out_ds = compute()
+            if out_ds is not None:
+                self.cache.put(key, out_ds)
+
+        return out_ds
+
+
+    def cache_key(self, operation=None):
+        """
+            Return the cache key of this raster, after an optional extra operation,
+            or None if the GeoTiff has no cache or is not backed by a file
+        """
+        if self.cache is None or self.source_identity is None:
+            return None
+
+        operations = self.operations + ([operation] if operation else [])
+        return self.cache.key([self.source_identity], operations)
+
+
+    def _refresh_no_data(self):
+        """
+            Re-read the no data value and rebuild the no data mask after the dataset has changed
+        """
+        self.no_data_value = self._get_no_data_val()
+        if self.no_data_value and not isinstance(self.raster_data, LazyRaster):
+            self.no_data_mask = self._set_no_data_mask()
+        else:
+            self.no_data_mask = None
+
+
 
     def _extract_geo_info(self, in_ds):
         """
@@ -370,7 +729,7 @@ class GeoTiff(object):
         """
         self.in_ds = in_ds
         self.projection = in_ds.GetProjection()
-        self.raster_dtype = in_ds.GetRasterBand(1).ReadAsArray().dtype
+        self.raster_dtype = gdal_to_numpy_dtype(in_ds.GetRasterBand(1).DataType)
         self.raster_count = in_ds.RasterCount
         self.raster_data = self._extract_raster_data(in_ds)
         self.raster_data_shape = self.raster_data.shape
@@ -384,12 +743,12 @@ class GeoTiff(object):
 
 
     @staticmethod
-    def geoTiff_factory(geoTiff=None, in_ds=None):
+    def geoTiff_factory(geoTiff=None, in_ds=None, lazy=False, cache=None, raster_data=None):
         """
             Method returns a GeoTiff object for some gdal Open input data source.
             This is useful when we've created an object in code that we wish to wrap into this class
         """
-        return GeoTiff(geoTiff, in_ds)
+        return GeoTiff(geoTiff, in_ds, lazy, cache, raster_data)
 
 
 
@@ -398,18 +757,20 @@ class GeoTiff(object):
         """
             Change the geotiffs projection to whatever is specified
         """
-        reproj_ds = gdal.Warp('', self.in_ds, format='MEM', dstSRS=EPSG)
+        operation = ["reproject", EPSG]
+        reproj_ds = self._run_cached(operation, lambda: gdal.Warp('', self.in_ds, format='MEM', dstSRS=EPSG))
         self._update_vars(reproj_ds)
+        self.operations.append(operation)
 
 
 
 
     @staticmethod
-    def factory(geotiffs):
+    def factory(geotiffs, lazy=False, cache=None, overview=None):
         """
             Return a list of GeoTiff objects for a list of geotiff directory paths
         """
-        return [GeoTiff(geotiff) for geotiff in geotiffs]
+        return [GeoTiff(geotiff, lazy=lazy, cache=cache, overview=overview) for geotiff in geotiffs]
 
 
 
@@ -1,16 +1,44 @@
 
 
 from osgeo import gdal_array, gdal, ogr, osr
+import numpy as np
 import os
 
-def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff"):
+
+# indices (which lie in -1 - 1) saved as int16 are stored multiplied by INDEX_SCALE,
+# with INT16_NO_DATA where the index is undefined
+INDEX_SCALE = 10000
+INT16_NO_DATA = -32768
+
+# internal tile size of cloud optimised geotiffs
+COG_BLOCK_SIZE = 512
+
+
+
+def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff", copy=True, cog_options=None):
     """
         Georeference a raster to a gdal dataset
-        Input: gdal.Open object, np.array, output_type ('MEM' or 'GTiff'), save_path (string to directory for save)
-        Output_type can be "GTiff" (locally saved geotiff), "MEM" (gdal.Open object in memory) ...
+        Input: gdal.Open object, np.array, output_type ('MEM', 'GTiff' or 'COG'), save_path (string to directory for save)
+        Output_type can be "GTiff" (locally saved geotiff), "MEM" (gdal.Open object in memory),
+        "COG" (locally saved cloud optimised geotiff, see write_cog - cog_options is a dictionary of its keyword arguments) ...
+        With output_type "MEM" and copy False, the dataset wraps the raster's own buffer instead of copying it
+        (see wrap_array_as_ds) - the caller must then keep the raster alive for as long as the dataset is used.
 
     """
 
+    if output_type == "MEM" and not copy:
+        out_ds = wrap_array_as_ds(raster)
+        copy_georeferencing(src_ds, out_ds)
+        return out_ds
+
+    if output_type == "COG":
+        if not save_path:
+            save_path = os.path.join(os.getcwd(), 'georeferenced.tif')
+
+        mem_ds = georeference_raster_to_ds(src_ds, raster, output_type="MEM", copy=False)
+        write_cog(mem_ds, save_path, **(cog_options or {}))
+        return
+
     # get gdal data type (translates np dtypes to gdal's types)
     type_code = gdal_array.NumericTypeCodeToGDALTypeCode(raster.dtype)
 
@@ -19,7 +47,7 @@ def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff
     # handle raster with many bands
     layers = 1
     if raster.ndim > 2:
-        layers = raster.ndim
+        layers = raster.shape[2]
 
 
     # handle output types
@@ -35,7 +63,7 @@ def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff
     # if the raster has layers, add each separatly
     if raster.ndim > 2:
 
-        for band in range (1, raster.ndim + 1):
+        for band in range (1, layers + 1):
             raster_band = raster[:, :, band-1]
             out_ds.GetRasterBand(band).WriteArray(raster_band)
 
@@ -43,9 +71,7 @@ def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff
         out_ds.GetRasterBand(1).WriteArray(raster)
 
     # add gis + metadata info
-    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
-    out_ds.SetProjection(src_ds.GetProjection())
-    out_ds.SetMetadata(src_ds.GetMetadata())
+    copy_georeferencing(src_ds, out_ds)
 
 
 
@@ -56,3 +82,204 @@ def georeference_raster_to_ds(src_ds, raster, save_path=None, output_type="GTiff
         out_ds.FlushCache()
         del out_ds
 
+
+
+def wrap_array_as_ds(raster):
+    """
+        Wrap a 2-D (rows, cols) or 3-D (rows, cols, bands) numpy array as a MEM gdal dataset, without copying.
+        The dataset reads and writes the array's memory directly through gdal's MEM DATAPOINTER, so
+        the array must outlive the dataset.
+        gdal can't point at arrays with negative strides or a non native byte order (eg. a big endian memmap), so
+        those are copied into a MEM dataset that owns its memory - nothing then depends on a temporary copy
+        staying alive.
+    """
+    if any(stride < 0 for stride in raster.strides) or not raster.dtype.isnative:
+        return _copy_array_to_ds(raster)
+
+    type_code = gdal_array.NumericTypeCodeToGDALTypeCode(raster.dtype)
+    bands = raster.shape[2] if raster.ndim > 2 else 1
+    band_offset = raster.strides[2] if raster.ndim > 2 else 0
+
+    name = "MEM:::DATAPOINTER=%d,PIXELS=%d,LINES=%d,BANDS=%d,DATATYPE=%s,PIXELOFFSET=%d,LINEOFFSET=%d,BANDOFFSET=%d" % (
+        raster.__array_interface__["data"][0], raster.shape[1], raster.shape[0], bands,
+        gdal.GetDataTypeName(type_code), raster.strides[1], raster.strides[0], band_offset)
+
+    # newer gdal versions only open MEM::: names when asked to
+    previous = gdal.GetConfigOption("GDAL_MEM_ENABLE_OPEN")
+    gdal.SetConfigOption("GDAL_MEM_ENABLE_OPEN", "YES")
+    try:
+        return gdal.Open(name, gdal.GA_Update)
+    finally:
+        gdal.SetConfigOption("GDAL_MEM_ENABLE_OPEN", previous)
+
+
+
+def _copy_array_to_ds(raster):
+    """
+        Copy a 2-D or 3-D numpy array into a new MEM dataset, converted to the native byte order
+    """
+    raster = raster.astype(raster.dtype.newbyteorder("="), copy=False)
+    bands = raster.shape[2] if raster.ndim > 2 else 1
+
+    out_ds = gdal.GetDriverByName("MEM").Create("", raster.shape[1], raster.shape[0], bands,
+                                                  gdal_array.NumericTypeCodeToGDALTypeCode(raster.dtype))
+    for band in range(1, bands + 1):
+        out_ds.GetRasterBand(band).WriteArray(raster[:, :, band - 1] if raster.ndim > 2 else raster)
+
+    return out_ds
+
+
+
+def copy_georeferencing(src_ds, out_ds):
+    """
+        Copy the geotransform, projection and metadata of src_ds onto out_ds
+    """
+    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_ds.SetMetadata(src_ds.GetMetadata())
+
+
+
+def save_index(src_ds, index, save_path, storage="float32", output_type="GTiff", cog_options=None):
+    """
+        Save an index raster as a geotiff (output_type "GTiff") or cloud optimised geotiff ("COG") on the grid of src_ds.
+        storage "float32" keeps the index as is, with NaN marking undefined pixels.
+        storage "int16" halves that again: the index is stored as round(index * INDEX_SCALE), undefined
+        pixels are INT16_NO_DATA, and the band's scale is set so gdal based readers get the index back unscaled.
+    """
+    # a cog is written in one go from a finished dataset
+    ds_path, ds_type = (None, "MEM") if output_type == "COG" else (save_path, output_type)
+
+    out_ds = create_index_ds(src_ds, storage, ds_path, ds_type)
+    out_ds.GetRasterBand(1).WriteArray(encode_index(index, storage))
+
+    if output_type == "COG":
+        write_cog(out_ds, save_path, **(cog_options or {}))
+    else:
+        out_ds.FlushCache()
+    del out_ds
+
+
+
+def create_index_ds(src_ds, storage="float32", save_path=None, output_type="GTiff"):
+    """
+        Create an empty one band dataset on the grid of src_ds for an index stored as storage (see save_index),
+        with its no data value (and, for int16, its scale) set
+    """
+    if storage == "float32":
+        return create_output_ds(src_ds, 1, gdal.GDT_Float32, save_path, output_type, no_data_value=np.nan)
+
+    if storage == "int16":
+        out_ds = create_output_ds(src_ds, 1, gdal.GDT_Int16, save_path, output_type, no_data_value=INT16_NO_DATA)
+        out_ds.GetRasterBand(1).SetScale(1.0 / INDEX_SCALE)
+        out_ds.GetRasterBand(1).SetOffset(0.0)
+        return out_ds
+
+    raise ValueError("Unknown index storage %s, use float32 or int16" % storage)
+
+
+
+def encode_index(index, storage="float32"):
+    """
+        Convert an index raster (or block of one) to its storage type (see save_index)
+    """
+    if storage == "float32":
+        return index.astype(np.float32, copy=False)
+
+    if storage == "int16":
+        valid = np.isfinite(index)
+        scaled = np.full(index.shape, INT16_NO_DATA, dtype=np.int16)
+        scaled[valid] = np.clip(np.rint(index[valid] * INDEX_SCALE), INT16_NO_DATA + 1, np.iinfo(np.int16).max)
+        return scaled
+
+    raise ValueError("Unknown index storage %s, use float32 or int16" % storage)
+
+
+
+def overview_factors(xsize, ysize, block_size=COG_BLOCK_SIZE):
+    """
+        Overview decimation factors (2, 4, 8...) until the smallest overview fits in one block
+    """
+    factors = []
+    factor = 2
+    while max(xsize, ysize) / float(factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+
+def write_cog(in_ds, save_path, block_size=COG_BLOCK_SIZE, compress="DEFLATE", predictor=True, level=None, overview_resampling=None):
+    """
+        Write a dataset as a cloud optimised geotiff: internally tiled, compressed, with overviews stored
+        ahead of the full resolution tiles, so viewers can read just the tiles and zoom level they show.
+        The dataset is copied as is (no warp), with gdal's COG driver when it is available (gdal >= 3.1) and
+        otherwise by building the overviews in memory and copying them with the GTiff driver.
+        Input: gdal dataset, save path, tile size, compression ("DEFLATE", "ZSTD", "LZW" or "NONE"),
+        predictor (horizontal differencing, a big win for smooth rasters), compression level,
+        overview resampling (defaults to NEAREST for paletted rasters and AVERAGE otherwise)
+    """
+    band = in_ds.GetRasterBand(1)
+    if overview_resampling is None:
+        overview_resampling = "NEAREST" if band.GetColorTable() is not None else "AVERAGE"
+
+    is_float = band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+    use_predictor = predictor and compress in ("DEFLATE", "ZSTD", "LZW")
+
+    if gdal.GetDriverByName("COG") is not None:
+        options = ["BLOCKSIZE=%d" % block_size, "COMPRESS=%s" % compress, "OVERVIEW_RESAMPLING=%s" % overview_resampling,
+                   "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"]
+        if use_predictor:
+            options.append("PREDICTOR=YES")
+        if level is not None:
+            options.append("LEVEL=%d" % level)
+
+        gdal.Translate(save_path, in_ds, format="COG", creationOptions=options)
+        return
+
+    # older gdal - build the overviews on an in memory copy then copy them across with the full resolution tiles
+    if in_ds.GetDriver().ShortName != "MEM":
+        in_ds = gdal.GetDriverByName("MEM").CreateCopy("", in_ds)
+
+    factors = overview_factors(in_ds.RasterXSize, in_ds.RasterYSize, block_size)
+    if factors:
+        in_ds.BuildOverviews(overview_resampling, factors)
+
+    options = ["TILED=YES", "BLOCKXSIZE=%d" % block_size, "BLOCKYSIZE=%d" % block_size, "COMPRESS=%s" % compress,
+               "COPY_SRC_OVERVIEWS=YES", "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"]
+    if use_predictor:
+        options.append("PREDICTOR=%d" % (3 if is_float else 2))
+    if level is not None:
+        options.append(("ZSTD_LEVEL=%d" if compress == "ZSTD" else "ZLEVEL=%d") % level)
+
+    out_ds = gdal.GetDriverByName("GTiff").CreateCopy(save_path, in_ds, options=options)
+    out_ds.FlushCache()
+    del out_ds
+
+
+
+def create_output_ds(src_ds, layers, type_code, save_path=None, output_type="GTiff", no_data_value=None):
+    """
+        Create an empty dataset on the same grid as src_ds, ready to be written block by block
+        Input: gdal.Open object, number of bands, gdal data type, save_path, output_type ('MEM' or 'GTiff'), no data value
+        Output: gdal dataset. GTiff outputs are tiled so blocks can be written in any order
+
+    """
+    driver = gdal.GetDriverByName(output_type)
+
+    if output_type == "MEM":
+        out_ds = driver.Create("", src_ds.RasterXSize, src_ds.RasterYSize, layers, type_code)
+
+    elif output_type == "GTiff":
+        if not save_path:
+            save_path = os.path.join(os.getcwd(), 'georeferenced.tif')
+
+        out_ds = driver.Create(save_path, src_ds.RasterXSize, src_ds.RasterYSize, layers, type_code, ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+
+    copy_georeferencing(src_ds, out_ds)
+
+    if no_data_value is not None:
+        for band in range(1, layers + 1):
+            out_ds.GetRasterBand(band).SetNoDataValue(no_data_value)
+
+    return out_ds
@@ -2,23 +2,15 @@
 
 from osgeo import ogr, gdal
 from math import *
-from functools import wraps
-from time import time
+from coordinates import haversine_distances
+from instrumentation import instrumented
 
 def timing(f):
     """
-        Time methods convienently
+        Time methods convienently.
+        Calls are recorded as "compute" spans when instrumentation is enabled (see instrumentation.py)
     """
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-
-        start = time()
-        result = f(*args, **kwargs)
-        end = time()
-        print 'Elapsed time: {time} for function {name}'.format(time=end-start, name=f.__name__)
-
-        return result
-    return wrapper
+    return instrumented("compute")(f)
 
 
 
@@ -43,23 +35,9 @@ def haversine_dist(coord1, coord2):
     """
         Calculate the great circle distance between two points on the earth (specified in decimal degrees)
         returns distance between points in km. 
+        See coordinates.haversine_distances for arrays of points
     """
-    # extract lats n lons
-    lat1 = coord1[0]
-    lon1 = coord1[1]
-    lat2 = coord2[0]
-    lon2 = coord2[1]
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    # Radius of earth in kilometers is 6371
-    km = 6371* c
-
-    return km
+    return float(haversine_distances(coord1[0], coord1[1], coord2[0], coord2[1]))
 
 
 
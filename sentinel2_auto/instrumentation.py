@@ -0,0 +1,391 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Spans timing each stage of the pipeline (open, read, warp, compute, colour, write)
+
+    Usage:
+        from sentinel2_auto import instrumentation
+        instrumentation.enable()
+        ...run the pipeline...
+        instrumentation.write_jsonl("spans.jsonl")
+        instrumentation.write_prometheus("/var/lib/node_exporter/s2auto.prom")
+
+    Each span records its wall time, process CPU time, bytes read and written, pixels processed, how much it raised the
+    process' peak RSS and gdal's block cache use when it ended. Spans nest per thread, so a warp inside cut_to_kml
+    knows its parent. Finished spans are kept in an in-process registry.
+    Instrumentation is off unless enable() is called or S2AUTO_INSTRUMENT=1 is set. While it is off, span() hands back
+    one shared do-nothing span, so the instrumented code only pays for a flag check.
+
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+from collections import deque, OrderedDict
+from functools import wraps
+from osgeo import gdal
+
+
+
+# pipeline stages spans are grouped by
+STAGES = ("fetch", "open", "read", "warp", "compute", "colour", "write", "granule")
+
+# counters a span can accumulate with count()
+COUNTERS = ("bytes_read", "bytes_written", "pixels")
+
+# finished spans the registry keeps, the oldest are dropped past this
+DEFAULT_MAX_SPANS = 100000
+
+# prefix of the prometheus metric names
+METRIC_PREFIX = "s2auto"
+
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu_seconds():
+    # user + system time of the whole process, threads included
+    times = os.times()
+    return times[0] + times[1]
+
+
+
+class Span(object):
+    """
+        One timed stage. Use as a context manager (see span()), and count() what it processes while it is open
+    """
+
+    def __init__(self, registry, stage, name, attributes):
+        self.registry = registry
+        self.stage = stage
+        self.name = name
+        self.attributes = attributes
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.parent = None
+        self.depth = 0
+
+
+    def __repr__(self):
+        return "Span_%s_%s" % (self.stage, self.name)
+
+
+    def add(self, **counters):
+        """
+            Add to the span's counters, eg. add(pixels=rows * cols, bytes_read=array.nbytes)
+        """
+        for counter, value in counters.iteritems():
+            self.counters[counter] += int(value)
+
+
+    def __enter__(self):
+        stack = self.registry._stack()
+        if stack:
+            self.parent = "%s/%s" % (stack[-1].stage, stack[-1].name)
+            self.depth = len(stack)
+        stack.append(self)
+
+        self._start_rss = _peak_rss_bytes()
+        self._start_cpu = _cpu_seconds()
+        self._start = time.time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.time() - self._start
+        cpu = _cpu_seconds() - self._start_cpu
+        rss_delta = _peak_rss_bytes() - self._start_rss
+
+        stack = self.registry._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+
+        record = OrderedDict([
+            ("stage", self.stage),
+            ("name", self.name),
+            ("parent", self.parent),
+            ("depth", self.depth),
+            ("start", self._start),
+            ("wall_seconds", wall),
+            ("cpu_seconds", cpu),
+            ("peak_rss_delta_bytes", rss_delta),
+            ("gdal_cache_used_bytes", gdal.GetCacheUsed()),
+            ("gdal_cache_max_bytes", gdal.GetCacheMax()),
+            ("pid", os.getpid()),
+            ("thread", threading.current_thread().name),
+            ("error", exc_type.__name__ if exc_type else None),
+        ])
+        record.update(self.counters)
+        record.update(self.attributes)
+
+        self.registry.record(record)
+        return False
+
+
+
+class _NullSpan(object):
+    """
+        The span handed out while instrumentation is off
+    """
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+
+class SpanRegistry(object):
+    """
+        In-process store of finished spans (as dictionaries), and the open span stack of each thread
+    """
+
+    def __init__(self, max_spans=DEFAULT_MAX_SPANS):
+        self.enabled = False
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    def __repr__(self):
+        return "SpanRegistry_%d" % len(self.spans)
+
+
+    def __len__(self):
+        return len(self.spans)
+
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def span(self, stage, name=None, **attributes):
+        """
+            Return a span to open with "with", or the shared do-nothing span when disabled
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, stage, name or stage, attributes)
+
+
+    def current(self):
+        """
+            Return the innermost open span of this thread (the do-nothing span if there is none)
+        """
+        stack = self._stack() if self.enabled else None
+        return stack[-1] if stack else _NULL_SPAN
+
+
+    def record(self, span_record):
+        with self._lock:
+            self.spans.append(span_record)
+
+
+    def extend(self, span_records):
+        """
+            Add spans recorded elsewhere, eg. by a batch worker process
+        """
+        with self._lock:
+            self.spans.extend(span_records)
+
+
+    def drain(self):
+        """
+            Remove and return every finished span
+        """
+        with self._lock:
+            span_records = list(self.spans)
+            self.spans.clear()
+        return span_records
+
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+    def summary(self):
+        """
+            Totals of the finished spans per (stage, name)
+            Return: OrderedDict of {(stage, name): dictionary of calls, wall and cpu seconds, counters, max rss delta}
+        """
+        with self._lock:
+            span_records = list(self.spans)
+
+        totals = OrderedDict()
+        for span_record in sorted(span_records, key=lambda record: (record["stage"], record["name"])):
+            key = (span_record["stage"], span_record["name"])
+            if key not in totals:
+                totals[key] = dict([("calls", 0), ("errors", 0), ("wall_seconds", 0.0), ("cpu_seconds", 0.0), ("peak_rss_delta_bytes", 0)] +
+                                   [(counter, 0) for counter in COUNTERS])
+
+            total = totals[key]
+            total["calls"] += 1
+            total["errors"] += 1 if span_record["error"] else 0
+            total["wall_seconds"] += span_record["wall_seconds"]
+            total["cpu_seconds"] += span_record["cpu_seconds"]
+            total["peak_rss_delta_bytes"] = max(total["peak_rss_delta_bytes"], span_record["peak_rss_delta_bytes"])
+            for counter in COUNTERS:
+                total[counter] += span_record.get(counter, 0)
+
+        return totals
+
+
+
+# the registry shared by everything in this process
+_registry = SpanRegistry()
+_registry.enabled = os.environ.get("S2AUTO_INSTRUMENT", "") not in ("", "0")
+
+
+
+def registry():
+    """
+        Return the process wide span registry
+    """
+    return _registry
+
+
+def enable():
+    _registry.enabled = True
+
+
+def disable():
+    _registry.enabled = False
+
+
+def is_enabled():
+    return _registry.enabled
+
+
+
+def span(stage, name=None, **attributes):
+    """
+        Time a block of code as one stage:
+            with span("warp", "resize_band", band="B04") as warp_span:
+                ...
+                warp_span.add(pixels=width * height)
+        Extra keyword attributes are stored on the span's record
+    """
+    return _registry.span(stage, name, **attributes)
+
+
+
+def count(**counters):
+    """
+        Add to the counters of the innermost open span of this thread, eg. count(bytes_read=array.nbytes)
+    """
+    _registry.current().add(**counters)
+
+
+
+def count_written(path):
+    """
+        Count the size of a file just written against the innermost open span
+    """
+    if _registry.enabled and path and os.path.isfile(path):
+        count(bytes_written=os.path.getsize(path))
+
+
+
+def instrumented(stage, name=None):
+    """
+        Decorator running every call of a function in a span, named after the function unless name is given
+    """
+    def decorator(f):
+        span_name = name or f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _registry.enabled:
+                return f(*args, **kwargs)
+
+            with _registry.span(stage, span_name):
+                return f(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+
+def _write_atomically(path, text):
+    # readers (eg. node_exporter's textfile collector) never see a half written file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(text)
+    os.rename(tmp_path, path)
+
+
+
+def write_jsonl(path, span_records=None, append=True):
+    """
+        Write spans (defaults to every finished span in the registry) as one json object per line
+    """
+    span_records = list(_registry.spans) if span_records is None else span_records
+
+    with open(path, "a" if append else "w") as jsonl_file:
+        for span_record in span_records:
+            jsonl_file.write(json.dumps(span_record) + "\n")
+
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+
+def prometheus_text(summary=None):
+    """
+        Format span totals (see SpanRegistry.summary) in the prometheus text exposition format
+    """
+    summary = _registry.summary() if summary is None else summary
+
+    metrics = [
+        ("calls_total", "counter", "Spans finished", "calls"),
+        ("errors_total", "counter", "Spans that raised", "errors"),
+        ("wall_seconds_total", "counter", "Wall time spent in the stage", "wall_seconds"),
+        ("cpu_seconds_total", "counter", "Process CPU time spent in the stage", "cpu_seconds"),
+        ("bytes_read_total", "counter", "Bytes read by the stage", "bytes_read"),
+        ("bytes_written_total", "counter", "Bytes written by the stage", "bytes_written"),
+        ("pixels_total", "counter", "Pixels processed by the stage", "pixels"),
+        ("peak_rss_delta_bytes", "gauge", "Largest rise of the peak RSS during one span", "peak_rss_delta_bytes"),
+    ]
+
+    lines = []
+    for metric, metric_type, description, field in metrics:
+        metric_name = "%s_stage_%s" % (METRIC_PREFIX, metric)
+        lines.append("# HELP %s %s" % (metric_name, description))
+        lines.append("# TYPE %s %s" % (metric_name, metric_type))
+        for (stage, name), total in summary.iteritems():
+            lines.append('%s{stage="%s",name="%s"} %s' % (metric_name, _label(stage), _label(name), repr(total[field])))
+
+    for metric, description, value in [("gdal_cache_used_bytes", "Bytes in gdal's block cache", gdal.GetCacheUsed()),
+                                       ("gdal_cache_max_bytes", "Size of gdal's block cache", gdal.GetCacheMax())]:
+        metric_name = "%s_%s" % (METRIC_PREFIX, metric)
+        lines.append("# HELP %s %s" % (metric_name, description))
+        lines.append("# TYPE %s gauge" % metric_name)
+        lines.append("%s %s" % (metric_name, value))
+
+    return "\n".join(lines) + "\n"
+
+
+
+def write_prometheus(path, summary=None):
+    """
+        Write span totals as a prometheus textfile (eg. for node_exporter's textfile collector), atomically
+    """
+    _write_atomically(path, prometheus_text(summary))
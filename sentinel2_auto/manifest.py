@@ -0,0 +1,148 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Manifests of the outputs generated for each granule, for incremental reprocessing
+
+    Every granule gets a .s2auto_manifest_<granule>.json in its directory recording, for each output written there,
+    the fingerprints (path, size, mtime) of the band files it was made from and the parameters it was made with
+    (indices, storage, format, library version). Granules sharing a directory (eg. a flat archive) have their own
+    manifests, so the workers processing them never overwrite each other's entries. A rerun skips a granule when every output it would write
+    is recorded with the same inputs and parameters and is still on disk unchanged.
+    Outputs are written to a temporary file and renamed into place, so an interrupted run never leaves a half
+    written geotiff behind - just the previous version, or nothing.
+
+"""
+
+import os
+import json
+import uuid
+from contextlib import contextmanager
+from cache import source_identity
+from version import __version__
+
+
+
+MANIFEST_NAME = ".s2auto_manifest.json"
+
+# the manifest of one granule, eg. .s2auto_manifest_T56HLH_20190204T000241.json
+GRANULE_MANIFEST_NAME = ".s2auto_manifest_%s.json"
+
+
+
+def fingerprint(path):
+    """
+        Identify a file by its absolute path, size and modification time (see cache.source_identity)
+        Return: list, or None if the file does not exist
+    """
+    try:
+        return source_identity(path)
+    except OSError:
+        return None
+
+
+
+@contextmanager
+def atomic_path(path):
+    """
+        Context manager giving a temporary path next to path to write to, renamed to path on success
+        and removed on failure. The temporary file keeps the extension so gdal picks the right driver.
+    """
+    # not made with mkstemp: the output should get the usual permissions, not mkstemp's owner only ones
+    directory, name = os.path.split(os.path.abspath(path))
+    root, extension = os.path.splitext(name)
+    tmp_path = os.path.join(directory, ".%s.%d.%s.tmp%s" % (root, os.getpid(), uuid.uuid4().hex[:8], extension))
+
+    try:
+        yield tmp_path
+        os.rename(tmp_path, path)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+
+class Manifest(object):
+    """
+        The manifest of one output directory: {output file name: {"inputs": {band: fingerprint},
+        "params": {...}, "output": fingerprint}}
+    """
+
+    def __init__(self, directory, granule=None):
+        """
+            Input: output directory, optional granule name (eg. "T56HLH_20190204T000241") to keep its own manifest
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, GRANULE_MANIFEST_NAME % granule if granule else MANIFEST_NAME)
+        self.entries = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as manifest_file:
+                    self.entries = json.load(manifest_file).get("outputs", {})
+            except ValueError:
+                # a corrupt manifest only costs a recompute
+                self.entries = {}
+
+
+    def __repr__(self):
+        return "Manifest_%s" % self.directory
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @staticmethod
+    def describe_inputs(inputs):
+        """
+            Fingerprint the input files.
+            Input: dictionary of {band name: path}
+            Return: dictionary of {band name: fingerprint}
+        """
+        return dict((name, fingerprint(path)) for name, path in inputs.items())
+
+
+    def is_up_to_date(self, output_path, inputs, params):
+        """
+            Return True if output_path is recorded with these input fingerprints and parameters
+            and has not changed on disk since
+        """
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None:
+            return False
+
+        return (entry["inputs"] == self.describe_inputs(inputs) and entry["params"] == _normalise(params)
+                and entry["output"] == fingerprint(output_path))
+
+
+    def outdated(self, output_paths, inputs, params):
+        """
+            Return the outputs that need (re)generating
+        """
+        return [output_path for output_path in output_paths if not self.is_up_to_date(output_path, inputs, params)]
+
+
+    def record(self, output_path, inputs, params):
+        """
+            Record an output as generated from inputs with params (call save() to write the manifest)
+        """
+        self.entries[os.path.basename(output_path)] = {"inputs": self.describe_inputs(inputs), "params": _normalise(params),
+                                                       "output": fingerprint(output_path)}
+
+
+    def save(self):
+        """
+            Write the manifest, atomically
+        """
+        with atomic_path(self.path) as tmp_path:
+            with open(tmp_path, "w") as manifest_file:
+                json.dump({"version": __version__, "outputs": self.entries}, manifest_file, indent=1, sort_keys=True)
+
+
+
+def _normalise(params):
+    # compare parameters the way they come back out of json (tuples become lists)
+    return json.loads(json.dumps(dict(params, version=__version__), sort_keys=True))
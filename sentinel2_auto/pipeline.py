@@ -0,0 +1,577 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Declarative processing of a scene from a recipe of bands, area of interest, resolution, indices and outputs
+
+    Usage:
+        python -m sentinel2_auto.pipeline recipe.yaml [--threads 8] [--plan]
+
+    A recipe (a dictionary, or a json/yaml file - see load_recipe) is planned into a DAG of stages: band reads,
+    the area of interest mask, indices, and gray, raster and colour outputs. Stages fuse into one streaming pass
+    unless they wait on a reduction: every window of the target grid is read once from a VRT stacking the needed
+    bands (resampled to the target resolution as it is read), all the indices are evaluated from that one read with
+    shared terms computed once (see expressions.py), and every output block is written in the same pass.
+    Colour outputs need their index's stretch first, so they are written by a second pass over the float32
+    indices rather than over the source bands.
+
+"""
+
+import os, sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from osgeo import gdal
+from expressions import compile_expressions, INDEX_EXPRESSIONS
+from georeferencing import create_output_ds, create_index_ds, encode_index, write_cog
+from colour import (COLOUR_SCALES, HISTOGRAM_BINS, colour_lut, quantize, create_colour_ds, colour_blocks,
+                    percentiles_from_histogram)
+from cutline import Cutline, _srs_from_wkt
+from datasets import open_dataset
+from streaming import stream_blocks
+from raster import block_windows
+from instrumentation import instrumented, span
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+
+# (xsize, ysize) windows streamed through the target grid
+PIPELINE_BLOCK_SIZE = (1024, 1024)
+
+OUTPUT_TYPES = ("gray", "raster", "colour")
+OUTPUT_FORMATS = ("GTiff", "COG")
+
+# the stretch of GeoTiff.apply_colour_scale
+STRETCH_PERCENTILES = (0.4, 99.6)
+
+# stages that need the whole of their input before anything can use their result
+REDUCTIONS = set(["stretch"])
+
+
+
+def load_recipe(path):
+    """
+        Read a recipe from a json or yaml file (yaml needs PyYAML)
+        Return: dictionary
+    """
+    with open(path) as recipe_file:
+        text = recipe_file.read()
+
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        if yaml is None:
+            raise ImportError("Reading the yaml recipe %s needs PyYAML (pip install pyyaml), or use json" % path)
+        return yaml.safe_load(text)
+
+    return json.loads(text)
+
+
+
+class Stage(object):
+    """
+        One node of a pipeline's DAG.
+        kind is "read", "mask", "index", "gray", "raster", "stretch" or "colour", inputs are the names of the
+        stages it uses and params holds the rest of its recipe (expression, path, storage...)
+    """
+
+    def __init__(self, name, kind, inputs=(), **params):
+        self.name = name
+        self.kind = kind
+        self.inputs = list(inputs)
+        self.params = params
+
+
+    def __repr__(self):
+        return "Stage_%s" % self.name
+
+
+
+class Pipeline(object):
+    """
+        A planned recipe, ready to run().
+        Planning only parses the recipe, so it can be checked (see describe()) without opening any file
+    """
+
+    def __init__(self, recipe, base_dir=None):
+        """
+            Input: recipe dictionary, directory its relative paths are relative to (defaults to the working directory)
+            A recipe has:
+                bands: {band name: path}
+                aoi: optional kml (or any vector file) to cut to
+                resolution: optional pixel size in the bands' units (defaults to the finest band)
+                indices: list of names in INDEX_EXPRESSIONS, or {name: expression (or null for a known index)}
+                outputs: optional list of {source: index or band name, type: gray/raster/colour, path, format,
+                         storage (gray), colour_scale and paletted (colour)} - a gray and a colour geotiff of every
+                         index by default
+                output_dir, format (GTiff or COG), resampling, block_size and threads are optional
+        """
+        if not recipe.get("bands"):
+            raise ValueError("A recipe needs bands")
+
+        self.recipe = recipe
+        self.base_dir = base_dir or os.getcwd()
+
+        self.bands = dict((band, self._path(path)) for band, path in recipe["bands"].items())
+        self.aoi = self._path(recipe["aoi"]) if recipe.get("aoi") else None
+        self.resolution = recipe.get("resolution")
+        self.resampling = recipe.get("resampling", "cubic")
+        self.output_dir = self._path(recipe.get("output_dir", "."))
+        self.output_type = recipe.get("format", "GTiff")
+        self.block_size = tuple(recipe.get("block_size", PIPELINE_BLOCK_SIZE))
+        self.threads = recipe.get("threads", 1)
+
+        self.expressions = self._parse_indices(recipe.get("indices", []))
+        self.outputs = self._parse_outputs(recipe.get("outputs"))
+        if not self.outputs:
+            raise ValueError("A recipe needs indices or outputs")
+
+        self.stages = self._build_stages()
+        self.passes = self._plan_passes()
+
+
+    @staticmethod
+    def from_file(path):
+        """
+            Plan the recipe of a json or yaml file, with paths relative to the file
+        """
+        return Pipeline(load_recipe(path), os.path.dirname(os.path.abspath(path)))
+
+
+    def __repr__(self):
+        return "Pipeline_%d_stages_%d_passes" % (len(self.stages), len(self.passes))
+
+
+    def _path(self, path):
+        return os.path.join(self.base_dir, os.path.expanduser(path))
+
+
+    def _parse_indices(self, indices):
+        """
+            Return: OrderedDict of {index name: expression}
+        """
+        if not isinstance(indices, dict):
+            indices = OrderedDict((name, None) for name in indices)
+
+        expressions = OrderedDict()
+        for name in sorted(indices):
+            expression = indices[name] or INDEX_EXPRESSIONS.get(name)
+            if expression is None:
+                raise ValueError("Index %s is not in INDEX_EXPRESSIONS, give its expression" % name)
+            expressions[name] = expression
+
+        return expressions
+
+
+    def _parse_outputs(self, outputs):
+        """
+            Check the outputs and fill in their defaults
+            Return: list of output dictionaries
+        """
+        if outputs is None:
+            outputs = [{"source": name, "type": output} for name in self.expressions for output in ("gray", "colour")]
+
+        parsed = []
+        paths = set()
+        for output in outputs:
+            output = dict(output)
+            source, output_type = output.get("source"), output.get("type", "gray")
+
+            if output_type not in OUTPUT_TYPES:
+                raise ValueError("Unknown output type %s, use %s" % (output_type, ", ".join(OUTPUT_TYPES)))
+            if output_type == "raster" and source not in self.bands:
+                raise ValueError("Raster output %s is not one of the bands" % source)
+            if output_type != "raster" and source not in self.expressions:
+                raise ValueError("%s output %s is not one of the indices" % (output_type, source))
+
+            output["type"] = output_type
+            output["format"] = output.get("format", self.output_type)
+            output["path"] = os.path.join(self.output_dir, output.get("path") or "%s_%s.tif" % (source.lower(), output_type))
+
+            if output["format"] not in OUTPUT_FORMATS:
+                raise ValueError("Unknown output format %s, use %s" % (output["format"], ", ".join(OUTPUT_FORMATS)))
+            if output_type == "gray" and output.setdefault("storage", "float32") not in ("float32", "int16"):
+                raise ValueError("Unknown index storage %s, use float32 or int16" % output["storage"])
+            if output_type == "colour" and output.setdefault("colour_scale", "RdYlGn") not in COLOUR_SCALES:
+                raise ValueError("Unknown colour scale %s, use %s" % (output["colour_scale"], ", ".join(sorted(COLOUR_SCALES))))
+            if output["path"] in paths:
+                raise ValueError("Two outputs are saved to %s" % output["path"])
+
+            output.setdefault("paletted", False)
+            paths.add(output["path"])
+            parsed.append(output)
+
+        return parsed
+
+
+    def _build_stages(self):
+        """
+            Make the DAG. Stages are added after their inputs, so the dictionary is in dependency order
+            Return: OrderedDict of {stage name: Stage}
+        """
+        stages = OrderedDict()
+        plan = compile_expressions(self.expressions) if self.expressions else None
+
+        missing = [band for band in (plan.bands if plan else []) if band not in self.bands]
+        if missing:
+            raise ValueError("The indices need bands %s which are not in the recipe" % ", ".join(missing))
+
+        # only read the bands something uses
+        used = set(plan.bands if plan else []) | set(output["source"] for output in self.outputs if output["type"] == "raster")
+        for band in sorted(used):
+            stages["read:" + band] = Stage("read:" + band, "read", band=band, path=self.bands[band])
+
+        mask = []
+        if self.aoi:
+            stages["mask:aoi"] = Stage("mask:aoi", "mask", path=self.aoi)
+            mask = ["mask:aoi"]
+
+        for name, expression in self.expressions.items():
+            index_bands = compile_expressions({name: expression}).bands
+            stages["index:" + name] = Stage("index:" + name, "index", ["read:" + band for band in index_bands] + mask,
+                                            index=name, expression=expression)
+
+        for output in self.outputs:
+            stage_name = "%s:%s" % (output["type"], os.path.basename(output["path"]))
+
+            if output["type"] == "raster":
+                stages[stage_name] = Stage(stage_name, "raster", ["read:" + output["source"]] + mask, **output)
+
+            elif output["type"] == "gray":
+                stages[stage_name] = Stage(stage_name, "gray", ["index:" + output["source"]], **output)
+
+            else:
+                stretch_name = "stretch:" + output["source"]
+                if stretch_name not in stages:
+                    stages[stretch_name] = Stage(stretch_name, "stretch", ["index:" + output["source"]])
+                stages[stage_name] = Stage(stage_name, "colour", ["index:" + output["source"], stretch_name], **output)
+
+        return stages
+
+
+    def _plan_passes(self):
+        """
+            Fuse the stages into streaming passes: a stage runs in the pass of its inputs,
+            unless one of them is a reduction, which has to finish first
+            Return: list of passes, each a list of stage names in dependency order
+        """
+        levels = {}
+        for name, stage in self.stages.items():
+            levels[name] = max([levels[input_name] + (1 if self.stages[input_name].kind in REDUCTIONS else 0)
+                                for input_name in stage.inputs] or [0])
+
+        passes = [[] for _ in range(max(levels.values()) + 1)] if levels else []
+        for name in self.stages:
+            passes[levels[name]].append(name)
+
+        return passes
+
+
+    def describe(self):
+        """
+            Return a readable summary of the planned passes
+        """
+        lines = []
+        for pass_idx, names in enumerate(self.passes, 1):
+            lines.append("pass %d: %s" % (pass_idx, ", ".join(names)))
+        return "\n".join(lines)
+
+
+
+    def _build_grid(self, work_dir):
+        """
+            Line the read bands up on the target grid: single band sources are stacked into one VRT, multi band
+            sources (eg. TCI) get a VRT each, all over the same bounds and resolution. The VRTs are written to
+            work_dir so every streaming thread can open its own handle.
+            Return: dictionary of {read stage name (and "mask:aoi"): list of gdal bands}, the grid dataset
+            and the list of datasets the bands belong to (keep them open while the bands are used)
+        """
+        reads = [stage for stage in self.stages.values() if stage.kind == "read"]
+        sources = OrderedDict()
+        for stage in reads:
+            in_ds = open_dataset(stage.params["path"])
+            if in_ds is None:
+                raise ValueError("Could not open band %s at %s" % (stage.params["band"], stage.params["path"]))
+            sources[stage.name] = in_ds
+
+        first_ds = sources.values()[0]
+        projection = first_ds.GetProjection()
+        srs = _srs_from_wkt(projection)
+        for name, in_ds in sources.items():
+            if not srs.IsSame(_srs_from_wkt(in_ds.GetProjection())):
+                raise ValueError("%s is not in the projection of the other bands, resize it with Bands first" % name)
+
+        resolution = self.resolution or min(abs(in_ds.GetGeoTransform()[1]) for in_ds in sources.values())
+
+        gt = first_ds.GetGeoTransform()
+        min_x, max_y = gt[0], gt[3]
+        max_x, min_y = gt[0] + gt[1] * first_ds.RasterXSize, gt[3] + gt[5] * first_ds.RasterYSize
+
+        if self.aoi:
+            cutline = Cutline(self.aoi)
+            aoi_min_x, aoi_max_x, aoi_min_y, aoi_max_y = cutline.bounds_for(projection)
+
+            # snap outwards onto the target resolution, anchored at the bands' corner
+            min_x = max(min_x, gt[0] + np.floor((aoi_min_x - gt[0]) / resolution) * resolution)
+            max_x = min(max_x, gt[0] + np.ceil((aoi_max_x - gt[0]) / resolution) * resolution)
+            max_y = min(max_y, gt[3] - np.floor((gt[3] - aoi_max_y) / resolution) * resolution)
+            min_y = max(min_y, gt[3] - np.ceil((gt[3] - aoi_min_y) / resolution) * resolution)
+
+            if max_x <= min_x or max_y <= min_y:
+                raise ValueError("The area of interest %s does not overlap the bands" % self.aoi)
+
+        options = dict(outputBounds=(min_x, min_y, max_x, max_y), xRes=resolution, yRes=resolution, resampleAlg=self.resampling)
+
+        bands = {}
+        datasets = []
+        stacked = [name for name, in_ds in sources.items() if in_ds.RasterCount == 1]
+
+        if stacked:
+            stack_ds = gdal.BuildVRT(os.path.join(work_dir, "stack.vrt"), [self.stages[name].params["path"] for name in stacked], separate=True, **options)
+            stack_ds.FlushCache()
+            datasets.append(stack_ds)
+            for band_idx, name in enumerate(stacked, 1):
+                bands[name] = [stack_ds.GetRasterBand(band_idx)]
+
+        for name, in_ds in sources.items():
+            if name not in bands:
+                vrt_ds = gdal.BuildVRT(os.path.join(work_dir, "%s.vrt" % self.stages[name].params["band"]), [self.stages[name].params["path"]], **options)
+                vrt_ds.FlushCache()
+                datasets.append(vrt_ds)
+                bands[name] = [vrt_ds.GetRasterBand(band_idx) for band_idx in range(1, vrt_ds.RasterCount + 1)]
+
+        grid_ds = datasets[0]
+
+        if self.aoi:
+            inside = cutline.mask(grid_ds.RasterXSize, grid_ds.RasterYSize, grid_ds.GetGeoTransform(), projection)
+            mask_ds = create_output_ds(grid_ds, 1, gdal.GDT_Byte, output_type="MEM")
+            mask_ds.GetRasterBand(1).WriteArray(inside.astype(np.uint8))
+            datasets.append(mask_ds)
+            bands["mask:aoi"] = [mask_ds.GetRasterBand(1)]
+
+        return bands, grid_ds, datasets
+
+
+
+    def _create_output(self, stage, grid_ds, source_bands):
+        """
+            Create the dataset an output stage writes its blocks to. COGs are written to memory then copied
+            with write_cog at the end, as a cog can't be written block by block
+        """
+        params = stage.params
+        ds_path, ds_type = (None, "MEM") if params["format"] == "COG" else (params["path"], "GTiff")
+
+        if stage.kind == "gray":
+            return create_index_ds(grid_ds, params["storage"], ds_path, ds_type)
+
+        if stage.kind == "colour":
+            return create_colour_ds(grid_ds, colour_lut(params["colour_scale"]), params["paletted"], ds_path, ds_type)
+
+        no_data = source_bands[0].GetNoDataValue()
+        if no_data is None and self.aoi:
+            no_data = 0
+        return create_output_ds(grid_ds, len(source_bands), source_bands[0].DataType, ds_path, ds_type, no_data_value=no_data)
+
+
+
+    def _run_pass(self, names, state, threads):
+        """
+            Stream one fused pass over the grid. Every input band is read once per window, the pass' indices are
+            evaluated together, and every output (and every index a later pass needs) is written from the same window.
+            Reductions of the pass (stretches) keep the range of their index while streaming and finish afterwards
+        """
+        stages = [self.stages[name] for name in names]
+        in_pass = set(names)
+
+        # inputs from the grid or from earlier passes. Reductions hand over a result, not bands
+        in_keys, in_bands = [], []
+        for name in OrderedDict((input_name, None) for stage in stages for input_name in stage.inputs):
+            if self.stages[name].kind in REDUCTIONS or (name in in_pass and self.stages[name].kind not in ("read", "mask")):
+                continue
+            for band in state["bands"][name]:
+                in_keys.append(name)
+                in_bands.append(band)
+
+        index_stages = [stage for stage in stages if stage.kind == "index"]
+        plan = compile_expressions(dict((stage.params["index"], stage.params["expression"]) for stage in index_stages)) if index_stages else None
+
+        # outputs of the pass, plus the indices that later passes or reductions need
+        out_stages = [stage for stage in stages if stage.kind in ("gray", "raster", "colour")]
+        for stage in out_stages:
+            state["datasets"][stage.name] = self._create_output(stage, state["grid"], state["bands"].get(stage.inputs[0]))
+
+        materialise = []
+        for stage in index_stages:
+            consumers = [other for other in self.stages.values() if stage.name in other.inputs]
+            if any(other.name not in in_pass or other.kind in REDUCTIONS for other in consumers):
+                reuse = [other for other in consumers if other.kind == "gray" and other.params["storage"] == "float32" and other.name in in_pass]
+                if reuse:
+                    state["open"].append(state["datasets"][reuse[0].name])
+                    state["bands"][stage.name] = [state["datasets"][reuse[0].name].GetRasterBand(1)]
+                else:
+                    scratch_ds = create_output_ds(state["grid"], 1, gdal.GDT_Float32, os.path.join(state["work_dir"], "%s.tif" % stage.params["index"]),
+                                                  no_data_value=np.nan)
+                    state["open"].append(scratch_ds)
+                    state["bands"][stage.name] = [scratch_ds.GetRasterBand(1)]
+                    materialise.append(stage)
+
+        out_bands = []
+        for stage in out_stages:
+            out_ds = state["datasets"][stage.name]
+            out_bands.extend(out_ds.GetRasterBand(band_idx) for band_idx in range(1, out_ds.RasterCount + 1))
+        out_bands.extend(state["bands"][stage.name][0] for stage in materialise)
+
+        stretches = [stage for stage in stages if stage.kind in REDUCTIONS]
+        ranges = dict((stage.name, [np.inf, -np.inf]) for stage in stretches)
+        ranges_lock = threading.Lock()
+        luts = dict((stage.name, colour_lut(stage.params["colour_scale"])) for stage in out_stages if stage.kind == "colour")
+        no_data = dict((stage.name, state["datasets"][stage.name].GetRasterBand(1).GetNoDataValue()) for stage in out_stages if stage.kind == "raster")
+
+        def process(*blocks):
+            values = {}
+            for name, block in zip(in_keys, blocks):
+                values.setdefault(name, []).append(block)
+
+            outside = ~values["mask:aoi"][0].astype(bool) if "mask:aoi" in values else None
+
+            if plan is not None:
+                results = plan.evaluate(dict((band, values["read:" + band][0]) for band in plan.bands), np.float32)
+                for stage in index_stages:
+                    index = results[stage.params["index"]]
+                    if outside is not None:
+                        index[outside] = np.nan
+                    values[stage.name] = [index]
+
+            for stage in stretches:
+                index = values[stage.inputs[0]][0]
+                finite = index[np.isfinite(index)]
+                if finite.size:
+                    with ranges_lock:
+                        ranges[stage.name][0] = min(ranges[stage.name][0], float(finite.min()))
+                        ranges[stage.name][1] = max(ranges[stage.name][1], float(finite.max()))
+
+            out_blocks = []
+            for stage in out_stages:
+                if stage.kind == "gray":
+                    out_blocks.append(encode_index(values[stage.inputs[0]][0], stage.params["storage"]))
+
+                elif stage.kind == "colour":
+                    low, high = state["stretches"][stage.inputs[1]]
+                    indices = quantize(values[stage.inputs[0]][0], low, high)
+                    out_blocks.extend(colour_blocks(indices, luts[stage.name], stage.params["paletted"]))
+
+                else:
+                    for block in values[stage.inputs[0]]:
+                        if outside is not None:
+                            block = block.copy()
+                            block[outside] = no_data[stage.name]
+                        out_blocks.append(block)
+
+            for stage in materialise:
+                out_blocks.append(values[stage.name][0])
+
+            return out_blocks
+
+        with span("compute", "pipeline_pass", stages=len(stages)) as pass_span:
+            stream_blocks(in_bands, out_bands, process, self.block_size, threads)
+            pass_span.add(pixels=state["grid"].RasterXSize * state["grid"].RasterYSize * len(stages))
+
+        for stage in materialise:
+            state["bands"][stage.name][0].FlushCache()
+
+        for stage in out_stages:
+            out_ds = state["datasets"].pop(stage.name)
+            out_ds.FlushCache()
+            if stage.params["format"] == "COG":
+                write_cog(out_ds, stage.params["path"])
+
+        for stage in stretches:
+            state["stretches"][stage.name] = self._stretch(state["bands"][stage.inputs[0]][0], ranges[stage.name])
+
+
+
+    def _stretch(self, band, value_range):
+        """
+            Find the stretch percentiles of an index from a histogram accumulated block by block over its
+            float32 band, like colour.histogram_percentiles over the whole raster
+            Return: (low, high)
+        """
+        low, high = value_range
+        if low > high:
+            # every pixel is NaN, quantize makes them all no data
+            return 0.0, 0.0
+        if low == high:
+            return low, high
+
+        counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        for window in block_windows(band.XSize, band.YSize, self.block_size[0], self.block_size[1]):
+            block = band.ReadAsArray(*window)
+            block_counts, edges = np.histogram(block[np.isfinite(block)], HISTOGRAM_BINS, range=(low, high))
+            counts += block_counts
+
+        return tuple(percentiles_from_histogram(counts, edges, STRETCH_PERCENTILES))
+
+
+
+    @instrumented("granule", "pipeline")
+    def run(self, threads=None):
+        """
+            Run the planned passes.
+            Input: number of threads to stream each pass with (defaults to the recipe's threads)
+            Return: OrderedDict of {output stage name: saved path}
+        """
+        threads = threads or self.threads
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        # VRTs and the float32 indices colour passes read, removed at the end
+        work_dir = tempfile.mkdtemp(prefix=".pipeline_", dir=self.output_dir)
+
+        try:
+            bands, grid_ds, datasets = self._build_grid(work_dir)
+
+            # datasets are kept in "open" while their bands are in "bands", outputs in "datasets" until their pass ends
+            state = {"bands": bands, "grid": grid_ds, "open": datasets, "work_dir": work_dir, "datasets": {}, "stretches": {}}
+            for names in self.passes:
+                self._run_pass(names, state, threads)
+
+            # drop every handle before the scratch files go
+            state.clear()
+
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        return OrderedDict((name, stage.params["path"]) for name, stage in self.stages.items() if stage.kind in OUTPUT_TYPES)
+
+
+
+def main(argv=None):
+    """
+        Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Process a scene from a json or yaml recipe")
+    parser.add_argument("recipe", help="recipe file")
+    parser.add_argument("--threads", type=int, default=None, help="threads to stream each pass with (default: the recipe's, or 1)")
+    parser.add_argument("--plan", action="store_true", help="only print the planned passes")
+    args = parser.parse_args(argv)
+
+    pipeline = Pipeline.from_file(args.recipe)
+    print pipeline.describe()
+
+    if not args.plan:
+        for name, path in pipeline.run(args.threads).items():
+            print "Saved %s" % path
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
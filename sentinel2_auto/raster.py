@@ -0,0 +1,225 @@
+from osgeo import gdal_array
+import numpy as np
+import os
+
+
+
+def gdal_to_numpy_dtype(gdal_type):
+    """
+        Translate a gdal data type code (eg. gdal.GDT_UInt16) to a numpy dtype
+    """
+    return np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(gdal_type))
+
+
+
+def block_windows(xsize, ysize, block_xsize, block_ysize):
+    """
+        Generate the (xoff, yoff, xsize, ysize) windows that cover a raster of size xsize by ysize,
+        walking it in blocks of block_xsize by block_ysize. Edge windows are clipped to the raster.
+    """
+    for yoff in range(0, ysize, block_ysize):
+        win_ysize = min(block_ysize, ysize - yoff)
+
+        for xoff in range(0, xsize, block_xsize):
+            win_xsize = min(block_xsize, xsize - xoff)
+            yield xoff, yoff, win_xsize, win_ysize
+
+
+
+class LazyRaster(object):
+    """
+        Proxy for the raster data of a gdal dataset.
+        Nothing is read on creation - slicing the proxy reads only the requested window through
+        gdal's ReadAsArray(xoff, yoff, xsize, ysize) and the data keeps the dataset's native dtype.
+        The shape follows GeoTiff.raster_data: (rows, cols) for one band, (rows, cols, bands) otherwise.
+    """
+
+    def __init__(self, in_ds):
+        self.in_ds = in_ds
+        self.raster_count = in_ds.RasterCount
+        self.dtype = gdal_to_numpy_dtype(in_ds.GetRasterBand(1).DataType)
+
+        if self.raster_count > 1:
+            self.shape = (in_ds.RasterYSize, in_ds.RasterXSize, self.raster_count)
+        else:
+            self.shape = (in_ds.RasterYSize, in_ds.RasterXSize)
+
+        # gdal reports the block size as (xsize, ysize)
+        self.block_size = tuple(in_ds.GetRasterBand(1).GetBlockSize())
+
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __repr__(self):
+        return "LazyRaster(shape=%s, dtype=%s)" % (self.shape, self.dtype)
+
+
+    def __array__(self, dtype=None):
+        """
+            Let numpy materialise the proxy, eg. np.asarray(lazy_raster)
+        """
+        if dtype is None:
+            return self.materialise()
+        return self.materialise().astype(dtype, copy=False)
+
+
+    def read_window(self, xoff, yoff, xsize, ysize, band_list=None):
+        """
+            Read a window of the raster.
+            Returns a (ysize, xsize) array for a single band raster (or a single entry band_list),
+            otherwise a (ysize, xsize, bands) array.
+        """
+        if band_list is None:
+            band_list = range(1, self.raster_count + 1)
+
+        if len(band_list) == 1:
+            return self.in_ds.GetRasterBand(band_list[0]).ReadAsArray(xoff, yoff, xsize, ysize)
+
+        window = np.empty((ysize, xsize, len(band_list)), dtype=self.dtype)
+        for idx, band in enumerate(band_list):
+            window[:, :, idx] = self.in_ds.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+
+        return window
+
+
+    def iter_blocks(self, block_size=None):
+        """
+            Generate (xoff, yoff, xsize, ysize) windows following the dataset's native block size,
+            or a user defined (xsize, ysize) block size
+        """
+        block_xsize, block_ysize = block_size or self.block_size
+        return block_windows(self.shape[1], self.shape[0], block_xsize, block_ysize)
+
+
+    def materialise(self):
+        """
+            Read the full raster into memory. This is the only method that reads everything
+        """
+        return self.read_window(0, 0, self.shape[1], self.shape[0])
+
+
+    def astype(self, dtype, copy=True):
+        """
+            Materialise the raster as a numpy array of dtype. Kept so code written for
+            in memory numpy rasters works unchanged
+        """
+        return self.materialise().astype(dtype, copy=False)
+
+
+    def __getitem__(self, key):
+        """
+            Support basic numpy indexing (ints and slices) over rows, cols and bands by reading
+            only the covering window. Anything fancier falls back to a full read.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if any(not isinstance(k, (int, long, slice)) for k in key) or len(key) > self.ndim:
+            return self.materialise()[key]
+
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # find the window to read along each axis and the indexing to apply to it afterwards
+        starts, sizes, post = [], [], []
+        for axis, k in enumerate(key):
+            length = self.shape[axis]
+
+            if isinstance(k, slice):
+                start, stop, step = k.indices(length)
+                if step < 0:
+                    return self.materialise()[key]
+                count = max(0, stop - start)
+                starts.append(start)
+                sizes.append(count)
+                post.append(slice(None, None, step))
+            else:
+                if k < 0:
+                    k += length
+                if not 0 <= k < length:
+                    raise IndexError("index %d is out of bounds for axis %d with size %d" % (k, axis, length))
+                starts.append(k)
+                sizes.append(1)
+                post.append(0)
+
+        if 0 in sizes:
+            empty_shape = [len(range(0, size, p.step or 1)) for size, p in zip(sizes, post) if isinstance(p, slice)]
+            return np.empty(empty_shape, dtype=self.dtype)
+
+        band_list = None
+        if self.ndim == 3:
+            band_list = range(starts[2] + 1, starts[2] + sizes[2] + 1)
+
+        window = self.read_window(starts[1], starts[0], sizes[1], sizes[0], band_list)
+        if self.ndim == 3 and window.ndim == 2:
+            window = window[:, :, np.newaxis]
+
+        return window[tuple(post)]
+
+
+
+def memmap_raster(in_ds):
+    """
+        Memory map the pixels of an uncompressed, striped geotiff straight from its file.
+        This only works when the strips are stored back to back in row order, with one band
+        or pixel interleaved bands - which is how gdal writes uncompressed, untiled geotiffs.
+        The map is copy on write, so changing the array never changes the file.
+        Return: np.memmap shaped like GeoTiff.raster_data, or None if the file cannot be mapped
+    """
+    path = in_ds.GetDescription()
+    band = in_ds.GetRasterBand(1)
+
+    if in_ds.GetDriver().ShortName != "GTiff" or not os.path.isfile(path):
+        return None
+
+    if in_ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") or band.GetMetadataItem("NBITS", "IMAGE_STRUCTURE"):
+        return None
+
+    if in_ds.RasterCount > 1 and in_ds.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE") != "PIXEL":
+        return None
+
+    # strips span the full width
+    block_xsize, block_ysize = band.GetBlockSize()
+    if block_xsize != in_ds.RasterXSize:
+        return None
+
+    dtype = gdal_to_numpy_dtype(band.DataType)
+    strip_bytes = block_ysize * in_ds.RasterXSize * in_ds.RasterCount * dtype.itemsize
+    strip_count = (in_ds.RasterYSize + block_ysize - 1) // block_ysize
+
+    first_offset = band.GetMetadataItem("BLOCK_OFFSET_0_0", "TIFF")
+    if first_offset is None:
+        return None
+    first_offset = int(first_offset)
+
+    for strip in range(1, strip_count):
+        offset = band.GetMetadataItem("BLOCK_OFFSET_0_%d" % strip, "TIFF")
+        if offset is None or int(offset) != first_offset + strip * strip_bytes:
+            return None
+
+    # the byte order is set by the first two bytes of a tiff
+    with open(path, "rb") as tiff:
+        byte_order = "<" if tiff.read(2) == b"II" else ">"
+
+    if in_ds.RasterCount > 1:
+        shape = (in_ds.RasterYSize, in_ds.RasterXSize, in_ds.RasterCount)
+    else:
+        shape = (in_ds.RasterYSize, in_ds.RasterXSize)
+
+    return np.memmap(path, dtype=dtype.newbyteorder(byte_order), mode="c", offset=first_offset, shape=shape)
@@ -0,0 +1,485 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Reusable reprojection plans for the fixed sentinel 2 tile grids
+
+    Sentinel 2 tiles sit on a fixed MGRS grid, so the same (source grid, target grid) pair comes up for every scene
+    of a tile. A WarpPlan works out once where the target pixels fall in the source grid: exactly on a coarse lattice
+    of target pixels, refined until interpolating between lattice points is within max_error pixels of the exact
+    mapping (the approximation gdal's warper makes). Only that lattice is kept, and saved to disk named by tile ID.
+    Applying a plan to a new scene is a vectorised numpy gather (nearest) or four pixel blend (bilinear), in strips.
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from osgeo import osr
+from cutline import _srs_from_wkt
+from coordinates import apply_geo_transform, invert_geo_transform
+
+
+
+# largest distance (in source pixels) between the interpolated and the exact mapping, like gdal.Warp's error threshold
+DEFAULT_MAX_ERROR = 0.125
+
+# starting spacing (in target pixels) of the lattice the mapping is computed exactly on
+DEFAULT_LATTICE_STEP = 64
+
+# plans kept in memory by a WarpPlanCache
+DEFAULT_MAX_PLANS = 16
+
+# target rows remapped at a time, bounding the temporary coordinate arrays
+REMAP_BLOCK_ROWS = 256
+
+RESAMPLING = ("nearest", "bilinear")
+
+
+
+def _srs(projection):
+    """
+        Make an osr spatial reference from wkt or anything SetFromUserInput takes (eg. "EPSG:4326")
+    """
+    if projection.lstrip().startswith(("GEOGCS", "PROJCS", "GEOGCRS", "PROJCRS", "COMPD")):
+        return _srs_from_wkt(projection)
+
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(projection)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+
+class Grid(object):
+    """
+        A raster grid: its size, geotransform and projection (wkt)
+    """
+
+    def __init__(self, xsize, ysize, geo_transform, projection):
+        self.xsize = int(xsize)
+        self.ysize = int(ysize)
+        self.geo_transform = tuple(float(value) for value in geo_transform)
+        self.projection = projection
+
+
+    @staticmethod
+    def of(in_ds):
+        """
+            Return the grid of a gdal dataset
+        """
+        return Grid(in_ds.RasterXSize, in_ds.RasterYSize, in_ds.GetGeoTransform(), in_ds.GetProjection())
+
+
+    def __repr__(self):
+        return "Grid_%dx%d" % (self.xsize, self.ysize)
+
+
+    def __eq__(self, other):
+        return isinstance(other, Grid) and self.describe() == other.describe()
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def describe(self):
+        """
+            Return a json serialisable description of the grid (geotransform rounded to a micro pixel)
+        """
+        rounded = [round(value, 9) for value in self.geo_transform]
+        return [self.xsize, self.ysize, rounded, self.projection]
+
+
+    def apply_to(self, out_ds):
+        """
+            Set the geotransform and projection of a dataset to the grid's
+        """
+        out_ds.SetGeoTransform(self.geo_transform)
+        out_ds.SetProjection(self.projection)
+
+
+
+def target_grid(src_grid, projection="EPSG:4326", shape=None, pixel_size=None, bounds=None):
+    """
+        Work out the grid a source grid is reprojected to.
+        Input: source Grid, target projection, optional (rows, cols) shape or (x, y) pixel size in target units,
+        optional (min_x, min_y, max_x, max_y) bounds in the target projection (like gdal.Warp's outputBounds).
+        Without bounds the target covers the whole source, found by transforming points along its edges.
+        Without a shape or pixel size, the target keeps as many pixels along its diagonal as the source has
+        (as gdal.Warp does)
+        Return: Grid
+    """
+    if projection != src_grid.projection:
+        projection = _srs(projection).ExportToWkt()
+
+    if bounds is None:
+        samples = np.linspace(0, 1, 21)
+        rows = np.concatenate([samples * 0, samples, samples * 0 + 1, samples]) * src_grid.ysize
+        cols = np.concatenate([samples, samples * 0, samples, samples * 0 + 1]) * src_grid.xsize
+
+        ys, xs = apply_geo_transform(src_grid.geo_transform, rows, cols)
+        xs, ys = _transform_points(src_grid.projection, projection, xs, ys)
+        finite = np.isfinite(xs) & np.isfinite(ys)
+        if not finite.any():
+            raise ValueError("The source grid can't be transformed to %s" % projection)
+
+        bounds = (xs[finite].min(), ys[finite].min(), xs[finite].max(), ys[finite].max())
+
+    min_x, min_y, max_x, max_y = [float(value) for value in bounds]
+
+    if shape is not None:
+        ysize, xsize = int(shape[0]), int(shape[1])
+        pixel_x, pixel_y = (max_x - min_x) / xsize, (max_y - min_y) / ysize
+
+    else:
+        if pixel_size is None:
+            pixel = np.hypot(max_x - min_x, max_y - min_y) / np.hypot(src_grid.xsize, src_grid.ysize)
+            pixel_size = (pixel, pixel)
+
+        pixel_x, pixel_y = [abs(float(value)) for value in pixel_size]
+        xsize = max(1, int(np.ceil((max_x - min_x) / pixel_x - 1e-6)))
+        ysize = max(1, int(np.ceil((max_y - min_y) / pixel_y - 1e-6)))
+
+    return Grid(xsize, ysize, (min_x, pixel_x, 0.0, max_y, 0.0, -pixel_y), projection)
+
+
+
+def _transform_points(src_projection, dst_projection, xs, ys):
+    """
+        Transform arrays of points between projections. Points that fail to transform are NaN
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if src_projection == dst_projection:
+        return xs, ys
+
+    src_srs, dst_srs = _srs(src_projection), _srs(dst_projection)
+    if src_srs.IsSame(dst_srs):
+        return xs, ys
+
+    transformation = osr.CoordinateTransformation(src_srs, dst_srs)
+    points = np.array(transformation.TransformPoints(np.column_stack([xs.ravel(), ys.ravel()]).tolist()), dtype=np.float64)
+    points[~np.isfinite(points)] = np.nan
+    return points[:, 0].reshape(xs.shape), points[:, 1].reshape(ys.shape)
+
+
+
+def _lattice(size, step):
+    """
+        Positions of the lattice along one axis: every step pixels, and always the last pixel
+    """
+    positions = np.unique(np.concatenate([np.arange(0, size, step), [size - 1]]))
+    return positions if len(positions) > 1 else np.array([0, 1])
+
+
+
+def _weights(positions, targets):
+    """
+        Find the lattice interval each target position falls in and how far along it
+    """
+    idx = np.clip(np.searchsorted(positions, targets, side="right") - 1, 0, len(positions) - 2)
+    weight = (targets - positions[idx]) / (positions[idx + 1] - positions[idx]).astype(np.float64)
+    return idx, weight
+
+
+
+def _interpolate(lattice, row_positions, col_positions, rows, cols):
+    """
+        Bilinearly interpolate lattice values (one per (row position, col position)) at every (rows x cols) pixel
+    """
+    row_idx, row_weight = _weights(row_positions, np.asarray(rows, dtype=np.float64))
+    col_idx, col_weight = _weights(col_positions, np.asarray(cols, dtype=np.float64))
+
+    top = lattice[row_idx]
+    bottom = lattice[row_idx + 1]
+    top = top[:, col_idx] * (1 - col_weight) + top[:, col_idx + 1] * col_weight
+    bottom = bottom[:, col_idx] * (1 - col_weight) + bottom[:, col_idx + 1] * col_weight
+
+    return top * (1 - row_weight)[:, np.newaxis] + bottom * row_weight[:, np.newaxis]
+
+
+
+class WarpPlan(object):
+    """
+        Where the pixels of a target grid fall in a source grid, kept as the exact fractional source (row, col)
+        of the target pixel centres on a lattice of target pixels
+    """
+
+    def __init__(self, src_grid, dst_grid, row_positions, col_positions, src_rows, src_cols, max_error=DEFAULT_MAX_ERROR):
+        self.src_grid = src_grid
+        self.dst_grid = dst_grid
+        self.row_positions = row_positions
+        self.col_positions = col_positions
+        self.src_rows = src_rows
+        self.src_cols = src_cols
+        self.max_error = max_error
+
+
+    def __repr__(self):
+        return "WarpPlan_%r_to_%r_lattice_%dx%d" % (self.src_grid, self.dst_grid, len(self.col_positions), len(self.row_positions))
+
+
+    @staticmethod
+    def key(src_grid, dst_grid, max_error=DEFAULT_MAX_ERROR):
+        """
+            Identify the plan of a (source grid, target grid) pair
+        """
+        description = json.dumps([src_grid.describe(), dst_grid.describe(), max_error], sort_keys=True)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+    @staticmethod
+    def build(src_grid, dst_grid, max_error=DEFAULT_MAX_ERROR, step=DEFAULT_LATTICE_STEP):
+        """
+            Compute the plan of a (source grid, target grid) pair. The lattice is halved until interpolating it
+            halfway between lattice points is within max_error source pixels of the exact mapping
+        """
+        inverse = invert_geo_transform(src_grid.geo_transform)
+
+        def exact(rows, cols):
+            # source (row, col) of target pixel centres
+            grid_rows, grid_cols = np.meshgrid(np.asarray(rows, dtype=np.float64) + 0.5, np.asarray(cols, dtype=np.float64) + 0.5, indexing="ij")
+            ys, xs = apply_geo_transform(dst_grid.geo_transform, grid_rows, grid_cols)
+            xs, ys = _transform_points(dst_grid.projection, src_grid.projection, xs, ys)
+            return apply_geo_transform(inverse, ys, xs)
+
+        while True:
+            row_positions = _lattice(dst_grid.ysize, step)
+            col_positions = _lattice(dst_grid.xsize, step)
+            src_rows, src_cols = exact(row_positions, col_positions)
+
+            if step <= 1:
+                break
+
+            # check midway between the lattice points, where the interpolation is worst
+            mid_rows = (row_positions[:-1] + row_positions[1:]) / 2.0
+            mid_cols = (col_positions[:-1] + col_positions[1:]) / 2.0
+            exact_rows, exact_cols = exact(mid_rows, mid_cols)
+
+            with np.errstate(invalid="ignore"):
+                error = np.hypot(_interpolate(src_rows, row_positions, col_positions, mid_rows, mid_cols) - exact_rows,
+                                 _interpolate(src_cols, row_positions, col_positions, mid_rows, mid_cols) - exact_cols)
+
+            finite = np.isfinite(error)
+            if not finite.any() or error[finite].max() <= max_error:
+                break
+            step //= 2
+
+        return WarpPlan(src_grid, dst_grid, row_positions, col_positions, src_rows, src_cols, max_error)
+
+
+    def source_coordinates(self, row_start, row_end):
+        """
+            Return the fractional source (rows, cols) of the centres of target rows row_start to row_end, every column
+        """
+        rows = np.arange(row_start, row_end)
+        cols = np.arange(self.dst_grid.xsize)
+        return (_interpolate(self.src_rows, self.row_positions, self.col_positions, rows, cols),
+                _interpolate(self.src_cols, self.row_positions, self.col_positions, rows, cols))
+
+
+    def apply(self, data, resampling="bilinear", no_data_value=None, block_rows=REMAP_BLOCK_ROWS):
+        """
+            Remap a raster from the source grid to the target grid.
+            Input: (rows, cols) or (rows, cols, bands) np array on the source grid, "nearest" or "bilinear",
+            the no data value (left out of bilinear blends, like NaN)
+            Target pixels off the source are the no data value, or NaN for float rasters and 0 otherwise.
+            Return: np array on the target grid, in the source's dtype
+        """
+        if resampling not in RESAMPLING:
+            raise ValueError("Unknown resampling %s, use %s" % (resampling, ", ".join(RESAMPLING)))
+
+        data = np.asarray(data)
+        if data.shape[:2] != (self.src_grid.ysize, self.src_grid.xsize):
+            raise ValueError("The raster is %s but the plan's source grid is %dx%d" % (data.shape[:2], self.src_grid.ysize, self.src_grid.xsize))
+
+        fill = no_data_value
+        if fill is None:
+            fill = np.nan if data.dtype.kind == "f" else 0
+
+        out = np.empty((self.dst_grid.ysize, self.dst_grid.xsize) + data.shape[2:], dtype=data.dtype)
+
+        for row_start in range(0, self.dst_grid.ysize, block_rows):
+            row_end = min(row_start + block_rows, self.dst_grid.ysize)
+            src_rows, src_cols = self.source_coordinates(row_start, row_end)
+
+            strip = out[row_start:row_end]
+            strip[...] = fill
+
+            if resampling == "nearest":
+                self._nearest(data, src_rows, src_cols, strip)
+            else:
+                self._bilinear(data, src_rows, src_cols, strip, no_data_value)
+
+        return out
+
+
+    def _inside(self, src_rows, src_cols):
+        with np.errstate(invalid="ignore"):
+            return (src_rows >= 0) & (src_rows < self.src_grid.ysize) & (src_cols >= 0) & (src_cols < self.src_grid.xsize)
+
+
+    def _nearest(self, data, src_rows, src_cols, strip):
+        inside = self._inside(src_rows, src_cols)
+
+        # points on a pixel edge go to the pixel after it, despite the interpolation's rounding
+        rows = np.minimum(np.floor(src_rows[inside] + 1e-6).astype(np.int64), self.src_grid.ysize - 1)
+        cols = np.minimum(np.floor(src_cols[inside] + 1e-6).astype(np.int64), self.src_grid.xsize - 1)
+        strip[inside] = data[rows, cols]
+
+
+    def _bilinear(self, data, src_rows, src_cols, strip, no_data_value):
+        inside = self._inside(src_rows, src_cols)
+
+        # blend the four pixel centres around each point, clamped at the edges
+        ys = src_rows[inside] - 0.5
+        xs = src_cols[inside] - 0.5
+        row0, col0 = np.floor(ys), np.floor(xs)
+        row_weight, col_weight = ys - row0, xs - col0
+
+        row0 = row0.astype(np.int64)
+        col0 = col0.astype(np.int64)
+        row1 = np.clip(row0 + 1, 0, self.src_grid.ysize - 1)
+        col1 = np.clip(col0 + 1, 0, self.src_grid.xsize - 1)
+        row0 = np.clip(row0, 0, self.src_grid.ysize - 1)
+        col0 = np.clip(col0, 0, self.src_grid.xsize - 1)
+
+        total = 0
+        weights_sum = 0
+        for rows, cols, weight in ((row0, col0, (1 - row_weight) * (1 - col_weight)), (row0, col1, (1 - row_weight) * col_weight),
+                                   (row1, col0, row_weight * (1 - col_weight)), (row1, col1, row_weight * col_weight)):
+            values = data[rows, cols].astype(np.float64)
+            if values.ndim > 1:
+                weight = weight[:, np.newaxis]
+
+            valid = np.isfinite(values)
+            if no_data_value is not None:
+                valid &= values != no_data_value
+
+            weight = np.where(valid, weight, 0)
+            total = total + np.where(valid, values, 0) * weight
+            weights_sum = weights_sum + weight
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            blended = total / weights_sum
+
+        # points whose four pixels are all no data stay no data
+        blended = np.where(weights_sum > 0, blended, strip[inside].astype(np.float64))
+
+        if data.dtype.kind in "iu":
+            limits = np.iinfo(data.dtype)
+            blended = np.clip(np.rint(blended), limits.min, limits.max)
+
+        strip[inside] = blended.astype(data.dtype)
+
+
+    def save(self, path):
+        """
+            Save the plan as a .npz, written to a temporary file and renamed so readers never see half a plan
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as plan_file:
+            np.savez(plan_file, grids=np.array(json.dumps([self.src_grid.describe(), self.dst_grid.describe(), self.max_error])),
+                     row_positions=self.row_positions, col_positions=self.col_positions, src_rows=self.src_rows, src_cols=self.src_cols)
+        os.rename(tmp_path, path)
+
+
+    @staticmethod
+    def load(path):
+        """
+            Load a plan saved with save()
+        """
+        saved = np.load(path)
+        src_description, dst_description, max_error = json.loads(str(saved["grids"]))
+
+        src_grid = Grid(src_description[0], src_description[1], src_description[2], src_description[3])
+        dst_grid = Grid(dst_description[0], dst_description[1], dst_description[2], dst_description[3])
+        return WarpPlan(src_grid, dst_grid, saved["row_positions"], saved["col_positions"], saved["src_rows"], saved["src_cols"], max_error)
+
+
+
+class WarpPlanCache(object):
+    """
+        Warp plans kept in memory (least recently used out) and, given a directory, on disk,
+        as <tile ID>_<plan key>.npz so every scene of a tile reuses them
+    """
+
+    def __init__(self, plan_dir=None, max_plans=DEFAULT_MAX_PLANS):
+        self.plan_dir = plan_dir
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+        if plan_dir and not os.path.isdir(plan_dir):
+            os.makedirs(plan_dir)
+
+
+    def __repr__(self):
+        return "WarpPlanCache_%s" % self.plan_dir
+
+
+    def __len__(self):
+        return len(self._plans)
+
+
+    def _path(self, key, tile=None):
+        return os.path.join(self.plan_dir, "%s_%s.npz" % (tile or "grid", key[:20]))
+
+
+    def get(self, src_grid, dst_grid, tile=None, max_error=DEFAULT_MAX_ERROR):
+        """
+            Return the plan of a (source grid, target grid) pair, loading or building (and saving) it on a miss.
+            tile (eg. "56HLH") names the saved plan
+        """
+        key = WarpPlan.key(src_grid, dst_grid, max_error)
+
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self._plans[key] = plan
+                return plan
+
+        plan = None
+        path = self._path(key, tile) if self.plan_dir else None
+        if path and os.path.isfile(path):
+            plan = WarpPlan.load(path)
+
+        if plan is None:
+            plan = WarpPlan.build(src_grid, dst_grid, max_error)
+            if path:
+                plan.save(path)
+
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+
+        return plan
+
+
+    def clear(self):
+        """
+            Drop the plans held in memory (saved plans stay on disk)
+        """
+        with self._lock:
+            self._plans.clear()
+
+
+
+# plans shared by everything in this process that doesn't give its own cache
+_plans = WarpPlanCache()
+
+
+
+def default_plan_cache():
+    """
+        Return the process wide, in memory, WarpPlanCache
+    """
+    return _plans
@@ -0,0 +1,179 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from osgeo import gdal
+from raster import block_windows
+
+
+# strip organised rasters (eg. MEM datasets, striped geotiffs) report one row blocks.
+# Rows are grouped until a window holds at least this many pixels so the per block overhead stays small
+MIN_BLOCK_PIXELS = 1024 * 1024
+
+
+
+def stream_block_size(band, min_block_pixels=MIN_BLOCK_PIXELS):
+    """
+        Find the (xsize, ysize) block size to stream a gdal band with.
+        This is the band's native block size (eg. the JP2 tile size), with strips grouped into taller windows
+    """
+    block_xsize, block_ysize = band.GetBlockSize()
+
+    if block_xsize * block_ysize < min_block_pixels:
+        rows = max(1, min_block_pixels // block_xsize)
+        block_ysize = max(block_ysize, (rows // block_ysize) * block_ysize)
+
+    return block_xsize, block_ysize
+
+
+
+def stream_blocks(in_bands, out_bands, func, block_size=None, threads=1, open_options=None):
+    """
+        Walk gdal bands block by block.
+        For each window, the block of every input band is read and func(*blocks) is called.
+        func returns one block (or a list of blocks) which is written straight to the output band(s).
+        Only one block per band is held in memory at a time - or, with several threads, a couple of blocks per thread:
+        the threads read and compute blocks in parallel (gdal reads and large numpy operations release the GIL)
+        while this thread writes the results in order.
+        Inputs: list of gdal input bands, list of gdal output bands, per block function, optional (xsize, ysize),
+        number of threads, optional list of the gdal open options each input band's dataset was opened with
+        (eg. ["OVERVIEW_LEVEL=2"]) so the threads reopen the same view of the file
+    """
+    _check_same_size([(band.YSize, band.XSize) for band in in_bands])
+
+    if block_size is None:
+        block_size = stream_block_size(in_bands[0])
+
+    windows = block_windows(in_bands[0].XSize, in_bands[0].YSize, block_size[0], block_size[1])
+
+    if threads <= 1:
+        for window in windows:
+            _write_results(out_bands, window, func(*[band.ReadAsArray(*window) for band in in_bands]))
+        return
+
+    open_options = open_options or [None] * len(in_bands)
+    readers = [_thread_safe_reader(band, options) for band, options in zip(in_bands, open_options)]
+
+    def process(window):
+        return func(*[read(*window) for read in readers])
+
+    # bound the blocks in flight so memory stays at a few blocks per thread
+    max_in_flight = 2 * threads
+    in_flight = deque()
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for window in windows:
+            if len(in_flight) >= max_in_flight:
+                done_window, future = in_flight.popleft()
+                _write_results(out_bands, done_window, future.result())
+
+            in_flight.append((window, executor.submit(process, window)))
+
+        while in_flight:
+            done_window, future = in_flight.popleft()
+            _write_results(out_bands, done_window, future.result())
+    finally:
+        executor.shutdown(wait=True)
+
+
+
+def _check_same_size(shapes):
+    """
+        Raise a ValueError unless every input has the same (rows, cols), as blocks are cut from the first one
+    """
+    if len(set(shapes)) > 1:
+        raise ValueError("Inputs are not the same size (%s), resize them first" % ", ".join("%dx%d" % shape for shape in shapes))
+
+
+
+def _write_results(out_bands, window, results):
+    """
+        Write the result block(s) of one window to the output bands
+    """
+    if not isinstance(results, (list, tuple)):
+        results = [results]
+
+    for out_band, result in zip(out_bands, results):
+        out_band.WriteArray(result, window[0], window[1])
+
+
+
+def _open(path, open_options=None):
+    if open_options:
+        return gdal.OpenEx(path, gdal.OF_RASTER, open_options=list(open_options))
+    return gdal.Open(path)
+
+
+
+def _thread_safe_reader(band, open_options=None):
+    """
+        Make a read_window(xoff, yoff, xsize, ysize) function for a gdal band that can be called from any thread.
+        gdal dataset handles must not be shared between threads, so bands of files are reopened once per thread,
+        with the open options the band's dataset was opened with.
+        In memory bands can't be reopened and are read one thread at a time - as are bands whose file reopens at
+        another size (eg. an overview opened without its options), rather than reading the wrong pixels.
+    """
+    in_ds = band.GetDataset()
+    path = in_ds.GetDescription()
+    band_idx = band.GetBand()
+
+    reopenable = False
+    if os.path.isfile(path):
+        probe_ds = _open(path, open_options)
+        reopenable = probe_ds is not None and (probe_ds.RasterXSize, probe_ds.RasterYSize) == (band.XSize, band.YSize)
+        probe_ds = None
+
+    if reopenable:
+        local = threading.local()
+
+        def read_window(*window):
+            if not hasattr(local, "band"):
+                local.ds = _open(path, open_options)
+                local.band = local.ds.GetRasterBand(band_idx)
+            return local.band.ReadAsArray(*window)
+
+    else:
+        lock = threading.Lock()
+
+        def read_window(*window):
+            with lock:
+                return band.ReadAsArray(*window)
+
+    return read_window
+
+
+
+def map_blocks(arrays, func, out_arrays, block_rows=None, threads=1):
+    """
+        Evaluate func over in memory (rows, cols) arrays in horizontal strips spread over a thread pool.
+        func(*blocks) returns one block (or a list of blocks) which is copied into out_arrays.
+        The strips are disjoint, so the threads write their results without any locking.
+        Inputs: list of np arrays, per block function, list of preallocated output arrays,
+        rows per strip (defaults to MIN_BLOCK_PIXELS worth), number of threads
+    """
+    _check_same_size([tuple(array.shape[:2]) for array in arrays])
+
+    rows, cols = arrays[0].shape[:2]
+    block_rows = block_rows or max(1, MIN_BLOCK_PIXELS // max(cols, 1))
+
+    def process(yoff):
+        results = func(*[array[yoff:yoff + block_rows] for array in arrays])
+        if not isinstance(results, (list, tuple)):
+            results = [results]
+
+        for out_array, result in zip(out_arrays, results):
+            out_array[yoff:yoff + block_rows] = result
+
+    if threads <= 1:
+        for yoff in range(0, rows, block_rows):
+            process(yoff)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        # list() raises the first error of any block
+        list(executor.map(process, range(0, rows, block_rows)))
+    finally:
+        executor.shutdown(wait=True)
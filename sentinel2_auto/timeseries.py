@@ -0,0 +1,233 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Time series of one sentinel 2 tile and per pixel temporal compositing
+
+    The granules of a tile share one grid, so a TileStack walks that grid block by block: for each window it reads
+    the bands of every date, evaluates an index (eg. ndvi) into a (dates, rows, cols) block and reduces it over time.
+    Only one block per date is held in memory, so a year of imagery costs O(block x dates) rather than O(scene x dates).
+
+"""
+
+import warnings
+from datetime import datetime
+import numpy as np
+from osgeo import gdal
+from geoTiff import GeoTiff
+from georeferencing import create_output_ds
+from expressions import compile_expressions, INDEX_EXPRESSIONS
+from discovery import GranuleIndex, parse_band_filename
+from raster import block_windows
+
+
+
+# (xsize, ysize) window streamed through the stack - each date holds one float32 block of this size
+TIMESERIES_BLOCK_SIZE = (512, 512)
+
+# resampling of every date's bands onto the common grid (20 m bands are upsampled in the first date too)
+DATE_RESAMPLING = 'cubic'
+
+
+
+def _nan_max(stack, days):
+    # fmax ignores NaN unless every date is NaN
+    return np.fmax.reduce(stack, axis=0)
+
+
+def _nan_min(stack, days):
+    return np.fmin.reduce(stack, axis=0)
+
+
+def _max_date(stack, days):
+    # index (into TileStack.dates) of the date with the highest value, -1 where no date is valid
+    valid = ~np.isnan(stack)
+    filled = np.where(valid, stack, -np.inf)
+    result = filled.argmax(axis=0).astype(np.float32)
+    result[~valid.any(axis=0)] = -1
+    return result
+
+
+def _count(stack, days):
+    return (~np.isnan(stack)).sum(axis=0).astype(np.float32)
+
+
+def _mean(stack, days):
+    count = (~np.isnan(stack)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nansum(stack, axis=0) / count
+
+
+def _median(stack, days):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)     # all NaN pixels stay NaN
+        return np.nanmedian(stack, axis=0)
+
+
+def _slope(stack, days):
+    # least squares slope of value against time (per day), over each pixel's valid dates
+    valid = ~np.isnan(stack)
+    times = np.where(valid, days[:, np.newaxis, np.newaxis], 0)
+    values = np.where(valid, stack, 0)
+
+    count = valid.sum(axis=0)
+    sum_t = times.sum(axis=0)
+    sum_v = values.sum(axis=0)
+    sum_tt = (times * times).sum(axis=0)
+    sum_tv = (times * values).sum(axis=0)
+
+    denominator = count * sum_tt - sum_t * sum_t
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (count * sum_tv - sum_t * sum_v) / denominator
+    slope[(count < 2) | (denominator == 0)] = np.nan
+    return slope
+
+
+# per pixel reductions over time. Each takes the (dates, rows, cols) block and the days since the first date
+REDUCTIONS = {
+    "max": _nan_max,
+    "min": _nan_min,
+    "max_date": _max_date,
+    "count": _count,
+    "mean": _mean,
+    "median": _median,
+    "slope": _slope,
+}
+
+
+
+def reduce_stack(stack, days, reductions):
+    """
+        Apply temporal reductions to a (dates, rows, cols) block where NaN marks missing observations
+        Input: np array, days of each date since the first one, names of reductions in REDUCTIONS
+        Return: dictionary of {reduction name: (rows, cols) float32 array}
+    """
+    return dict((name, REDUCTIONS[name](stack, days).astype(np.float32, copy=False)) for name in reductions)
+
+
+
+def sensing_time(granule):
+    """
+        Read the sensing time of a granule ({band name: path}) from its band file names
+        Return: datetime
+    """
+    for path in granule.values():
+        band_file = parse_band_filename(path)
+        if band_file:
+            return datetime.strptime(band_file.sensing_time, "%Y%m%dT%H%M%S")
+
+    raise ValueError("Could not find the sensing time of the granule %s" % granule)
+
+
+
+class TileStack(object):
+    """
+        The granules of one tile over time, keyed by sensing date.
+        Nothing is read on creation. composite() streams every date through an index expression block by block
+        and reduces the dates of each pixel (max ndvi composite, median, mean, slope...).
+    """
+
+    def __init__(self, granules):
+        """
+            Input: list of granules (dictionaries of {band name: path}, see discovery.discover_granules),
+            or a dictionary of {sensing time (datetime): granule}
+        """
+        if not isinstance(granules, dict):
+            granules = dict((sensing_time(granule), granule) for granule in granules)
+
+        if not granules:
+            raise ValueError("A TileStack needs at least one granule")
+
+        self.dates = sorted(granules)
+        self.granules = [granules[date] for date in self.dates]
+
+        # days since the first date, used by the slope reduction
+        self.days = np.array([(date - self.dates[0]).total_seconds() / 86400.0 for date in self.dates])
+
+
+    def __repr__(self):
+        return "TileStack_%d_dates_%s_%s" % (len(self.dates), self.dates[0].date(), self.dates[-1].date())
+
+
+    def __len__(self):
+        return len(self.dates)
+
+
+    @staticmethod
+    def from_directory(path, tile, start=None, end=None, index_path=None):
+        """
+            Make the TileStack of one tile (eg. "56HLH") from the granules under a directory,
+            optionally between two sensing times (see discovery.GranuleIndex.files)
+        """
+        index = GranuleIndex(index_path)
+        try:
+            index.refresh(path)
+            return TileStack(index.granules(path, tile, start, end))
+        finally:
+            index.close()
+
+
+    def _date_vrts(self, bands):
+        """
+            Stack the bands of each date into a VRT, all on the grid of the first date at its finest resolution,
+            so a window of one date lines up with the same window of every other date
+        """
+        first_vrt = gdal.BuildVRT('', [self.granules[0][band] for band in bands], separate=True, resolution='highest',
+                                  resampleAlg=DATE_RESAMPLING)
+        gt = first_vrt.GetGeoTransform()
+        bounds = (gt[0], gt[3] + gt[5] * first_vrt.RasterYSize, gt[0] + gt[1] * first_vrt.RasterXSize, gt[3])
+
+        vrts = [first_vrt]
+        for granule in self.granules[1:]:
+            vrts.append(gdal.BuildVRT('', [granule[band] for band in bands], separate=True, outputBounds=bounds,
+                                      xRes=gt[1], yRes=abs(gt[5]), resampleAlg=DATE_RESAMPLING))
+        return vrts
+
+
+    def composite(self, expression="ndvi", reductions=("max",), save_paths=None, block_size=TIMESERIES_BLOCK_SIZE):
+        """
+            Compute per pixel temporal reductions of an index over all the dates.
+            Input: an index name in INDEX_EXPRESSIONS or a band math expression, names of reductions in REDUCTIONS,
+            optional dictionary of {reduction name: save path}, (xsize, ysize) block size
+            Pixels with no valid observation (or too few for a slope) are NaN.
+            Return: dictionary of {reduction name: lazy GeoTiff}
+        """
+        expression = INDEX_EXPRESSIONS.get(expression, expression)
+        plan = compile_expressions({"index": expression})
+
+        missing = [idx for idx, granule in enumerate(self.granules) if any(band not in granule for band in plan.bands)]
+        if missing:
+            raise ValueError("Dates %s are missing bands for %s" % (", ".join(str(self.dates[idx]) for idx in missing), expression))
+
+        unknown = [name for name in reductions if name not in REDUCTIONS]
+        if unknown:
+            raise ValueError("Unknown reductions %s, use %s" % (", ".join(unknown), ", ".join(sorted(REDUCTIONS))))
+
+        vrts = self._date_vrts(plan.bands)
+        save_paths = save_paths or {}
+
+        out_dss = {}
+        for name in reductions:
+            output_type = "GTiff" if save_paths.get(name) else "MEM"
+            out_dss[name] = create_output_ds(vrts[0], 1, gdal.GDT_Float32, save_paths.get(name), output_type, no_data_value=np.nan)
+
+        xsize, ysize = vrts[0].RasterXSize, vrts[0].RasterYSize
+        stack = np.empty((len(vrts), block_size[1], block_size[0]), dtype=np.float32)
+
+        for xoff, yoff, win_xsize, win_ysize in block_windows(xsize, ysize, block_size[0], block_size[1]):
+            block = stack[:, :win_ysize, :win_xsize]
+
+            for date_idx, vrt in enumerate(vrts):
+                bands = [vrt.GetRasterBand(band_idx + 1).ReadAsArray(xoff, yoff, win_xsize, win_ysize) for band_idx in range(len(plan.bands))]
+                block[date_idx] = plan.evaluate(dict(zip(plan.bands, bands)), np.float32)["index"]
+
+            for name, result in reduce_stack(block, self.days, reductions).items():
+                out_dss[name].GetRasterBand(1).WriteArray(result, xoff, yoff)
+
+        composites = {}
+        for name, out_ds in out_dss.items():
+            out_ds.FlushCache()
+            composites[name] = GeoTiff.geoTiff_factory(in_ds=out_ds, lazy=True)
+
+        return composites
@@ -0,0 +1,218 @@
+"""
+    Project:
+        sentinel2_auto
+
+    File:
+        Zonal statistics of a raster over many polygons (eg. paddocks) in one pass
+
+    All the polygons of a vector file are rasterized into one label image on the raster's grid, where each pixel
+    holds the number of the zone it falls in. Per zone statistics are then reduced with np.bincount (count, mean, std)
+    and one sort by (zone, value) (min, max, percentiles), instead of cropping the raster once per polygon.
+
+"""
+
+import csv
+from collections import OrderedDict
+import numpy as np
+from osgeo import gdal, ogr, osr
+from cutline import _srs_from_wkt, geo_window
+
+
+
+DEFAULT_STATISTICS = ("count", "mean", "std", "min", "max")
+
+
+
+class Zones(object):
+    """
+        The polygons of a vector file (kml, geojson, shapefile...), each one a zone.
+        Zones are identified by the value of id_field, or by their feature id. The geometries are reprojected
+        (and cached) for each raster projection they are used with.
+    """
+
+    def __init__(self, vector_path, id_field=None):
+        """
+            Input: path to the vector file, optional name of the attribute holding each zone's id
+        """
+        vector_ds = ogr.Open(vector_path)
+        if vector_ds is None:
+            raise ValueError("Could not read the zones %s" % vector_path)
+
+        self.vector_path = vector_path
+        self.ids = []
+        self.geometries = []
+        self.srs = None
+
+        for layer_idx in range(vector_ds.GetLayerCount()):
+            layer = vector_ds.GetLayerByIndex(layer_idx)
+
+            if self.srs is None and layer.GetSpatialRef() is not None:
+                self.srs = _srs_from_wkt(layer.GetSpatialRef().ExportToWkt())
+
+            for feature in layer:
+                geometry = feature.GetGeometryRef()
+                if geometry is None:
+                    continue
+
+                geometry = geometry.Clone()
+                geometry.FlattenTo2D()
+                self.geometries.append(geometry)
+                self.ids.append(feature.GetField(id_field) if id_field else feature.GetFID())
+
+        if not self.geometries:
+            raise ValueError("The zones %s have no geometries" % vector_path)
+
+        # kmls are always in wgs84
+        if self.srs is None:
+            self.srs = osr.SpatialReference()
+            self.srs.ImportFromEPSG(4326)
+            if hasattr(self.srs, "SetAxisMappingStrategy"):
+                self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        self._projected = {}
+        self._labels = (None, None)
+
+
+    def __repr__(self):
+        return "Zones_%d_%s" % (len(self), self.vector_path)
+
+
+    def __len__(self):
+        return len(self.geometries)
+
+
+    def layer_for(self, projection):
+        """
+            Return an in memory ogr layer of the zones in a projection (wkt), with the zone number (1, 2, ...)
+            of each polygon in its "zone" field. The layer is only built the first time
+        """
+        if projection not in self._projected:
+            dst_srs = _srs_from_wkt(projection)
+            transformation = None if dst_srs.IsSame(self.srs) else osr.CoordinateTransformation(self.srs, dst_srs)
+
+            vector_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+            layer = vector_ds.CreateLayer("zones", dst_srs, ogr.wkbUnknown)
+            layer.CreateField(ogr.FieldDefn("zone", ogr.OFTInteger))
+
+            for zone, geometry in enumerate(self.geometries, 1):
+                geometry = geometry.Clone()
+                if transformation is not None:
+                    geometry.Transform(transformation)
+
+                feature = ogr.Feature(layer.GetLayerDefn())
+                feature.SetField("zone", zone)
+                feature.SetGeometry(geometry)
+                layer.CreateFeature(feature)
+
+            # the datasource owns the layer, keep both
+            self._projected[projection] = (vector_ds, layer)
+
+        return self._projected[projection][1]
+
+
+    def window(self, xsize, ysize, geo_transform, projection):
+        """
+            Find the pixel window of a grid covering all the zones
+            Return: (xoff, yoff, xsize, ysize) or None if no zone overlaps the grid
+        """
+        return geo_window(self.layer_for(projection).GetExtent(), geo_transform, xsize, ysize)
+
+
+    def labels(self, xsize, ysize, geo_transform, projection):
+        """
+            Rasterize the zones onto a grid. Where zones overlap, the later zone wins.
+            The last label image is kept, so bands on the same grid only rasterize the zones once
+            Return: int32 np array of zone numbers (index into self.ids plus one), 0 outside every zone
+        """
+        key = (xsize, ysize, tuple(geo_transform), projection)
+        if self._labels[0] == key:
+            return self._labels[1]
+
+        label_ds = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Int32)
+        label_ds.SetGeoTransform(geo_transform)
+        label_ds.SetProjection(projection)
+
+        gdal.RasterizeLayer(label_ds, [1], self.layer_for(projection), options=["ATTRIBUTE=zone"])
+
+        self._labels = (key, label_ds.GetRasterBand(1).ReadAsArray())
+        return self._labels[1]
+
+
+
+def zonal_statistics(values, labels, zone_count, statistics=DEFAULT_STATISTICS, percentiles=(), no_data_mask=None):
+    """
+        Reduce a raster per zone in one pass.
+        Input: (rows, cols) raster, label image of the same shape (0 for no zone, 1 - zone_count otherwise),
+        number of zones, names of statistics (count, sum, mean, std, min, max), percentiles (0 - 100),
+        optional boolean mask of pixels to leave out. NaN pixels are always left out
+        Return: OrderedDict of {statistic name (percentiles are "p<percentile>"): array with one value per zone},
+        NaN for zones without a valid pixel
+    """
+    valid = labels > 0
+    if values.dtype.kind == "f":
+        valid &= np.isfinite(values)
+    if no_data_mask is not None:
+        valid &= ~no_data_mask
+
+    zone_labels = labels[valid] - 1
+    zone_values = values[valid].astype(np.float64)
+
+    count = np.bincount(zone_labels, minlength=zone_count)[:zone_count]
+    table = OrderedDict()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if "count" in statistics:
+            table["count"] = count
+
+        sums = np.bincount(zone_labels, weights=zone_values, minlength=zone_count)[:zone_count]
+        if "sum" in statistics:
+            table["sum"] = sums
+
+        mean = sums / count
+        if "mean" in statistics:
+            table["mean"] = mean
+
+        if "std" in statistics:
+            squares = np.bincount(zone_labels, weights=zone_values * zone_values, minlength=zone_count)[:zone_count]
+            table["std"] = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+
+    if "min" in statistics or "max" in statistics or percentiles:
+
+        # one sort groups each zone's values together, in order
+        order = np.lexsort((zone_values, zone_labels))
+        sorted_values = zone_values[order]
+        starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+        has_values = count > 0
+
+        def pick(positions):
+            result = np.full(zone_count, np.nan)
+            result[has_values] = sorted_values[positions[has_values]]
+            return result
+
+        if "min" in statistics:
+            table["min"] = pick(starts)
+        if "max" in statistics:
+            table["max"] = pick(starts + count - 1)
+
+        for percentile in percentiles:
+            # linear interpolation between the closest ranks, like np.percentile
+            rank = (count - 1) * percentile / 100.0
+            below = np.floor(rank).astype(np.int64)
+            above = np.minimum(below + 1, np.maximum(count - 1, 0))
+            fraction = rank - below
+
+            table["p%g" % percentile] = pick(starts + below) * (1 - fraction) + pick(starts + above) * fraction
+
+    return table
+
+
+
+def write_table(table, csv_path):
+    """
+        Write a table (an OrderedDict of equal length columns, eg. from GeoTiff.zonal_stats) to a csv
+    """
+    with open(csv_path, "wb") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(list(table.keys()))
+        for row in zip(*table.values()):
+            writer.writerow(row)
@@ -1,9 +1,13 @@
 from setuptools import setup
+import os
 
 
+# single source of the version, shared with the raster cache keys
+exec(open(os.path.join(os.path.dirname(__file__), 'sentinel2_auto', 'version.py')).read())
+
 
 setup(name='sentinel2_auto',
-      version='0.1',
+      version=__version__,
       description='Automation of producing vegetation indicies from multispectral bands',
       url='http://github.com/corno93/sentinel2_auto',
       author='Alex Cornelio',
@@ -0,0 +1,83 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the Bands class
+
+    Tests:
+
+        Stacked and per band resizing agree on bands of mixed resolutions
+
+"""
+
+from sentinel2_auto.bands import Bands
+from osgeo import gdal, osr
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+def write_band(path, size, pixel, seed):
+    """
+        Write a uint16 utm (zone 56S) geotiff of smooth noise covering the same 400 m square whatever its pixel size
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32756)
+
+    out_ds = gdal.GetDriverByName("GTiff").Create(path, size, size, 1, gdal.GDT_UInt16)
+    out_ds.SetGeoTransform((300000.0, pixel, 0.0, 6100000.0, 0.0, -pixel))
+    out_ds.SetProjection(srs.ExportToWkt())
+
+    rows, cols = np.mgrid[0:size, 0:size] * pixel
+    raster = 1000 + 500 * np.sin(rows / 90.0 + seed) * np.cos(cols / 70.0 - seed)
+    out_ds.GetRasterBand(1).WriteArray(raster.astype(np.uint16))
+    out_ds.FlushCache()
+
+
+
+class TestBandsResize(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = {"B08": os.path.join(self.directory, "B08.tif"), "B11": os.path.join(self.directory, "B11.tif")}
+        write_band(self.paths["B08"], 40, 10.0, 1)
+        write_band(self.paths["B11"], 20, 20.0, 2)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_stacked_matches_per_band(self):
+        """
+            Test the stacked resize resamples each band once from its native grid, like resize_band does
+        """
+        stacked = Bands(self.paths, resize=False)
+        stacked.resize_bands(stacked=True)
+
+        per_band = Bands(self.paths, resize=False)
+        per_band.resize_bands()
+
+        for band in ("B08", "B11"):
+            stacked_raster = stacked.geotiff_objs[band].raster_data.astype(np.int32)
+            per_band_raster = per_band.geotiff_objs[band].raster_data.astype(np.int32)
+
+            self.assertEqual(stacked_raster.shape, per_band_raster.shape)
+            self.assertLessEqual(np.abs(stacked_raster - per_band_raster).max(), 1)
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for batch generation of indices
+
+    Tests:
+
+        Granules sharing a directory get their own outputs and manifests
+        Incremental reruns skip each granule's up to date outputs
+
+"""
+
+from sentinel2_auto import batch
+from sentinel2_auto.batch import generate_indicies, granule_name
+from sentinel2_auto.manifest import Manifest
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+class FakeIndex(object):
+    """
+        A computed index that saves the bands it was computed from
+    """
+
+    def __init__(self, bands):
+        self.text = ",".join(sorted(bands.values()))
+
+    def save_raster(self, path, storage, output_type):
+        with open(path, "w") as out_file:
+            out_file.write("gray " + self.text)
+
+    def apply_colour_scale(self, path, output_type):
+        with open(path, "w") as out_file:
+            out_file.write("colour " + self.text)
+
+
+
+class FakeBands(object):
+
+    computed = 0
+
+    def __init__(self, bands, stacked=False, cache=None):
+        self.bands = bands
+
+    def compute_indices(self, expressions):
+        FakeBands.computed += 1
+        return dict((index, FakeIndex(self.bands)) for index in expressions)
+
+
+
+class TestSharedDirectory(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # two dates of a tile flattened into one directory
+        self.granules = []
+        for sensing_time in ("20190204T000241", "20190209T000239"):
+            granule = {}
+            for band in ("B04", "B07"):
+                granule[band] = os.path.join(self.directory, "T56HLH_%s_%s.jp2" % (sensing_time, band))
+                with open(granule[band], "w") as band_file:
+                    band_file.write(band)
+            self.granules.append(granule)
+
+        self._bands = batch.Bands
+        batch.Bands = FakeBands
+        FakeBands.computed = 0
+
+
+    def tearDown(self):
+        batch.Bands = self._bands
+        shutil.rmtree(self.directory)
+
+
+    def test_granule_name(self):
+        """
+            Test granules are named after their tile and sensing time, and other files aren't named
+        """
+        self.assertEqual(granule_name(self.granules[0]["B04"]), "T56HLH_20190204T000241")
+        self.assertIsNone(granule_name(os.path.join(self.directory, "red.tif")))
+
+
+    def test_separate_outputs(self):
+        """
+            Test each granule writes its own outputs and manifest, and reruns skip both
+        """
+        outputs = [generate_indicies(granule, ("ndvi",))[0] for granule in self.granules]
+
+        self.assertEqual([os.path.basename(path) for path in outputs[0]],
+                         ["T56HLH_20190204T000241_ndvi_gray.tif", "T56HLH_20190204T000241_ndvi_colour.tif"])
+        self.assertEqual(len(set(outputs[0] + outputs[1])), 4)
+
+        for granule, granule_outputs in zip(self.granules, outputs):
+            with open(granule_outputs[0]) as gray_file:
+                self.assertEqual(gray_file.read(), "gray %s,%s" % (granule["B04"], granule["B07"]))
+
+            manifest = Manifest(self.directory, granule_name(granule["B04"]))
+            self.assertEqual(sorted(manifest.entries), sorted(os.path.basename(path) for path in granule_outputs))
+
+        for granule, granule_outputs in zip(self.granules, outputs):
+            self.assertEqual(generate_indicies(granule, ("ndvi",), incremental=True), ([], granule_outputs))
+        self.assertEqual(FakeBands.computed, 2)
+
+        # a changed band only recomputes its own granule
+        with open(self.granules[1]["B07"], "a") as band_file:
+            band_file.write("more")
+        self.assertEqual(generate_indicies(self.granules[0], ("ndvi",), incremental=True)[0], [])
+        self.assertEqual(generate_indicies(self.granules[1], ("ndvi",), incremental=True)[0], outputs[1])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the on disk raster cache
+
+    Tests:
+
+        Cache keys
+        Stacked resizes are keyed by the whole stack
+        Least recently used eviction
+        Failed writes and their left over temporary files
+
+"""
+
+from sentinel2_auto import cache
+from sentinel2_auto.cache import RasterCache, source_identity
+from sentinel2_auto.bands import Bands
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+class FakeGeoTiff(object):
+    """
+        Just the cache key of a GeoTiff read from a file
+    """
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+
+    def cache_key(self, operation=None):
+        return self.cache.key([source_identity(self.path)], [operation] if operation else [])
+
+
+
+class FailingGdal(object):
+    """
+        A gdal whose drivers create the file then fail, like a write that runs out of disk
+    """
+
+    def GetDriverByName(self, name):
+        return self
+
+    def CreateCopy(self, path, in_ds, options=None):
+        with open(path, "wb") as out_file:
+            out_file.write("half a geotiff")
+        raise RuntimeError("No space left on device")
+
+
+
+class TestRasterCache(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = RasterCache(os.path.join(self.directory, "cache"), max_size_mb=1)
+
+        self.paths = {}
+        for band in ("B08", "B11", "B12"):
+            self.paths[band] = os.path.join(self.directory, "T56HLH_20190204T000241_%s.jp2" % band)
+            with open(self.paths[band], "wb") as band_file:
+                band_file.write(band)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_key(self):
+        """
+            Test keys are stable and change with the sources and the operations, including their order
+        """
+        sources = [source_identity(self.paths["B08"])]
+        resize, crop = ["resize", [100, 100], None], ["crop", "abc", True]
+
+        self.assertEqual(RasterCache.key(sources, [resize]), RasterCache.key(list(sources), [list(resize)]))
+        self.assertNotEqual(RasterCache.key(sources, [resize]), RasterCache.key([source_identity(self.paths["B11"])], [resize]))
+        self.assertNotEqual(RasterCache.key(sources, [resize]), RasterCache.key(sources, [["resize", [100, 101], None]]))
+        self.assertNotEqual(RasterCache.key(sources, [resize, crop]), RasterCache.key(sources, [crop, resize]))
+
+        # a changed source file is a different source
+        with open(self.paths["B08"], "ab") as band_file:
+            band_file.write("more")
+        self.assertNotEqual(RasterCache.key(sources, [resize]), RasterCache.key([source_identity(self.paths["B08"])], [resize]))
+
+
+    def test_stacked_resize_keys(self):
+        """
+            Test a band's stacked resize is keyed by every band in the stack, whatever their order
+        """
+        geotiffs = dict((band, FakeGeoTiff(self.cache, path)) for band, path in self.paths.items())
+
+        with_b08 = Bands._stacked_resize_operation([geotiffs["B08"], geotiffs["B11"]], (100, 100))
+        with_b12 = Bands._stacked_resize_operation([geotiffs["B11"], geotiffs["B12"]], (100, 100))
+        reordered = Bands._stacked_resize_operation([geotiffs["B11"], geotiffs["B08"]], (100, 100))
+
+        self.assertNotEqual(geotiffs["B11"].cache_key(with_b08), geotiffs["B11"].cache_key(with_b12))
+        self.assertEqual(geotiffs["B11"].cache_key(with_b08), geotiffs["B11"].cache_key(reordered))
+
+
+    def test_evict(self):
+        """
+            Test the least recently used entries are deleted once the cache is over its cap, and other files are left alone
+        """
+        cache_dir = self.cache.cache_dir
+        for idx in range(4):
+            path = os.path.join(cache_dir, "entry%d.tif" % idx)
+            with open(path, "wb") as entry_file:
+                entry_file.write("0" * 400 * 1024)
+            os.utime(path, (1000000000 + idx, 1000000000 + idx))
+
+        # entry0 was used most recently
+        os.utime(os.path.join(cache_dir, "entry0.tif"), (1000000010, 1000000010))
+
+        with open(os.path.join(cache_dir, "notes.txt"), "w") as other_file:
+            other_file.write("0" * 2 * 1024 * 1024)
+
+        self.cache.evict()
+        self.assertEqual(sorted(os.listdir(cache_dir)), ["entry0.tif", "entry3.tif", "notes.txt"])
+
+        self.cache.clear()
+        self.assertEqual(os.listdir(cache_dir), ["notes.txt"])
+
+
+    def test_failed_put(self):
+        """
+            Test a failed write leaves neither an entry nor its temporary file behind
+        """
+        _gdal = cache.gdal
+        cache.gdal = FailingGdal()
+        try:
+            self.assertRaises(RuntimeError, self.cache.put, "abc", None)
+        finally:
+            cache.gdal = _gdal
+
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+        self.assertIsNone(self.cache.get("abc"))
+
+
+    def test_stale_tmp_files(self):
+        """
+            Test evict and clear delete old temporary files but not the ones other writers may still be writing
+        """
+        cache_dir = self.cache.cache_dir
+        for name in ("old.tmp", "new.tmp"):
+            with open(os.path.join(cache_dir, name), "wb") as tmp_file:
+                tmp_file.write("0" * 1024)
+
+        stale = 1000000000
+        os.utime(os.path.join(cache_dir, "old.tmp"), (stale, stale))
+
+        self.cache.evict()
+        self.assertEqual(os.listdir(cache_dir), ["new.tmp"])
+
+        os.utime(os.path.join(cache_dir, "new.tmp"), (stale, stale))
+        self.cache.clear()
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
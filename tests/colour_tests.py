@@ -0,0 +1,84 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the colour mapping engine
+
+    Tests:
+
+        Lookup table of a colour scale
+        Histogram percentiles against numpy
+        Quantizing with no data
+
+"""
+
+from sentinel2_auto.colour import colour_lut, histogram_percentiles, quantize, colour_indices, NO_DATA_INDEX, COLOUR_LEVELS
+import numpy as np
+import unittest
+
+
+
+
+class TestColour(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            Make a random float32 index with some undefined pixels
+        """
+        random = np.random.RandomState(0)
+        self.index = random.uniform(-1, 1, (200, 300)).astype(np.float32)
+        self.index[:10, :10] = np.nan
+
+
+    def test_lut(self):
+        """
+            The scale runs from red to green and no data is white
+        """
+        lut = colour_lut("RdYlGn")
+        self.assertEqual(lut.shape, (256, 3))
+        self.assertEqual(lut.dtype, np.uint8)
+        self.assertEqual(tuple(lut[0]), (0xa5, 0x00, 0x26))
+        self.assertEqual(tuple(lut[COLOUR_LEVELS - 1]), (0x00, 0x68, 0x37))
+        self.assertEqual(tuple(lut[NO_DATA_INDEX]), (255, 255, 255))
+
+
+    def test_histogram_percentiles(self):
+        """
+            The histogram estimate is within a bin of the exact percentiles
+        """
+        estimate = histogram_percentiles(self.index, (0.4, 50, 99.6))
+        exact = np.nanpercentile(self.index, (0.4, 50, 99.6))
+        np.testing.assert_allclose(estimate, exact, atol=2.0 / 4096)
+
+        self.assertIsNone(histogram_percentiles(np.full((5, 5), np.nan), (1, 99)))
+
+
+    def test_quantize(self):
+        """
+            Values are clipped to the scale and undefined or masked pixels get the no data index
+        """
+        data = np.array([[-2.0, 0.0, 0.5], [1.0, 3.0, np.nan]])
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[0, 2] = True
+
+        indices = quantize(data, 0.0, 1.0, mask)
+        np.testing.assert_array_equal(indices, [[0, 0, NO_DATA_INDEX], [COLOUR_LEVELS - 1, COLOUR_LEVELS - 1, NO_DATA_INDEX]])
+
+        indices = colour_indices(self.index, np.isnan(self.index))
+        self.assertTrue((indices[:10, :10] == NO_DATA_INDEX).all())
+        self.assertEqual(indices[10:].max(), COLOUR_LEVELS - 1)
+        self.assertEqual(indices[10:].min(), 0)
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestColour)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,72 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the vectorised coordinate conversions
+
+    Tests:
+
+        Geotransform round trip
+        Haversine distances against the scalar helper
+
+"""
+
+from sentinel2_auto.coordinates import apply_geo_transform, invert_geo_transform, geo_to_pixel, haversine_distances
+from sentinel2_auto import helpers
+import numpy as np
+import unittest
+
+
+
+
+class TestCoordinates(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            A 10m utm geotransform and some random pixels
+        """
+        self.geo_transform = (300000.0, 10.0, 0.0, 6300040.0, 0.0, -10.0)
+        random = np.random.RandomState(0)
+        self.rows = random.randint(0, 10980, 1000)
+        self.cols = random.randint(0, 10980, 1000)
+
+
+    def test_round_trip(self):
+        """
+            Pixel centres map back onto the same pixels
+        """
+        ys, xs = apply_geo_transform(self.geo_transform, self.rows + 0.5, self.cols + 0.5)
+        self.assertEqual((xs[0], ys[0]), (300000.0 + 10 * (self.cols[0] + 0.5), 6300040.0 - 10 * (self.rows[0] + 0.5)))
+
+        rows, cols = geo_to_pixel(invert_geo_transform(self.geo_transform), ys, xs)
+        np.testing.assert_array_equal(rows, self.rows)
+        np.testing.assert_array_equal(cols, self.cols)
+
+        self.assertRaises(ValueError, invert_geo_transform, (0, 0, 0, 0, 0, 0))
+
+
+    def test_haversine(self):
+        """
+            The vectorised distances match the scalar helper
+        """
+        lats = np.linspace(-33.9, -33.8, 50)
+        lons = np.linspace(151.1, 151.3, 50)
+        distances = haversine_distances(-33.85, 151.2, lats, lons)
+
+        self.assertEqual(distances.shape, (50,))
+        for lat, lon, distance in zip(lats, lons, distances):
+            self.assertAlmostEqual(distance, helpers.haversine_dist((-33.85, 151.2), (lat, lon)))
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCoordinates)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,170 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the pool of open gdal datasets
+
+    Tests:
+
+        Least recently used eviction
+        Datasets are pooled by path and open options
+        Changed files are reopened
+        Overview levels are capped at the coarsest overview
+        Files without overviews are reported once
+
+"""
+
+from sentinel2_auto import datasets
+from sentinel2_auto.datasets import DatasetPool, open_overview
+from gdal_fakes import FakeGdal
+from StringIO import StringIO
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+
+
+
+
+class TestDatasetPool(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for idx in range(3):
+            self.paths.append(os.path.join(self.directory, "B0%d.jp2" % (idx + 2)))
+            with open(self.paths[-1], "wb") as band_file:
+                band_file.write("jp2")
+
+        self.gdal = FakeGdal()
+        self._gdal = datasets.gdal
+        datasets.gdal = self.gdal
+
+        self._pool = datasets._pool
+        datasets._pool = DatasetPool()
+        datasets._no_overview_paths.clear()
+
+
+    def tearDown(self):
+        datasets.gdal = self._gdal
+        datasets._pool = self._pool
+        datasets._no_overview_paths.clear()
+        shutil.rmtree(self.directory)
+
+
+    def test_lru_eviction(self):
+        """
+            Test the least recently used dataset is dropped once the pool is full
+        """
+        pool = DatasetPool(max_open=2)
+        b02 = pool.open(self.paths[0])
+        pool.open(self.paths[1])
+
+        # using B02 again makes B03 the oldest
+        self.assertIs(pool.open(self.paths[0]), b02)
+        pool.open(self.paths[2])
+
+        self.assertEqual(len(pool), 2)
+        self.assertIs(pool.open(self.paths[0]), b02)
+        self.assertEqual((pool.hits, pool.misses), (2, 3))
+
+        pool.open(self.paths[1])
+        self.assertEqual(pool.misses, 4)
+        self.assertEqual([os.path.basename(path) for path, _ in self.gdal.opened], ["B02.jp2", "B03.jp2", "B04.jp2", "B03.jp2"])
+
+        pool.resize(1)
+        self.assertEqual(len(pool), 1)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+
+
+    def test_keyed_by_path_and_options(self):
+        """
+            Test the same file opened with other options is another dataset, and relative paths share a dataset
+        """
+        self.gdal.overviews = [self.gdal.full[::2, ::2]]
+
+        pool = DatasetPool()
+        full = pool.open(self.paths[0])
+        overview = pool.open(self.paths[0], ["OVERVIEW_LEVEL=0"])
+
+        self.assertIsNot(full, overview)
+        self.assertEqual(overview.open_options, ["OVERVIEW_LEVEL=0"])
+        self.assertIs(pool.open(self.paths[0], ("OVERVIEW_LEVEL=0",)), overview)
+
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            self.assertIs(pool.open("B02.jp2"), full)
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(len(self.gdal.opened), 2)
+        self.assertIsNone(pool.open(os.path.join(self.directory, "missing.jp2")))
+        self.assertEqual(len(pool), 2)
+
+
+    def test_reopen_changed_file(self):
+        """
+            Test a file whose size or modification time changed is opened again
+        """
+        pool = DatasetPool()
+        first = pool.open(self.paths[0])
+
+        with open(self.paths[0], "ab") as band_file:
+            band_file.write("more")
+        resized = pool.open(self.paths[0])
+        self.assertIsNot(resized, first)
+
+        os.utime(self.paths[0], (1000000000, 1000000000))
+        touched = pool.open(self.paths[0])
+        self.assertIsNot(touched, resized)
+
+        self.assertIs(pool.open(self.paths[0]), touched)
+        self.assertEqual(len(self.gdal.opened), 3)
+        self.assertEqual(len(pool), 1)
+
+
+    def test_open_overview_capping(self):
+        """
+            Test overview levels past the coarsest overview read the coarsest one
+        """
+        self.gdal.overviews = [self.gdal.full[::2, ::2], self.gdal.full[::4, ::4]]
+
+        self.assertEqual(open_overview(self.paths[0], 1).open_options, ["OVERVIEW_LEVEL=0"])
+        self.assertEqual(open_overview(self.paths[0], 2).open_options, ["OVERVIEW_LEVEL=1"])
+        self.assertEqual(open_overview(self.paths[0], 5).open_options, ["OVERVIEW_LEVEL=1"])
+        self.assertIsNone(open_overview(self.paths[0]).open_options)
+
+
+    def test_no_overviews_reported_once(self):
+        """
+            Test a file without overviews opens at full resolution and is only reported the first time
+        """
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            full = open_overview(self.paths[0], 2)
+            self.assertIs(open_overview(self.paths[0], 3), full)
+            open_overview(self.paths[1], 2)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertIsNone(full.open_options)
+        self.assertEqual(output.count("B02.jp2 has no overviews"), 1)
+        self.assertEqual(output.count("B03.jp2 has no overviews"), 1)
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the granule discovery index
+
+    Tests:
+
+        Parsing band file names
+        Grouping band files into granules
+        Incremental refreshing
+
+"""
+
+from sentinel2_auto.discovery import GranuleIndex, parse_band_filename, discover_granules
+import unittest
+import tempfile
+import shutil
+import time
+import os
+
+
+
+
+
+class TestGranuleDiscovery(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            Make a small archive of empty band files
+        """
+        self.root = tempfile.mkdtemp()
+        self.index_dir = tempfile.mkdtemp()
+        self.granule_dir = os.path.join(self.root, "S2A_MSIL1C_20190204T000241_N0207_R030_T56HLH_20190204T012019.SAFE", "IMG_DATA")
+        os.makedirs(self.granule_dir)
+
+        for band in ["B01", "B02", "B03", "B04", "B8A", "TCI"]:
+            open(os.path.join(self.granule_dir, "T56HLH_20190204T000241_%s.jp2" % band), "w").close()
+
+        open(os.path.join(self.granule_dir, "MTD_TL.xml"), "w").close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.index_dir)
+
+
+    def test_parse(self):
+        """
+            Parse L1C and L2A names
+        """
+        band_file = parse_band_filename("T56HLH_20190204T000241_B8A.jp2")
+        self.assertEqual((band_file.tile, band_file.sensing_time, band_file.band, band_file.resolution), ("56HLH", "20190204T000241", "B8A", None))
+
+        band_file = parse_band_filename("/data/R20m/T56HLH_20190204T000241_B05_20m.jp2")
+        self.assertEqual((band_file.band, band_file.resolution), ("B05", 20))
+
+        self.assertEqual(parse_band_filename("MTD_TL.xml"), None)
+
+
+    def test_granules(self):
+        """
+            Every band is found under its own name (B02 used to be collated as B03)
+        """
+        granules = discover_granules(self.root)
+        self.assertEqual(len(granules), 1)
+        self.assertEqual(sorted(granules[0]), ["B01", "B02", "B03", "B04", "B8A", "TCI"])
+        self.assertTrue(granules[0]["B02"].endswith("_B02.jp2"))
+
+
+    def test_incremental_refresh(self):
+        """
+            Only changed directories are rescanned
+        """
+        # keep the index file outside the archive, so writing it does not touch the archive's mtimes
+        index = GranuleIndex(os.path.join(self.index_dir, "index.sqlite"))
+        self.assertEqual(index.refresh(self.root), 3)
+        self.assertEqual(index.refresh(self.root), 0)
+
+        # make sure the directory mtime moves on
+        time.sleep(1)
+        os.remove(os.path.join(self.granule_dir, "T56HLH_20190204T000241_B01.jp2"))
+        self.assertEqual(index.refresh(self.root), 1)
+        self.assertEqual(len(index.files()), 5)
+        index.close()
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGranuleDiscovery)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,92 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the band math expression engine
+
+    Tests:
+
+        Evaluating indices against plain numpy
+        Common subexpression elimination
+        Division by zero
+        Unsupported syntax
+
+"""
+
+from sentinel2_auto.expressions import compile_expressions, INDEX_EXPRESSIONS
+import numpy as np
+import unittest
+
+
+
+
+class TestExpressionPlan(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            Make some random uint16 bands
+        """
+        random = np.random.RandomState(0)
+        self.blocks = dict((band, random.randint(0, 10000, (40, 50)).astype(np.uint16)) for band in ["B02", "B04", "B05", "B07", "B08", "B11"])
+
+
+    def test_indices(self):
+        """
+            Evaluate all the known indices in one pass and compare them to numpy
+        """
+        plan = compile_expressions(INDEX_EXPRESSIONS)
+        indices = plan.evaluate(self.blocks, np.float64)
+
+        nir = self.blocks["B07"].astype(float)
+        red = self.blocks["B04"].astype(float)
+        self.assertTrue(np.allclose(indices["ndvi"], (nir - red) / (nir + red)))
+        self.assertEqual(indices["ndvi"].dtype, np.float64)
+
+
+    def test_float32(self):
+        """
+            Float32 is the default computation type
+        """
+        plan = compile_expressions({"ndwi": INDEX_EXPRESSIONS["ndwi"]})
+        self.assertEqual(plan.evaluate(self.blocks)["ndwi"].dtype, np.float32)
+
+
+    def test_common_subexpressions(self):
+        """
+            B08 + B04 is shared, regardless of operand order
+        """
+        plan = compile_expressions({"a": "(B08 - B04) / (B08 + B04)", "b": "B04 + B08"})
+        self.assertEqual(len(plan.nodes), 5)
+
+
+    def test_division_by_zero(self):
+        """
+            Undefined pixels come back as NaN
+        """
+        self.blocks["B07"][0, 0] = 0
+        self.blocks["B04"][0, 0] = 0
+
+        ndvi = compile_expressions({"ndvi": INDEX_EXPRESSIONS["ndvi"]}).evaluate(self.blocks)["ndvi"]
+        self.assertTrue(np.isnan(ndvi[0, 0]))
+        self.assertEqual(np.isnan(ndvi).sum(), 1)
+
+
+    def test_unsupported_syntax(self):
+        """
+            Only arithmetic, numbers, band names and a few functions are allowed
+        """
+        self.assertRaises(ValueError, compile_expressions, {"bad": "B04.__class__"})
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestExpressionPlan)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,125 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for fetching granules from an object store, against the local stand-in server
+
+    Tests:
+
+        Listing a tile's granules over http and from a directory
+        Fetching objects, and resuming with range requests
+        Only fetching the bands the indices need
+
+"""
+
+from sentinel2_auto.fetch import LocalObjectServer, HttpObjectStore, FileObjectStore, remote_granules, fetch_and_process, tile_prefix
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+GRANULE_DIR = "tiles/56/H/LH/S2A_MSIL1C_%s_N0207_R130_T56HLH_%s.SAFE/GRANULE/L1C_T56HLH/IMG_DATA"
+
+SENSING_TIMES = ["20190204T000241", "20190209T000239"]
+
+BANDS = ["B03", "B04", "B08", "B11", "TCI"]
+
+
+
+class TestFetch(unittest.TestCase):
+
+
+    def setUp(self):
+        self.bucket_dir = tempfile.mkdtemp()
+        self.download_dir = tempfile.mkdtemp()
+
+        for sensing_time in SENSING_TIMES:
+            granule_dir = os.path.join(self.bucket_dir, *(GRANULE_DIR % (sensing_time, sensing_time)).split("/"))
+            os.makedirs(granule_dir)
+            for band in BANDS:
+                with open(os.path.join(granule_dir, "T56HLH_%s_%s.jp2" % (sensing_time, band)), "wb") as band_file:
+                    band_file.write(os.urandom(3000))
+
+        # not a band
+        with open(os.path.join(self.bucket_dir, "tiles", "56", "H", "LH", "index.json"), "w") as other_file:
+            other_file.write("{}")
+
+        self.server = LocalObjectServer(self.bucket_dir).start()
+        self.store = HttpObjectStore(self.server.url, self.server.bucket, pool_size=2)
+
+
+    def tearDown(self):
+        self.store.close()
+        self.server.stop()
+        shutil.rmtree(self.bucket_dir)
+        shutil.rmtree(self.download_dir)
+
+
+    def test_list_granules(self):
+        """
+            Test a tile's granules are listed the same over http and from a directory, filtered by date
+        """
+        self.assertEqual(tile_prefix("T56HLH"), "tiles/56/H/LH/")
+
+        granules = remote_granules(self.store, "56HLH")
+        self.assertEqual(granules, remote_granules(FileObjectStore(self.bucket_dir), "56HLH"))
+
+        self.assertEqual(len(granules), 2)
+        self.assertEqual(sorted(granules[0]), BANDS)
+        self.assertTrue(granules[0]["B04"].startswith("tiles/56/H/LH/") and granules[0]["B04"].endswith("T56HLH_20190204T000241_B04.jp2"))
+
+        self.assertEqual(len(remote_granules(self.store, "56HLH", start="20190205")), 1)
+        self.assertEqual(remote_granules(self.store, "55HGB"), [])
+
+
+    def test_fetch(self):
+        """
+            Test objects are fetched intact and the store answers range requests
+        """
+        key = remote_granules(self.store, "56HLH")[0]["B08"]
+        save_path = os.path.join(self.download_dir, "B08.jp2")
+
+        self.assertEqual(self.store.fetch(key, save_path), 3000)
+
+        with open(os.path.join(self.bucket_dir, *key.split("/")), "rb") as source_file:
+            source = source_file.read()
+        with open(save_path, "rb") as saved_file:
+            self.assertEqual(saved_file.read(), source)
+
+        connection, response = self.store._get("/%s/%s" % (self.store.bucket, key), {"Range": "bytes=1000-"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.read(), source[1000:])
+        connection.close()
+
+        with self.assertRaises(IOError):
+            self.store.fetch("tiles/nothing.jp2", os.path.join(self.download_dir, "nothing.jp2"))
+        self.assertEqual(os.listdir(self.download_dir), ["B08.jp2"])
+
+
+    def test_fetch_only_needed_bands(self):
+        """
+            Test only the bands of the indices are downloaded, keeping the bucket's layout, and every granule gets a result
+        """
+        granules = remote_granules(self.store, "56HLH")
+
+        results = fetch_and_process(granules, self.store, self.download_dir, indices=["ndwi"], fetch_workers=4, workers=1)
+        self.assertEqual(len(results), 2)
+
+        fetched = sorted(file_name for _, _, file_names in os.walk(self.download_dir) for file_name in file_names if file_name.endswith(".jp2"))
+        self.assertEqual(fetched, sorted("T56HLH_%s_%s.jp2" % (sensing_time, band) for sensing_time in SENSING_TIMES for band in ("B08", "B11")))
+        self.assertTrue(os.path.isfile(os.path.join(self.download_dir, *granules[0]["B11"].split("/"))))
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Fake gdal bands, datasets and opener over numpy arrays, shared by the tests that don't need real files.
+        Patch a module's gdal with FakeGdal in setUp and put it back in tearDown.
+
+"""
+
+import numpy as np
+import os
+
+
+
+
+
+class FakeBand(object):
+    """
+        The parts of a gdal band the library uses, over a (rows, cols) numpy array.
+        Writes go straight into the array and are recorded as (xoff, yoff)
+    """
+
+    def __init__(self, dataset, array, band_idx=1):
+        self.dataset = dataset
+        self.array = array
+        self.band_idx = band_idx
+        self.YSize, self.XSize = array.shape
+        self.DataType = array.dtype
+        self.writes = []
+
+    def GetDataset(self):
+        return self.dataset
+
+    def GetBand(self):
+        return self.band_idx
+
+    def GetBlockSize(self):
+        return self.dataset.block_size or (self.XSize, 1)
+
+    def GetOverviewCount(self):
+        return self.dataset.overview_count
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        xsize = self.XSize if xsize is None else xsize
+        ysize = self.YSize if ysize is None else ysize
+        if xoff < 0 or yoff < 0 or xoff + xsize > self.XSize or yoff + ysize > self.YSize:
+            raise ValueError("window out of range")
+        self.dataset.reads.append((xoff, yoff, xsize, ysize))
+        return self.array[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+    def WriteArray(self, array, xoff=0, yoff=0):
+        self.writes.append((xoff, yoff))
+        self.array[yoff:yoff + array.shape[0], xoff:xoff + array.shape[1]] = array
+
+
+
+class FakeDataset(object):
+    """
+        A gdal dataset over a (rows, cols) or (rows, cols, bands) numpy array, recording every window read
+        Input: array, description (the file path), open options it was opened with, number of overviews,
+        (xsize, ysize) block size of its bands (defaults to one row strips)
+    """
+
+    def __init__(self, array, description="", open_options=None, overview_count=0, block_size=None):
+        self.description = description
+        self.open_options = open_options
+        self.overview_count = overview_count
+        self.block_size = block_size
+        self.reads = []
+
+        if array.ndim == 2:
+            self.bands = [FakeBand(self, array)]
+        else:
+            self.bands = [FakeBand(self, array[:, :, idx], idx + 1) for idx in range(array.shape[2])]
+
+        self.RasterYSize, self.RasterXSize = array.shape[:2]
+        self.RasterCount = len(self.bands)
+
+    def GetDescription(self):
+        return self.description
+
+    def GetRasterBand(self, band_idx):
+        return self.bands[band_idx - 1]
+
+
+
+class FakeGdal(object):
+    """
+        Opens any existing file as a dataset of full, or of overviews[level] with the OVERVIEW_LEVEL=level open option.
+        Every open is recorded as (path, open options)
+    """
+    OF_RASTER = 2
+
+    def __init__(self, full=None, overviews=()):
+        self.full = np.zeros((4, 4), dtype=np.uint16) if full is None else full
+        self.overviews = list(overviews)
+        self.opened = []
+
+    def Open(self, path):
+        return self.OpenEx(path)
+
+    def OpenEx(self, path, flags=0, open_options=None):
+        self.opened.append((path, open_options))
+        if not os.path.isfile(path):
+            return None
+
+        array = self.full
+        for option in open_options or ():
+            if option.startswith("OVERVIEW_LEVEL="):
+                array = self.overviews[int(option.split("=")[1])]
+
+        return FakeDataset(array, path, open_options, len(self.overviews))
@@ -0,0 +1,80 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for wrapping numpy arrays as gdal datasets
+
+    Tests:
+
+        Wrapping shares the array's memory
+        Byte swapped and reversed arrays are copied into datasets that own their memory
+
+"""
+
+from sentinel2_auto.georeferencing import wrap_array_as_ds
+import numpy as np
+import unittest
+import gc
+
+
+
+
+
+class TestWrapArray(unittest.TestCase):
+
+
+    def setUp(self):
+        self.raster = np.arange(60, dtype=np.uint16).reshape(6, 10)
+
+
+    def test_wrap_shares_memory(self):
+        """
+            Test a native, contiguous array is wrapped without a copy: writes through the dataset reach the array
+        """
+        out_ds = wrap_array_as_ds(self.raster)
+        np.testing.assert_array_equal(out_ds.ReadAsArray(), self.raster)
+
+        out_ds.GetRasterBand(1).WriteArray(np.zeros((1, 10), dtype=np.uint16), 0, 0)
+        out_ds.FlushCache()
+        self.assertTrue((self.raster[0] == 0).all())
+
+        stack = np.dstack([self.raster, self.raster * 2])
+        stack_ds = wrap_array_as_ds(stack)
+        self.assertEqual(stack_ds.RasterCount, 2)
+        np.testing.assert_array_equal(stack_ds.GetRasterBand(2).ReadAsArray(), stack[:, :, 1])
+
+
+    def test_arrays_gdal_cannot_point_at(self):
+        """
+            Test byte swapped and reversed arrays give datasets that stay valid once the arrays are gone
+        """
+        expected = self.raster.copy()
+
+        swapped = self.raster.astype(self.raster.dtype.newbyteorder())
+        reversed_rows = self.raster[::-1]
+
+        swapped_ds = wrap_array_as_ds(swapped)
+        reversed_ds = wrap_array_as_ds(reversed_rows)
+
+        # nothing but the datasets is left holding the pixels
+        del swapped, reversed_rows
+        self.raster = None
+        gc.collect()
+        np.ones((1000, 1000), dtype=np.uint16)
+
+        np.testing.assert_array_equal(swapped_ds.ReadAsArray(), expected)
+        np.testing.assert_array_equal(reversed_ds.ReadAsArray(), expected[::-1])
+
+        stack_ds = wrap_array_as_ds(np.dstack([expected, expected * 2])[::-1].astype(">u2"))
+        np.testing.assert_array_equal(stack_ds.GetRasterBand(2).ReadAsArray(), (expected * 2)[::-1])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
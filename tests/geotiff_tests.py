@@ -13,6 +13,7 @@
         Resampling
         Reprojecting
         Kml cutting
+        Masking a file's raster leaves the file and its pooled dataset alone
         Georeferencing and saving
         Applying colourscale
 
@@ -20,6 +21,8 @@
 
 from sentinel2_auto.geoTiff import GeoTiff
 from sentinel2_auto.georeferencing import georeference_raster_to_ds
+from sentinel2_auto.cutline import Cutline
+import numpy as np
 import unittest
 import os
 
@@ -82,6 +85,25 @@ class TestSentinel2AutoMethods(unittest.TestCase):
          
 
 
+    def test_mask_to_cutline(self):
+        """
+            Test masking copies the pooled dataset of the file rather than writing into it
+        """
+        before = self.geotiff.in_ds.ReadAsArray()
+        pooled_ds = self.geotiff.in_ds
+
+        self.geotiff.mask_to_cutline(Cutline(kml))
+        self.assertEqual(self.geotiff.in_ds.GetDriver().ShortName, "MEM")
+
+        other = GeoTiff(file)
+        self.assertIs(other.in_ds, pooled_ds)
+        np.testing.assert_array_equal(other.in_ds.ReadAsArray(), before)
+        self.assertFalse(os.path.exists(file + ".aux.xml"))
+
+        self.assertRaises(ValueError, Cutline(kml).apply_mask, pooled_ds)
+
+
+
     def test_georeferencing_and_saving(self):
         """
             Test georeferencing some non geo data and saving it
@@ -0,0 +1,179 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the instrumentation spans
+
+    Tests:
+
+        Disabled instrumentation records nothing
+        Nested spans and their counters
+        Per stage summaries
+        Timed helpers are recorded in a pipeline stage
+        Json lines and prometheus exports
+
+"""
+
+from sentinel2_auto.instrumentation import SpanRegistry, instrumented, write_jsonl, write_prometheus
+from sentinel2_auto import instrumentation
+from sentinel2_auto.helpers import timing
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+
+
+
+
+class TestInstrumentation(unittest.TestCase):
+
+
+    def setUp(self):
+        self.registry = SpanRegistry()
+        self.registry.enabled = True
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        instrumentation.disable()
+        instrumentation.registry().clear()
+
+
+    def test_disabled(self):
+        """
+            Test a disabled registry hands out the do-nothing span and records nothing
+        """
+        self.registry.enabled = False
+
+        with self.registry.span("read") as read_span:
+            read_span.add(pixels=10)
+
+        self.assertIs(read_span, self.registry.span("write"))
+        self.assertEqual(len(self.registry), 0)
+
+
+    def test_nested_spans(self):
+        """
+            Test spans know their parent and keep their own counters
+        """
+        with self.registry.span("warp", "cut_to_kml", band="B04"):
+            with self.registry.span("read") as read_span:
+                read_span.add(pixels=100, bytes_read=200)
+            self.registry.current().add(pixels=50)
+
+        read_record, warp_record = self.registry.spans
+
+        self.assertEqual(read_record["parent"], "warp/cut_to_kml")
+        self.assertEqual(read_record["depth"], 1)
+        self.assertEqual((read_record["pixels"], read_record["bytes_read"]), (100, 200))
+
+        self.assertIsNone(warp_record["parent"])
+        self.assertEqual(warp_record["pixels"], 50)
+        self.assertEqual(warp_record["band"], "B04")
+        self.assertGreaterEqual(warp_record["wall_seconds"], read_record["wall_seconds"])
+
+
+    def test_errors_are_recorded(self):
+        """
+            Test a span records the exception that ended it without swallowing it
+        """
+        with self.assertRaises(ValueError):
+            with self.registry.span("compute"):
+                raise ValueError("bad expression")
+
+        self.assertEqual(self.registry.spans[0]["error"], "ValueError")
+
+
+    def test_summary(self):
+        """
+            Test span totals are grouped by stage and name
+        """
+        for _ in range(3):
+            with self.registry.span("write", "save_raster") as write_span:
+                write_span.add(bytes_written=1000)
+
+        with self.registry.span("compute"):
+            pass
+
+        summary = self.registry.summary()
+
+        self.assertEqual(list(summary.keys()), [("compute", "compute"), ("write", "save_raster")])
+        self.assertEqual(summary[("write", "save_raster")]["calls"], 3)
+        self.assertEqual(summary[("write", "save_raster")]["bytes_written"], 3000)
+
+
+    def test_instrumented_decorator(self):
+        """
+            Test the decorator only records spans when instrumentation is enabled
+        """
+        @instrumented("compute")
+        def add(a, b):
+            instrumentation.count(pixels=a + b)
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(len(instrumentation.registry()), 0)
+
+        instrumentation.enable()
+        self.assertEqual(add(1, 2), 3)
+
+        span_record = instrumentation.registry().spans[0]
+        self.assertEqual((span_record["stage"], span_record["name"], span_record["pixels"]), ("compute", "add", 3))
+
+
+    def test_timing_decorator(self):
+        """
+            Test the timing helper records its spans in one of the pipeline stages
+        """
+        @timing
+        def add(a, b):
+            return a + b
+
+        instrumentation.enable()
+        self.assertEqual(add(1, 2), 3)
+
+        span_record = instrumentation.registry().spans[0]
+        self.assertEqual((span_record["stage"], span_record["name"]), ("compute", "add"))
+        self.assertIn(span_record["stage"], instrumentation.STAGES)
+
+
+    def test_exports(self):
+        """
+            Test spans are written as json lines and totals as a prometheus textfile
+        """
+        with self.registry.span("read", "read_raster") as read_span:
+            read_span.add(bytes_read=4096)
+
+        jsonl_path = os.path.join(self.directory, "spans.jsonl")
+        write_jsonl(jsonl_path, list(self.registry.spans))
+        write_jsonl(jsonl_path, list(self.registry.spans))
+
+        with open(jsonl_path) as jsonl_file:
+            lines = [json.loads(line) for line in jsonl_file]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]["bytes_read"], 4096)
+
+        prom_path = os.path.join(self.directory, "s2auto.prom")
+        write_prometheus(prom_path, self.registry.summary())
+
+        with open(prom_path) as prom_file:
+            text = prom_file.read()
+        self.assertIn('s2auto_stage_bytes_read_total{stage="read",name="read_raster"} 4096', text)
+        self.assertIn("# TYPE s2auto_stage_wall_seconds_total counter", text)
+
+        # no temporary file is left behind
+        self.assertEqual(sorted(os.listdir(self.directory)), ["s2auto.prom", "spans.jsonl"])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
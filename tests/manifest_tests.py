@@ -0,0 +1,126 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the output manifests used by incremental reprocessing
+
+    Tests:
+
+        Atomic writes
+        Outputs up to date with their inputs and parameters
+        Changed inputs, parameters and outputs
+        Corrupt manifests
+
+"""
+
+from sentinel2_auto.manifest import Manifest, atomic_path, MANIFEST_NAME
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+class TestManifest(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.band_path = os.path.join(self.directory, "T56HLH_20190204T000241_B04.jp2")
+        self.output_path = os.path.join(self.directory, "ndvi_gray.tif")
+        self._write(self.band_path, "band")
+        self._write(self.output_path, "index")
+
+        self.inputs = {"B04": self.band_path}
+        self.params = {"expression": "(B08 - B04) / (B08 + B04)", "storage": "float32", "output_type": "GTiff"}
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def _write(self, path, text, mtime=None):
+        with open(path, "w") as out_file:
+            out_file.write(text)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+
+    def test_atomic_path(self):
+        """
+            Test the temporary file replaces the output on success and is removed on failure
+        """
+        with atomic_path(self.output_path) as tmp_path:
+            self.assertEqual(os.path.dirname(tmp_path), self.directory)
+            self.assertTrue(tmp_path.endswith(".tif"))
+            self._write(tmp_path, "new index")
+
+        with open(self.output_path) as output_file:
+            self.assertEqual(output_file.read(), "new index")
+
+        with self.assertRaises(RuntimeError):
+            with atomic_path(self.output_path) as tmp_path:
+                self._write(tmp_path, "half an index")
+                raise RuntimeError("interrupted")
+
+        with open(self.output_path) as output_file:
+            self.assertEqual(output_file.read(), "new index")
+        self.assertEqual(sorted(os.listdir(self.directory)), ["T56HLH_20190204T000241_B04.jp2", "ndvi_gray.tif"])
+
+
+    def test_up_to_date(self):
+        """
+            Test a recorded output is up to date in a later run until its inputs, parameters or itself change
+        """
+        manifest = Manifest(self.directory)
+        self.assertEqual(manifest.outdated([self.output_path], self.inputs, self.params), [self.output_path])
+
+        manifest.record(self.output_path, self.inputs, self.params)
+        manifest.save()
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, MANIFEST_NAME)))
+
+        rerun = Manifest(self.directory)
+        self.assertEqual(len(rerun), 1)
+        self.assertTrue(rerun.is_up_to_date(self.output_path, self.inputs, self.params))
+
+        # other parameters
+        self.assertFalse(rerun.is_up_to_date(self.output_path, self.inputs, dict(self.params, storage="int16")))
+
+        # a new band file
+        self._write(self.band_path, "new band", mtime=1000000000)
+        self.assertFalse(rerun.is_up_to_date(self.output_path, self.inputs, self.params))
+
+        rerun.record(self.output_path, self.inputs, self.params)
+        self.assertTrue(rerun.is_up_to_date(self.output_path, self.inputs, self.params))
+
+        # the output was replaced or deleted
+        self._write(self.output_path, "someone else's index", mtime=1000000000)
+        self.assertFalse(rerun.is_up_to_date(self.output_path, self.inputs, self.params))
+
+        os.remove(self.output_path)
+        self.assertFalse(rerun.is_up_to_date(self.output_path, self.inputs, self.params))
+
+
+    def test_corrupt_manifest(self):
+        """
+            Test a corrupt manifest is treated as empty
+        """
+        self._write(os.path.join(self.directory, MANIFEST_NAME), "{not json")
+
+        manifest = Manifest(self.directory)
+        self.assertEqual(len(manifest), 0)
+        self.assertFalse(manifest.is_up_to_date(self.output_path, self.inputs, self.params))
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
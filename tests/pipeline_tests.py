@@ -0,0 +1,127 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for planning declarative pipelines
+
+    Tests:
+
+        Loading json recipes
+        Default outputs
+        Only reading the bands that are used
+        Fusing stages into passes
+        Rejecting bad recipes
+
+"""
+
+from sentinel2_auto.pipeline import Pipeline, load_recipe
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+
+
+
+
+BANDS = {"B04": "B04.jp2", "B05": "B05.jp2", "B07": "B07.jp2", "B08": "B08.jp2", "B11": "B11.jp2", "TCI": "TCI.jp2"}
+
+
+
+class TestPipelinePlanning(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_load_json_recipe(self):
+        """
+            Test a json recipe is planned with paths relative to the recipe
+        """
+        recipe_path = os.path.join(self.directory, "recipe.json")
+        with open(recipe_path, "w") as recipe_file:
+            json.dump({"bands": BANDS, "indices": ["ndvi"], "output_dir": "out"}, recipe_file)
+
+        self.assertEqual(load_recipe(recipe_path)["indices"], ["ndvi"])
+
+        pipeline = Pipeline.from_file(recipe_path)
+        self.assertEqual(pipeline.bands["B04"], os.path.join(self.directory, "B04.jp2"))
+        self.assertEqual(sorted(os.path.basename(output["path"]) for output in pipeline.outputs), ["ndvi_colour.tif", "ndvi_gray.tif"])
+        self.assertTrue(all(output["path"].startswith(os.path.join(self.directory, "out")) for output in pipeline.outputs))
+
+
+    def test_only_used_bands_are_read(self):
+        """
+            Test the bands no index or output uses are never read
+        """
+        pipeline = Pipeline({"bands": BANDS, "indices": ["ndvi"]})
+
+        reads = [name for name, stage in pipeline.stages.items() if stage.kind == "read"]
+        self.assertEqual(reads, ["read:B04", "read:B07"])
+
+
+    def test_passes(self):
+        """
+            Test per pixel stages fuse into one pass and colour outputs wait for their stretch
+        """
+        recipe = {
+            "bands": BANDS,
+            "aoi": "paddock.kml",
+            "indices": {"ndvi": None, "ndwi": None, "custom": "(B08 - B04) / (B08 + B04)"},
+            "outputs": [
+                {"source": "TCI", "type": "raster"},
+                {"source": "ndvi", "type": "gray", "storage": "int16"},
+                {"source": "ndvi", "type": "colour"},
+                {"source": "ndwi", "type": "colour", "paletted": True, "format": "COG"},
+                {"source": "custom", "type": "gray"},
+            ],
+        }
+        pipeline = Pipeline(recipe)
+
+        self.assertEqual(len(pipeline.passes), 2)
+
+        first, second = pipeline.passes
+        self.assertEqual(set(name.split(":")[0] for name in first), set(["read", "mask", "index", "raster", "gray", "stretch"]))
+        self.assertEqual(second, ["colour:ndvi_colour.tif", "colour:ndwi_colour.tif"])
+
+        # every band is read once, in the first pass
+        self.assertEqual([name for name in first if name.startswith("read:")], ["read:B04", "read:B07", "read:B08", "read:B11", "read:TCI"])
+        self.assertIn("pass 2: colour:ndvi_colour.tif", pipeline.describe())
+
+
+    def test_bad_recipes(self):
+        """
+            Test recipes that can't be run are rejected when they are planned
+        """
+        bad_recipes = [
+            {"indices": ["ndvi"]},
+            {"bands": BANDS},
+            {"bands": BANDS, "indices": ["not_an_index"]},
+            {"bands": {"B04": "B04.jp2"}, "indices": ["ndvi"]},
+            {"bands": BANDS, "indices": ["ndvi"], "outputs": [{"source": "ndre", "type": "gray"}]},
+            {"bands": BANDS, "indices": ["ndvi"], "outputs": [{"source": "ndvi", "type": "gray", "storage": "int8"}]},
+            {"bands": BANDS, "indices": ["ndvi"], "outputs": [{"source": "ndvi", "type": "colour", "colour_scale": "Rainbow"}]},
+            {"bands": BANDS, "indices": ["ndvi"], "outputs": [{"source": "ndvi", "type": "gray"}, {"source": "ndvi", "type": "gray"}]},
+            {"bands": BANDS, "outputs": [{"source": "B99", "type": "raster"}]},
+        ]
+
+        for recipe in bad_recipes:
+            with self.assertRaises(ValueError):
+                Pipeline(recipe)
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
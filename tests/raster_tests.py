@@ -0,0 +1,152 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for lazy windowed raster access
+
+    Tests:
+
+        Indexing a lazy raster matches indexing the materialised array
+        Only the covering window is read
+        Reading windows of some of the bands
+        Walking a raster in blocks, including the clipped edge blocks
+
+"""
+
+from sentinel2_auto import raster
+from sentinel2_auto.raster import LazyRaster, block_windows
+from gdal_fakes import FakeDataset
+import numpy as np
+import unittest
+
+
+
+
+
+class TestLazyRaster(unittest.TestCase):
+
+
+    def setUp(self):
+        # fake bands report their numpy dtype as their gdal data type
+        self._gdal_to_numpy_dtype = raster.gdal_to_numpy_dtype
+        raster.gdal_to_numpy_dtype = np.dtype
+
+        self.bands = np.arange(37 * 53 * 3, dtype=np.uint16).reshape(37, 53, 3)
+        self.band = self.bands[:, :, :1]
+
+
+    def tearDown(self):
+        raster.gdal_to_numpy_dtype = self._gdal_to_numpy_dtype
+
+
+    def _check_keys(self, array, keys):
+        lazy = LazyRaster(FakeDataset(array))
+        expected_array = array[:, :, 0] if array.shape[2] == 1 else array
+        np.testing.assert_array_equal(np.asarray(lazy), expected_array)
+
+        for key in keys:
+            expected = expected_array[key]
+            result = lazy[key]
+            self.assertEqual(result.shape, expected.shape, "shape of %s" % (key,))
+            self.assertEqual(result.dtype, expected.dtype)
+            np.testing.assert_array_equal(result, expected, "values of %s" % (key,))
+
+
+    def test_single_band_indexing(self):
+        """
+            Test ints, negative ints, slices, steps and out of range slices on a single band raster
+        """
+        keys = [0, -1, 36, (5, 7), (-1, -1), (-37, 0), slice(None), slice(3, 9), slice(-5, None),
+                (slice(2, 30, 4), slice(None, None, 7)), (slice(None), -3), (4, slice(10, -10, 3)),
+                (slice(30, 100), slice(-100, 5)), (slice(None, None, -1), 2), (slice(5, 5), slice(None)),
+                (slice(10, 3), 4), [1, 3], (np.arange(3), 2)]
+        self._check_keys(self.band, keys)
+
+
+    def test_band_axis_indexing(self):
+        """
+            Test indexing over the band axis of a multi band raster
+        """
+        keys = [(0, 0, 0), (-1, -1, -1), (slice(None), slice(None), 1), (slice(2, 9), slice(4, 20, 5), slice(1, None)),
+                (slice(None), 3), (slice(None), slice(None), slice(None, None, 2)), (5, slice(None), slice(0, 2)),
+                (slice(None), slice(None), slice(2, 2)), (slice(None), slice(None), slice(None, None, -1))]
+        self._check_keys(self.bands, keys)
+
+
+    def test_out_of_bounds(self):
+        """
+            Test out of range ints raise IndexError like numpy does
+        """
+        lazy = LazyRaster(FakeDataset(self.bands))
+        for key in [37, -38, (0, 53), (0, 0, 3), (0, 0, -4)]:
+            self.assertRaises(IndexError, lazy.__getitem__, key)
+
+
+    def test_reads_covering_window(self):
+        """
+            Test slicing reads just the window covering the slice, in the band's native dtype
+        """
+        in_ds = FakeDataset(self.bands)
+        lazy = LazyRaster(in_ds)
+
+        self.assertEqual(lazy.shape, (37, 53, 3))
+        self.assertEqual((lazy.ndim, lazy.size, lazy.nbytes, len(lazy)), (3, 37 * 53 * 3, 37 * 53 * 3 * 2, 37))
+
+        lazy[4:10, 20:40:3, 2]
+        self.assertEqual(in_ds.reads, [(20, 4, 20, 6)])
+
+        in_ds.reads = []
+        lazy[-1, 5:7]
+        self.assertEqual(in_ds.reads, [(5, 36, 2, 1)] * 3)
+
+
+    def test_read_window(self):
+        """
+            Test reading a window of all the bands, some of them and one of them
+        """
+        lazy = LazyRaster(FakeDataset(self.bands))
+
+        np.testing.assert_array_equal(lazy.read_window(3, 5, 10, 4), self.bands[5:9, 3:13])
+        np.testing.assert_array_equal(lazy.read_window(3, 5, 10, 4, [1, 3]), self.bands[5:9, 3:13, [0, 2]])
+
+        one_band = lazy.read_window(0, 30, 53, 7, [2])
+        self.assertEqual(one_band.shape, (7, 53))
+        np.testing.assert_array_equal(one_band, self.bands[30:, :, 1])
+
+        single = LazyRaster(FakeDataset(self.band))
+        self.assertEqual(single.shape, (37, 53))
+        np.testing.assert_array_equal(single.read_window(50, 36, 3, 1), self.band[36:, 50:, 0])
+
+
+    def test_iter_blocks(self):
+        """
+            Test the blocks cover every pixel once, with the edge blocks clipped to the raster
+        """
+        lazy = LazyRaster(FakeDataset(self.bands, block_size=(16, 8)))
+
+        for block_size, edge in [(None, (48, 32, 5, 5)), ((10, 10), (50, 30, 3, 7)), ((53, 37), (0, 0, 53, 37)),
+                                 ((100, 1), (0, 36, 53, 1))]:
+            windows = list(lazy.iter_blocks(block_size))
+            self.assertEqual(windows[-1], edge)
+
+            covered = np.zeros(lazy.shape[:2], dtype=np.int32)
+            mosaic = np.zeros_like(self.bands)
+            for xoff, yoff, xsize, ysize in windows:
+                covered[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+                mosaic[yoff:yoff + ysize, xoff:xoff + xsize] = lazy.read_window(xoff, yoff, xsize, ysize)
+
+            self.assertTrue((covered == 1).all())
+            np.testing.assert_array_equal(mosaic, self.bands)
+
+        self.assertEqual(list(block_windows(0, 5, 2, 2)), [])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
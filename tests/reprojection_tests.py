@@ -0,0 +1,162 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the reusable warp plans
+
+    Tests:
+
+        Target grids
+        Nearest and bilinear remapping
+        No data handling
+        Saving, loading and caching plans by tile
+
+"""
+
+from sentinel2_auto.reprojection import Grid, WarpPlan, WarpPlanCache, target_grid
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+
+
+
+
+PROJECTION = 'PROJCS["WGS 84 / UTM zone 56S"]'
+
+# a 10 m, 8 x 6 pixel utm grid
+SOURCE = Grid(8, 6, (300000.0, 10.0, 0.0, 6100000.0, 0.0, -10.0), PROJECTION)
+
+
+
+class TestReprojection(unittest.TestCase):
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = np.arange(48, dtype=np.uint16).reshape(6, 8)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_target_grid(self):
+        """
+            Test the target grid covers the source and keeps its pixel count unless told otherwise
+        """
+        same = target_grid(SOURCE, PROJECTION)
+        self.assertEqual((same.xsize, same.ysize), (8, 6))
+        np.testing.assert_allclose(same.geo_transform, SOURCE.geo_transform)
+
+        halved = target_grid(SOURCE, PROJECTION, shape=(3, 4))
+        self.assertEqual((halved.xsize, halved.ysize), (4, 3))
+        self.assertAlmostEqual(halved.geo_transform[1], 20.0)
+
+        self.assertEqual(target_grid(SOURCE, PROJECTION, pixel_size=(20, 20)), halved)
+
+
+    def test_identity_plan(self):
+        """
+            Test a plan onto the same grid gives the raster back with either resampling
+        """
+        plan = WarpPlan.build(SOURCE, SOURCE)
+
+        np.testing.assert_array_equal(plan.apply(self.data, "nearest"), self.data)
+        np.testing.assert_array_equal(plan.apply(self.data, "bilinear"), self.data)
+
+
+    def test_shifted_grid(self):
+        """
+            Test remapping onto a grid shifted by whole and half pixels
+        """
+        # one pixel right and one down: the last row and column fall off the source
+        shifted = Grid(8, 6, (300010.0, 10.0, 0.0, 6099990.0, 0.0, -10.0), PROJECTION)
+        out = WarpPlan.build(SOURCE, shifted).apply(self.data, "nearest", no_data_value=0)
+
+        np.testing.assert_array_equal(out[:5, :7], self.data[1:, 1:])
+        self.assertTrue((out[5] == 0).all() and (out[:, 7] == 0).all())
+
+        # half a pixel right: bilinear averages neighbouring columns
+        half = Grid(7, 6, (300005.0, 10.0, 0.0, 6100000.0, 0.0, -10.0), PROJECTION)
+        out = WarpPlan.build(SOURCE, half).apply(self.data.astype(np.float32), "bilinear")
+
+        np.testing.assert_allclose(out, (self.data[:, :-1] + self.data[:, 1:]) / 2.0)
+
+
+    def test_downsampled_grid(self):
+        """
+            Test nearest picks pixels and bilinear blends them when halving the resolution
+        """
+        halved = target_grid(SOURCE, PROJECTION, shape=(3, 4))
+        plan = WarpPlan.build(SOURCE, halved)
+
+        np.testing.assert_array_equal(plan.apply(self.data, "nearest"), self.data[1::2, 1::2])
+
+        blocks = self.data.astype(np.float64).reshape(3, 2, 4, 2).mean(axis=(1, 3))
+        np.testing.assert_array_equal(plan.apply(self.data, "bilinear"), np.rint(blocks).astype(np.uint16))
+
+        # every band of a 3-D raster is remapped
+        stack = np.dstack([self.data, self.data * 2])
+        out = plan.apply(stack, "nearest")
+        self.assertEqual(out.shape, (3, 4, 2))
+        np.testing.assert_array_equal(out[:, :, 1], self.data[1::2, 1::2] * 2)
+
+
+    def test_no_data(self):
+        """
+            Test no data pixels are left out of bilinear blends
+        """
+        data = self.data.astype(np.float32)
+        data[0, 0] = -9999
+        data[0:2, 2:4] = np.nan
+
+        halved = target_grid(SOURCE, PROJECTION, shape=(3, 4))
+        out = WarpPlan.build(SOURCE, halved).apply(data, "bilinear", no_data_value=-9999)
+
+        self.assertAlmostEqual(out[0, 0], (1 + 8 + 9) / 3.0, places=5)
+        self.assertEqual(out[0, 1], -9999)
+
+        with self.assertRaises(ValueError):
+            WarpPlan.build(SOURCE, halved).apply(data, "cubic")
+
+        with self.assertRaises(ValueError):
+            WarpPlan.build(SOURCE, halved).apply(data[:3], "nearest")
+
+
+    def test_plan_cache(self):
+        """
+            Test plans are saved by tile, loaded by a new cache and give the same remap
+        """
+        halved = target_grid(SOURCE, PROJECTION, shape=(3, 4))
+
+        cache = WarpPlanCache(self.directory)
+        plan = cache.get(SOURCE, halved, tile="56HLH")
+        self.assertIs(cache.get(SOURCE, halved, tile="56HLH"), plan)
+
+        saved = os.listdir(self.directory)
+        self.assertEqual(len(saved), 1)
+        self.assertTrue(saved[0].startswith("56HLH_") and saved[0].endswith(".npz"))
+
+        loaded = WarpPlanCache(self.directory).get(SOURCE, halved, tile="56HLH")
+        self.assertEqual(loaded.dst_grid, halved)
+        np.testing.assert_array_equal(loaded.apply(self.data, "bilinear"), plan.apply(self.data, "bilinear"))
+
+        # the least recently used plans are dropped from memory
+        small = WarpPlanCache(max_plans=1)
+        small.get(SOURCE, halved)
+        small.get(SOURCE, SOURCE)
+        self.assertEqual(len(small), 1)
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
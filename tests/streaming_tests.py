@@ -0,0 +1,182 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for streaming bands block by block
+
+    Tests:
+
+        Threads reopen files with the open options of the band (eg. an overview level)
+        Inputs of different sizes are refused
+        Threaded streaming writes the same blocks in the same order as one thread, with a bounded number in flight
+        Threaded map_blocks matches one thread
+
+"""
+
+from sentinel2_auto import streaming
+from sentinel2_auto.streaming import stream_blocks, map_blocks
+from sentinel2_auto.raster import block_windows
+from gdal_fakes import FakeDataset, FakeGdal
+import numpy as np
+import threading
+import unittest
+import tempfile
+import time
+import os
+
+
+
+
+
+class TestStreamReopening(unittest.TestCase):
+
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".jp2")
+        os.close(fd)
+
+        self.full = np.arange(64 * 48, dtype=np.float32).reshape(64, 48)
+        self.overview = self.full[::2, ::2].copy()
+        self.gdal = FakeGdal(self.full, [self.overview])
+
+        self._gdal = streaming.gdal
+        streaming.gdal = self.gdal
+
+
+    def tearDown(self):
+        streaming.gdal = self._gdal
+        os.remove(self.path)
+
+
+    def _stream(self, open_options):
+        in_band = FakeDataset(self.overview, self.path).GetRasterBand(1)
+        out_band = FakeDataset(np.zeros_like(self.overview)).GetRasterBand(1)
+        stream_blocks([in_band], [out_band], lambda block: block * 2, block_size=(24, 4), threads=3, open_options=open_options)
+        return out_band.array
+
+
+    def test_overview_is_reopened_with_its_options(self):
+        """
+            Test the threads read the overview, not the corner of the full resolution file
+        """
+        np.testing.assert_array_equal(self._stream([["OVERVIEW_LEVEL=0"]]), self.overview * 2)
+        self.assertTrue(self.gdal.opened)
+        self.assertTrue(all(options == ["OVERVIEW_LEVEL=0"] for _, options in self.gdal.opened))
+
+
+    def test_reopening_at_another_size(self):
+        """
+            Test a band whose file reopens at another size is read through the band itself
+        """
+        np.testing.assert_array_equal(self._stream(None), self.overview * 2)
+        self.assertEqual(self.gdal.opened, [(self.path, None)])
+
+
+
+class TestThreadedStreaming(unittest.TestCase):
+
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.nir = rng.randint(0, 10000, (70, 45)).astype(np.float32)
+        self.red = rng.randint(0, 10000, (70, 45)).astype(np.float32)
+        self.lock = threading.Lock()
+
+
+    def _stream(self, threads, block_size=(20, 8)):
+        """
+            Stream an ndvi and its sum over the fake bands, recording the most blocks computed but not yet written
+        """
+        in_bands = [FakeDataset(self.nir).GetRasterBand(1), FakeDataset(self.red).GetRasterBand(1)]
+        out_bands = [FakeDataset(np.zeros_like(self.nir)).GetRasterBand(1), FakeDataset(np.zeros_like(self.nir)).GetRasterBand(1)]
+        self.max_pending = 0
+
+        def func(nir, red):
+            with self.lock:
+                pending = len(self.computed) - len(out_bands[0].writes)
+                self.max_pending = max(self.max_pending, pending + 1)
+                self.computed.append(None)
+
+            # finish the blocks out of order
+            time.sleep(0.002 * (len(self.computed) % 3))
+            return [(nir - red) / (nir + red + 1), nir + red]
+
+        self.computed = []
+        stream_blocks(in_bands, out_bands, func, block_size=block_size, threads=threads)
+        return out_bands
+
+
+    def test_threads_match_one_thread(self):
+        """
+            Test several threads write the same results, in the same window order, as one thread
+        """
+        expected = list(block_windows(45, 70, 20, 8))
+        single = self._stream(1)
+
+        for threads in (2, 4):
+            threaded = self._stream(threads)
+            for single_band, threaded_band in zip(single, threaded):
+                np.testing.assert_array_equal(threaded_band.array, single_band.array)
+                self.assertEqual(threaded_band.writes, [window[:2] for window in expected])
+
+        np.testing.assert_array_equal(single[1].array, self.nir + self.red)
+
+
+    def test_in_flight_bound(self):
+        """
+            Test no more than two blocks per thread are computed ahead of the writes
+        """
+        for threads in (1, 2, 3):
+            self._stream(threads, block_size=(45, 1))
+            self.assertLessEqual(self.max_pending, max(1, 2 * threads))
+            self.assertEqual(len(self.computed), 70)
+
+
+    def test_map_blocks_threads_match_one_thread(self):
+        """
+            Test threaded map_blocks fills the same outputs as one thread, including a short last strip
+        """
+        def func(nir, red):
+            return [(nir - red) / (nir + red + 1), nir + red]
+
+        results = []
+        for threads in (1, 3):
+            out_arrays = [np.zeros_like(self.nir), np.zeros_like(self.nir)]
+            map_blocks([self.nir, self.red], func, out_arrays, block_rows=16, threads=threads)
+            results.append(out_arrays)
+
+        for single, threaded in zip(*results):
+            np.testing.assert_array_equal(threaded, single)
+        np.testing.assert_array_equal(results[1][0], (self.nir - self.red) / (self.nir + self.red + 1))
+
+
+
+class TestInputSizes(unittest.TestCase):
+
+
+    def test_different_sizes(self):
+        """
+            Test bands or arrays of different sizes raise a ValueError instead of reading windows of the first one
+        """
+        full = np.zeros((64, 48), dtype=np.float32)
+        half = np.zeros((32, 24), dtype=np.float32)
+        in_bands = [FakeDataset(full).GetRasterBand(1), FakeDataset(half).GetRasterBand(1)]
+        out_band = FakeDataset(np.zeros_like(full)).GetRasterBand(1)
+
+        for threads in (1, 3):
+            self.assertRaisesRegexp(ValueError, "64x48, 32x24", stream_blocks, in_bands, [out_band], np.add, threads=threads)
+            self.assertRaises(ValueError, map_blocks, [full, half], np.add, [np.zeros_like(full)], threads=threads)
+
+        # a single row array would otherwise broadcast silently
+        self.assertRaises(ValueError, map_blocks, [full, full[:1]], np.add, [np.zeros_like(full)])
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the temporal reductions of a TileStack
+
+    Tests:
+
+        Reductions against numpy
+        Missing observations
+        Sensing times from band file names
+
+"""
+
+from sentinel2_auto.timeseries import reduce_stack, sensing_time, REDUCTIONS
+from datetime import datetime
+import numpy as np
+import unittest
+
+
+
+
+class TestTemporalReductions(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            Make a stack of 6 dates where each pixel grows linearly, with some missing observations
+        """
+        self.days = np.array([0, 10, 20, 35, 50, 80], dtype=float)
+        random = np.random.RandomState(0)
+        slopes = random.uniform(-0.01, 0.01, (20, 30))
+
+        self.stack = (0.2 + slopes[np.newaxis] * self.days[:, np.newaxis, np.newaxis]).astype(np.float32)
+        self.stack[2, :5, :5] = np.nan
+        self.stack[:, 0, 0] = np.nan
+        self.slopes = slopes
+
+
+    def test_reductions(self):
+        """
+            Every reduction skips the missing dates
+        """
+        results = reduce_stack(self.stack, self.days, sorted(REDUCTIONS))
+
+        # the first row holds the pixel with no observations
+        np.testing.assert_allclose(results["max"][1:], np.nanmax(self.stack[:, 1:], axis=0))
+        np.testing.assert_allclose(results["mean"][1:], np.nanmean(self.stack[:, 1:], axis=0), rtol=1e-5)
+        np.testing.assert_allclose(results["median"][1:], np.nanmedian(self.stack[:, 1:], axis=0))
+
+        np.testing.assert_allclose(results["slope"][1:], self.slopes[1:], atol=1e-5)
+        self.assertEqual(results["count"][1, 1], 5)
+        self.assertEqual(results["count"][10, 10], 6)
+
+        for name in ("max", "mean", "median", "slope"):
+            self.assertTrue(np.isnan(results[name][0, 0]))
+        self.assertEqual(results["max_date"][0, 0], -1)
+
+
+    def test_sensing_time(self):
+        """
+            The sensing time is read from the band file names
+        """
+        granule = {"B04": "/data/S2A.SAFE/GRANULE/IMG_DATA/T56HLH_20190204T000241_B04.jp2"}
+        self.assertEqual(sensing_time(granule), datetime(2019, 2, 4, 0, 2, 41))
+        self.assertRaises(ValueError, sensing_time, {"B04": "/data/band4.tif"})
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTemporalReductions)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,77 @@
+"""
+    Project:
+        sentinel2_auto
+
+    Author:
+        Alex Cornelio
+
+    File:
+        Tests for the zonal statistics reductions
+
+    Tests:
+
+        Statistics of every zone against numpy
+        Empty zones and no data
+
+"""
+
+from sentinel2_auto.zonal import zonal_statistics
+import numpy as np
+import unittest
+
+
+
+
+class TestZonalStatistics(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+            Make a random index with some undefined pixels and a label image of 50 zones, the last of which is empty
+        """
+        random = np.random.RandomState(0)
+        self.values = random.uniform(-1, 1, (300, 400)).astype(np.float32)
+        self.values[:20, :20] = np.nan
+        self.labels = random.randint(0, 50, (300, 400)).astype(np.int32)
+        self.zone_count = 50
+
+
+    def test_statistics(self):
+        """
+            Every statistic matches numpy over each zone's defined pixels
+        """
+        table = zonal_statistics(self.values, self.labels, self.zone_count, ("count", "sum", "mean", "std", "min", "max"), (10, 50, 90))
+        self.assertEqual(list(table.keys()), ["count", "sum", "mean", "std", "min", "max", "p10", "p50", "p90"])
+
+        for zone in range(1, self.zone_count):
+            values = self.values[(self.labels == zone) & ~np.isnan(self.values)].astype(np.float64)
+
+            self.assertEqual(table["count"][zone - 1], len(values))
+            self.assertAlmostEqual(table["sum"][zone - 1], values.sum(), places=6)
+            self.assertAlmostEqual(table["mean"][zone - 1], values.mean())
+            self.assertAlmostEqual(table["std"][zone - 1], values.std())
+            self.assertEqual(table["min"][zone - 1], values.min())
+            self.assertEqual(table["max"][zone - 1], values.max())
+            np.testing.assert_allclose([table[p][zone - 1] for p in ("p10", "p50", "p90")], np.percentile(values, (10, 50, 90)))
+
+
+    def test_empty_zones(self):
+        """
+            Zones without a valid pixel have a count of 0 and NaN statistics
+        """
+        no_data_mask = self.labels == 3
+        table = zonal_statistics(self.values, self.labels, self.zone_count, percentiles=(50,), no_data_mask=no_data_mask)
+
+        for zone in (3, self.zone_count):
+            self.assertEqual(table["count"][zone - 1], 0)
+            for name in ("mean", "std", "min", "max", "p50"):
+                self.assertTrue(np.isnan(table[name][zone - 1]))
+
+
+
+
+if __name__ == '__main__':
+
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestZonalStatistics)
+    unittest.TextTestRunner(verbosity=2).run(suite)